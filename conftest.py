@@ -1,6 +1,10 @@
+import http.server
+import json
 import pytest
 import os
+import socket
 import sys
+import threading
 
 from djwebdapp.models import Account, Blockchain
 from djwebdapp_multisig.models import MultisigContract
@@ -108,3 +112,57 @@ def account(blockchain):
         address='testacc',
         blockchain=blockchain,
     )
+
+
+@pytest.fixture
+def http_stub():
+    """
+    Start local HTTP servers answering with a handler function.
+
+    The handler takes (method, path, body) and returns a (status, data)
+    tuple, data is sent as JSON. Return the server URL.
+    """
+    servers = []
+
+    def start(handler):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def respond(self):
+                length = int(self.headers.get('Content-Length', 0) or 0)
+                body = self.rfile.read(length) if length else b''
+                status, data = handler(
+                    self.command,
+                    self.path,
+                    json.loads(body) if body else None,
+                )
+                content = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = respond
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f'http://127.0.0.1:{server.server_port}'
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def http_dead():
+    """ Return the URL of a local port nothing listens on. """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return f'http://127.0.0.1:{port}'
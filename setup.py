@@ -15,6 +15,7 @@ extras_require = dict(
         #'web3>=6.7.0',  # no [dev] for persistent deployments
         'web3>=6.7.0,<=6.20',
         'eth-typing<5',
+        'rlp',
     ],
     tezos=[
         'pytezos>3.4',
@@ -46,6 +47,7 @@ setup(
         'django-picklefield>=3.0.1',
         'networkx==2.8.8',
         'mnemonic',
+        'requests',
     ],
     extras_require=extras_require,
     author='James Pic',
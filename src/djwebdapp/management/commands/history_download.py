@@ -7,6 +7,9 @@ class Command(BaseCommand):
     help = '''
     Import a contract from tzkt.
 
+    An interrupted download resumes from the last imported operation when
+    the command runs again.
+
     Example usage:
 
         ./manage.py history_download 'Tezos Mainnet' <address>
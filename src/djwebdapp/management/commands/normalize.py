@@ -6,11 +6,30 @@ from djwebdapp.models import Blockchain
 class Command(BaseCommand):
     help = 'Normalize indexed transactions'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=0,
+            help='Normalize contracts in parallel with this many processes',
+        )
+        parser.add_argument(
+            '--requeue',
+            action='store_true',
+            help='Retry transactions which failed normalization too often',
+        )
+
     def handle(self, *args, **options):
         for blockchain in Blockchain.objects.filter(is_active=True):
             try:
+                if options['requeue']:
+                    requeued = blockchain.provider.normalize_requeue()
+                    blockchain.provider.logger.info(f'Requeued {requeued}')
                 blockchain.provider.logger.info(f'Normalizing {blockchain}')
-                blockchain.provider.normalize()
+                if options['workers']:
+                    blockchain.provider.normalize_parallel(options['workers'])
+                else:
+                    blockchain.provider.normalize()
             except:  # noqa
                 blockchain.provider.logger.exception(
                     f'{blockchain}.normalize() failure!'
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djwebdapp', '0018_blockchain_chain_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Code',
+            fields=[
+                ('hash', models.CharField(editable=False, max_length=64, primary_key=True, serialize=False)),
+                ('code', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='code',
+            field=models.ForeignKey(blank=True, editable=False, help_text='Smart contract code, if this is a smart contract', null=True, on_delete=django.db.models.deletion.PROTECT, to='djwebdapp.code'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djwebdapp', '0019_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lease',
+            fields=[
+                ('name', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('owner', models.CharField(max_length=255)),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+    ]
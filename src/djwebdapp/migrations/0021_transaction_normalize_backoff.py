@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djwebdapp', '0020_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='normalize_after',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Retry normalization after this datetime', null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='normalize_fails',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of consecutive normalization failures'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('normalize_fails', 0), ('normalized', False), ('state', 'done')), fields=['blockchain', 'created_at', 'id'], name='djwebdapp_normalize_new'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('normalize_after__isnull', False), ('normalized', False)), fields=['blockchain', 'normalize_after'], name='djwebdapp_normalize_retry'),
+        ),
+    ]
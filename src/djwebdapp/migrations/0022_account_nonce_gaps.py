@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djwebdapp', '0021_transaction_normalize_backoff'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='nonce_gaps',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
@@ -1,14 +1,20 @@
 import binascii
 import datetime
+import functools
+import hashlib
 import importlib
+import json
 import networkx
 import os
+import socket
+import threading
 import time
 import traceback
 import uuid
 
 from django.conf import settings
-from django.db import models
+from django.db import OperationalError, models
+from django.db import transaction as db_transaction
 from django.db.models import Q, Max, signals
 from django.dispatch import receiver
 from django.utils import timezone
@@ -26,11 +32,29 @@ SETTINGS = dict(
         ('djwebdapp.provider.Success', 'Test that always succeeds'),
         ('djwebdapp.provider.FailDeploy', 'Test that fails deploy'),
         ('djwebdapp.provider.FailWatch', 'Test that fails watch'),
-    )
+    ),
+    # keep-alive connections per node endpoint, see djwebdapp.nodes
+    HTTP_POOL_MAXSIZE=10,
+    HTTP_POOL_BLOCK=False,
+    # workers deploying calls in parallel, see djwebdapp.provider.DeployPool
+    DEPLOY_POOL='process',
+    DEPLOY_POOL_SIZE=15,
+    # parsed tezos contract interfaces, see djwebdapp_tezos.models
+    TEZOS_INTERFACES=128,
+    # web3 contract objects and event topics, see djwebdapp_ethereum.provider
+    ETHEREUM_INTERFACES=256,
 )
 SETTINGS.update(getattr(settings, 'DJBLOCKCHAIN', {}))
 
 
+@functools.lru_cache(maxsize=None)
+def import_provider_class(provider_class):
+    """ Return the provider class for a dotted path, cached per process. """
+    parts = provider_class.split('.')
+    mod = importlib.import_module('.'.join(parts[:-1]))
+    return getattr(mod, parts[-1])
+
+
 class Account(models.Model):
     """
     A blockchain account.
@@ -85,6 +109,19 @@ class Account(models.Model):
 
         Counter of transactions sent from this account.
 
+    .. py:attribute:: nonce_gaps
+
+        Nonces below :py:attr:`counter` which are not used by a transaction,
+        because they were given back or dropped by the node, so they are
+        reserved again first.
+
+    .. py:attribute:: nonce_fields
+
+        Fields which the provider writes with the row locked and explicit
+        update_fields. Code which saves an account while nonces may be
+        reserved, such as :py:meth:`refresh_balance()`, passes its own
+        update_fields so that it does not overwrite them.
+
     .. py:attribute:: last_level
 
         Last block level when a transaction was sent from this account.
@@ -139,12 +176,19 @@ class Account(models.Model):
     secret_key = EncryptedTextField()
     revealed = models.BooleanField(default=False)
     counter = models.PositiveIntegerField(null=True)
+    nonce_gaps = models.JSONField(
+        default=list,
+        blank=True,
+        editable=False,
+    )
     last_level = models.PositiveIntegerField(null=True)
     index = models.BooleanField(
         default=True,
         help_text='Wether the indexer should index all transactions or not',
     )
 
+    nonce_fields = ('counter', 'nonce_gaps')
+
     objects = InheritanceManager()
 
     class Meta:
@@ -181,8 +225,11 @@ class Account(models.Model):
         new_balance = self.blockchain.provider.get_balance(self.address)
         if new_balance != self.balance:
             self.balance = new_balance
-            if commit:
+            if commit and self._state.adding:
                 self.save()
+            elif commit:
+                # do not overwrite the nonces reserved in the meantime
+                self.save(update_fields=('balance', 'updated_at'))
         return self.balance
 
     def set_secret_key(self, value):
@@ -336,13 +383,16 @@ class Blockchain(models.Model):
     @property
     def provider_cls(self):
         """ Return the imported provider class. """
-        parts = self.provider_class.split('.')
-        mod = importlib.import_module('.'.join(parts[:-1]))
-        return getattr(mod, parts[-1])
+        return import_provider_class(self.provider_class)
 
     @property
     def provider(self):
-        """ Return a fresh instance of the provider class bound to self. """
+        """
+        Return a fresh instance of the provider class bound to self.
+
+        The client of the provider is shared by every provider instance of
+        this blockchain, see :py:class:`~djwebdapp.provider.ClientRegistry`.
+        """
         return self.provider_cls(blockchain=self)
 
     def wait(self):
@@ -368,13 +418,14 @@ class Blockchain(models.Model):
 
     def wait_level(self, level):
         """ Wait for the blockchain head to reach a given level. """
-        while self.provider.head < level:
+        provider = self.provider
+        while provider.head_refresh() < level:
             time.sleep(.1)
 
     def wait_blocks(self, blocks=None):
         """ Wait for the blockchain head to advance a number of blocks. """
         blocks = blocks or self.min_confirmations
-        self.wait_level(self.provider.head + blocks)
+        self.wait_level(self.provider.head_refresh() + blocks)
 
 
 class Node(models.Model):
@@ -465,6 +516,64 @@ class Explorer(models.Model):
     )
 
 
+def code_hash(code):
+    """
+    Return the SHA-256 hex digest of the canonical JSON of some code, used as
+    primary key of :py:class:`Code`.
+    """
+    return hashlib.sha256(
+        json.dumps(code, sort_keys=True, separators=(',', ':')).encode()
+    ).hexdigest()
+
+
+class CodeManager(models.Manager):
+    def store(self, code):
+        """
+        Return the :py:class:`Code` of some code, create it if necessary.
+        """
+        return self.get_or_create(
+            hash=code_hash(code),
+            defaults=dict(code=code),
+        )[0]
+
+
+class Code(models.Model):
+    """
+    Smart contract code, stored once for every contract with that code.
+
+    Transactions reference their code with the
+    :py:attr:`~Transaction.code` foreign key, blockchain-specific subclasses
+    expose it as attributes, ie.
+    :py:attr:`~djwebdapp_tezos.models.TezosTransaction.micheline`.
+
+    .. py:attribute:: hash
+
+        SHA-256 of the code, see :py:func:`code_hash()`.
+
+    .. py:attribute:: code
+
+        Code JSON, in the format of the blockchain.
+
+    .. py:attribute:: created_at
+
+        Automatic datetime of the creation of this code in the database.
+    """
+    hash = models.CharField(
+        max_length=64,
+        primary_key=True,
+        editable=False,
+    )
+    code = models.JSONField()
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+    )
+
+    objects = CodeManager()
+
+    def __str__(self):
+        return self.hash
+
+
 class TransactionManager(InheritanceManager):
     """
     Manager for the :py:class:`Transaction` model.
@@ -487,6 +596,7 @@ class TransactionManager(InheritanceManager):
                 **lookup_attributes,
                 **(defaults or {}),
             )
+            instance.code_store()
             instance.save_base(raw=True, force_insert=True)
             instance.refresh_from_db()
             return instance, True
@@ -599,6 +709,11 @@ class Transaction(models.Model):
         If the transaction is a contract creation, and the transaction
         contains the deployed contract code, this field is set to True.
 
+    .. py:attribute:: code
+
+        Foreign key to the :py:class:`Code` of the contract, if this
+        transaction is a contract, see :py:meth:`code_get()`.
+
     .. py:attribute:: metadata
 
         This field contains the metadata of the transaction.
@@ -608,6 +723,17 @@ class Transaction(models.Model):
         Enabled when transaction is normalized.
         Set True by the :py:meth:`~Transaction.normalize` method.
 
+    .. py:attribute:: normalize_fails
+
+        Number of consecutive normalization failures.
+
+    .. py:attribute:: normalize_after
+
+        Datetime after which normalization is retried, if it failed. None
+        for a failed transaction means that it failed too many times, and
+        is left aside until it is requeued, see
+        :py:meth:`~djwebdapp.provider.Provider.normalize_retry_after()`.
+
     .. py:attribute:: state
 
         Status of the transaction. By default, the transaction is in the
@@ -762,6 +888,14 @@ class Transaction(models.Model):
         default=False,
         help_text='Checked if this transaction has smart contract code.',
     )
+    code = models.ForeignKey(
+        Code,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text='Smart contract code, if this is a smart contract',
+    )
     metadata = models.JSONField(
         default=dict,
         blank=True,
@@ -782,6 +916,17 @@ class Transaction(models.Model):
         default=False,
         help_text='Enabled when transaction is normalized',
     )
+    normalize_fails = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text='Number of consecutive normalization failures',
+    )
+    normalize_after = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text='Retry normalization after this datetime',
+    )
     state = models.CharField(
         choices=STATE_CHOICES,
         default='deploy',
@@ -868,6 +1013,27 @@ class Transaction(models.Model):
             'nonce',
         )
         ordering = ['-created_at']
+        indexes = [
+            # transactions to normalize for the first time
+            models.Index(
+                fields=['blockchain', 'created_at', 'id'],
+                condition=Q(
+                    normalized=False,
+                    state='done',
+                    normalize_fails=0,
+                ),
+                name='djwebdapp_normalize_new',
+            ),
+            # failed transactions to normalize again
+            models.Index(
+                fields=['blockchain', 'normalize_after'],
+                condition=Q(
+                    normalized=False,
+                    normalize_after__isnull=False,
+                ),
+                name='djwebdapp_normalize_retry',
+            ),
+        ]
 
     def __str__(self):
         if self.name:
@@ -886,15 +1052,28 @@ class Transaction(models.Model):
         else:
             return str(self.pk)
 
-    def state_set(self, state):
+    def state_set(self, state, commit=True, provider=None,
+                  update_fields=None):
         """
         Set :py:attr:`~state` attribute and save it to the :py:attr:`~history`.
+
+        :param commit: Needs to be True for this method to actually save
+                       the model.
+        :param provider: :py:class:`~djwebdapp.provider.Provider` to get the
+                         head level and logger from, pass it to avoid
+                         instanciating a new one and querying the head again.
+        :param update_fields: Fields that changed besides the state, to save
+                              only those with the state and history rather
+                              than rewrite the whole row, including large
+                              fields such as :py:attr:`metadata`. The whole
+                              row is saved by default, or if it is not in
+                              the database yet.
         """
+        provider = provider or self.blockchain.provider
         if state == 'done':
             confirmed_level = self.level + self.blockchain.min_confirmations
-            head = self.blockchain.provider.head
-            if confirmed_level > head:
-                self.blockchain.provider.logger.info(
+            if confirmed_level > provider.head:
+                provider.logger.info(
                     f'Set {self} to confirm instead of done'
                 )
                 state = 'confirm'
@@ -904,10 +1083,16 @@ class Transaction(models.Model):
             self.state,
             int(datetime.datetime.now().strftime('%s')),
         ])
-        self.blockchain.provider.logger.info(
+        provider.logger.info(
             f'{self}.state={state}'
         )
-        self.save()
+        if commit:
+            if update_fields is None or self._state.adding:
+                self.save()
+            else:
+                self.save(update_fields={
+                    'state', 'history', 'updated_at', *update_fields,
+                })
 
     @property
     def provider(self):
@@ -930,12 +1115,13 @@ class Transaction(models.Model):
         If the deploy attempts count is above the :py:attr:`max_fails` field,
         then set :py:attr:`state` to `aborted`, otherwise, set it to `retry`.
         """
-        self.provider.logger.info(f'Deploying {self}')
-        self.state_set('deploying')
+        provider = self.sender.provider
+        provider.logger.info(f'Deploying {self}')
+        self.state_set('deploying', provider=provider, update_fields=())
         try:
-            self.sender.provider.deploy(self)
+            provider.deploy(self)
         except Exception:
-            self.sender.provider.logger.exception('Deploy fail')
+            provider.logger.exception('Deploy fail')
             self.last_fail = timezone.now()
 
             deploys_since_last_start = 0
@@ -952,14 +1138,30 @@ class Transaction(models.Model):
                     'last error:',
                     self.error or '',
                 ])
-                self.state_set('aborted')
+                self.state_set(
+                    'aborted',
+                    provider=provider,
+                    update_fields=('last_fail', 'error'),
+                )
             else:
-                self.state_set('retry')
+                self.state_set(
+                    'retry',
+                    provider=provider,
+                    update_fields=('last_fail', 'error'),
+                )
             raise
         else:
             self.last_fail = None
             self.error = ''
-            self.state_set('done')
+            self.state_set(
+                'done',
+                provider=provider,
+                update_fields=(
+                    'last_fail',
+                    'error',
+                    *provider.deploy_update_fields,
+                ),
+            )
             # indexer is supposed to place it in done
 
     def save(self, *args, **kwargs):
@@ -994,8 +1196,49 @@ class Transaction(models.Model):
         if not self.blockchain_id and self.contract_id:
             self.blockchain_id = self.contract.blockchain_id
 
+        if self.code_changed and kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'code'}
+        self.code_store()
+
         return super().save(*args, **kwargs)
 
+    @property
+    def code_changed(self):
+        """
+        True if :py:meth:`code_set()` was called since the last save.
+        """
+        return 'code_pending' in self.__dict__
+
+    def code_get(self):
+        """
+        Return the code of this transaction, None if it has no code.
+        """
+        if self.code_changed:
+            return self.code_pending
+        if self.code_id:
+            return self.code.code
+
+    def code_set(self, code):
+        """
+        Set the code of this transaction, stored by :py:meth:`code_store()`.
+        """
+        self.code_pending = code or None
+
+    def code_store(self):
+        """
+        Reference the :py:class:`Code` set by :py:meth:`code_set()`, if any.
+
+        Code is stored once per :py:func:`code_hash()`, so the
+        :py:class:`Code` row is only queried if the code hash changed.
+        """
+        if not self.code_changed:
+            return
+        code = self.__dict__.pop('code_pending')
+        if code is None:
+            self.code = None
+        elif code_hash(code) != self.code_id:
+            self.code = Code.objects.store(code)
+
     def get_args(self):
         """
         Return the arguments of the transaction.
@@ -1064,32 +1307,59 @@ class Transaction(models.Model):
         elif self.normalizer_class:
             return self.normalizer_class
 
-    def normalize(self):
+    def normalize(self, contract=None, commit=True):
         """
         Method invoked when normalizing a transaction.
 
         By default, this relies on
         :py:attr:`~djwebdapp.models.Transaction.normalizer_class`
+
+        Return True if the normalizer was called, then :py:attr:`normalized`,
+        :py:attr:`error` and :py:attr:`last_fail` are set, and so are
+        :py:attr:`normalize_fails` and :py:attr:`normalize_after` to back off
+        from failing transactions.
+
+        :param contract: The :py:meth:`contract_subclass()`, pass it to avoid
+                         querying it again.
+        :param commit: Needs to be True for this method to actually save
+                       the model.
         """
-        contract = self.contract_subclass()
+        contract = contract or self.contract_subclass()
         if not contract:
-            return
+            return False
 
         normalizer = contract.normalizer_get()
         if not normalizer:
-            return
+            return False
 
         try:
-            normalizer.normalize(self, contract)
+            # roll back what the normalizer did if it fails
+            with db_transaction.atomic():
+                normalizer.normalize(self, contract)
         except Exception:
-            self.sender.provider.logger.exception('Exception in normalization')
+            provider = contract.provider
+            provider.logger.exception('Exception in normalization')
             self.error = traceback.format_exc()
             self.last_fail = timezone.now()
+            self.normalize_fails += 1
+            self.normalize_after = provider.normalize_retry_after(
+                self.normalize_fails,
+            )
         else:
-            self.normalized = True
-            self.error = ''
-            self.last_fail = None
-        self.save()
+            self.normalize_success()
+        if commit:
+            self.save()
+        return True
+
+    def normalize_success(self):
+        """
+        Set the fields of a normalized transaction, without saving.
+        """
+        self.normalized = True
+        self.error = ''
+        self.last_fail = None
+        self.normalize_fails = 0
+        self.normalize_after = None
 
     @property
     def contract_path(self):
@@ -1102,6 +1372,14 @@ class Transaction(models.Model):
             self.contract_name,
         )
 
+    def contract_subclass_id(self):
+        """
+        Return the primary key of :py:meth:`contract_subclass()`.
+        """
+        if self.kind == 'contract':
+            return self.pk
+        return getattr(self, 'contract_id', None)
+
     def contract_subclass(self):
         """
         Return the subclass of the `.contract` relation.
@@ -1137,26 +1415,44 @@ class Event(models.Model):
 
     objects = InheritanceManager()
 
+    def contract_subclass_id(self):
+        return self.transaction.contract_subclass_id()
+
     def contract_subclass(self):
         return self.transaction.contract_subclass()
 
-    def normalize(self):
-        contract = self.contract_subclass()
+    def normalize(self, contract=None, commit=True):
+        """
+        Normalize this event with the normalizer of its contract.
+
+        Return True if the event was normalized.
+
+        :param contract: The :py:meth:`contract_subclass()`, pass it to avoid
+                         querying it again.
+        :param commit: Needs to be True for this method to actually save
+                       the model.
+        """
+        contract = contract or self.contract_subclass()
 
         if not contract:
-            return
+            return False
 
         normalizer = contract.normalizer_get()
         if not normalizer:
-            return
+            return False
 
         try:
-            normalizer.normalize_event(self, contract)
+            # roll back what the normalizer did if it fails
+            with db_transaction.atomic():
+                normalizer.normalize_event(self, contract)
         except Exception:
             contract.provider.logger.exception('Exception in event normalizer')
-        else:
-            self.normalized = True
+            return False
+
+        self.normalized = True
+        if commit:
             self.save()
+        return True
 
 
 @receiver(signals.post_save)
@@ -1233,3 +1529,114 @@ class Dependency(models.Model):
         blank=True,
         auto_now=True,
     )
+
+
+class Lease(models.Model):
+    """
+    Lock on a named resource, held by one worker until it expires, so that
+    workers of any process or host never work on the same resource.
+
+    .. py:attribute:: name
+
+        Name of the leased resource, ie. ``normalize:<contract id>``.
+
+    .. py:attribute:: owner
+
+        Identifier of the worker holding the lease, see :py:meth:`owner_id()`.
+
+    .. py:attribute:: expires_at
+
+        Datetime after which another worker may take the lease.
+    """
+    name = models.CharField(
+        max_length=255,
+        primary_key=True,
+    )
+    owner = models.CharField(
+        max_length=255,
+    )
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.name} by {self.owner}'
+
+    @staticmethod
+    def owner_id():
+        """
+        Return the identifier of the current worker: host, process and
+        thread.
+        """
+        return ':'.join((
+            socket.gethostname(),
+            str(os.getpid()),
+            str(threading.get_ident()),
+        ))
+
+    @classmethod
+    def acquire(cls, name, ttl, retries=5):
+        """
+        Return the lease of name for the current worker, None if another
+        worker holds it.
+
+        Acquisition is retried with a short back-off if the database is
+        locked, as SQLite fails a writer while another one holds the lock
+        instead of waiting, so that concurrent workers do not skip a
+        contract which nobody holds.
+
+        :param ttl: Number of seconds after which the lease expires, unless
+                    it is renewed.
+        :param retries: Number of attempts while the database is locked.
+        """
+        for attempt in range(retries):
+            try:
+                with db_transaction.atomic():
+                    return cls.take(name, ttl)
+            except OperationalError:
+                if attempt + 1 == retries:
+                    raise
+                time.sleep(.05 * 2 ** attempt)
+
+    @classmethod
+    def take(cls, name, ttl):
+        """
+        Try to take the lease of name once, see :py:meth:`acquire()`.
+        """
+        now = timezone.now()
+        lease = cls(
+            name=name,
+            owner=cls.owner_id(),
+            expires_at=now + datetime.timedelta(seconds=ttl),
+        )
+        cls.objects.bulk_create(
+            [cls(name=name, owner='', expires_at=now)],
+            ignore_conflicts=True,
+        )
+        # the database serializes updates, only one worker gets the row
+        taken = cls.objects.filter(
+            Q(expires_at__lte=now) | Q(owner=lease.owner),
+            name=name,
+        ).update(
+            owner=lease.owner,
+            expires_at=lease.expires_at,
+        )
+        if taken:
+            return lease
+
+    def renew(self, ttl):
+        """
+        Extend the lease by ttl seconds, return False if it was lost.
+        """
+        expires_at = timezone.now() + datetime.timedelta(seconds=ttl)
+        renewed = Lease.objects.filter(
+            name=self.name,
+            owner=self.owner,
+        ).update(expires_at=expires_at)
+        if renewed:
+            self.expires_at = expires_at
+        return bool(renewed)
+
+    def release(self):
+        """
+        Release the lease if it is still held.
+        """
+        Lease.objects.filter(name=self.name, owner=self.owner).delete()
@@ -0,0 +1,286 @@
+"""
+Node pool to spread queries over the nodes of a blockchain.
+
+Providers wrap their blockchain clients around a :py:class:`NodePool` so that
+queries go to the :py:class:`~djwebdapp.models.Node` with the highest
+priority, fail over to the next one when a node does not answer, and skip
+failing nodes for a while.
+
+Queries to a node endpoint go through the keep-alive session of
+:py:func:`get_session()`, shared by every client of the process.
+"""
+import itertools
+import os
+import threading
+import time
+import urllib.error
+
+import requests
+
+from djwebdapp.models import SETTINGS
+
+
+sessions = dict()
+sessions_lock = threading.Lock()
+
+
+def get_session(endpoint):
+    """
+    Return the keep-alive requests session of a node endpoint.
+
+    Sessions are shared by every client of the process. The number of
+    connections kept alive per endpoint is set by the ``HTTP_POOL_MAXSIZE``
+    key of the ``DJBLOCKCHAIN`` setting, and ``HTTP_POOL_BLOCK`` makes
+    threads wait for a free connection rather than open extra ones.
+    """
+    with sessions_lock:
+        if endpoint not in sessions:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=SETTINGS['HTTP_POOL_MAXSIZE'],
+                pool_block=SETTINGS['HTTP_POOL_BLOCK'],
+            )
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[endpoint] = session
+        return sessions[endpoint]
+
+
+def sessions_reset():
+    """
+    Forget all sessions, so that connections are not shared with a parent
+    process after a fork.
+    """
+    global sessions_lock
+    # the lock may have been held by another thread of the parent
+    sessions_lock = threading.Lock()
+    sessions.clear()
+
+
+os.register_at_fork(after_in_child=sessions_reset)
+
+
+class NodeBehind(Exception):
+    """
+    Raised by pool queries when a node does not have the data yet, because
+    it is behind the others.
+
+    The next node is tried without counting a failure, if no node has the
+    data then the result of the last node is returned, or raised if it is an
+    exception.
+    """
+    def __init__(self, result):
+        super().__init__(result)
+        self.result = result
+
+
+class NodeState:
+    """
+    Health of a node in a :py:class:`NodePool`.
+
+    .. py:attribute:: endpoint
+
+        Node endpoint URL.
+
+    .. py:attribute:: priority
+
+        Nodes with the highest priority are used first.
+
+    .. py:attribute:: latency
+
+        Moving average of the response time in seconds, None until the first
+        successful query.
+
+    .. py:attribute:: errors
+
+        Number of consecutive failures.
+
+    .. py:attribute:: open_until
+
+        Monotonic time until which the node is skipped, after
+        :py:attr:`NodePool.max_errors` consecutive failures.
+    """
+    def __init__(self, endpoint, priority=0):
+        self.endpoint = endpoint
+        self.priority = priority
+        self.latency = None
+        self.errors = 0
+        self.open_until = 0
+
+    def __repr__(self):
+        return f'<NodeState {self.endpoint} errors={self.errors}>'
+
+    @property
+    def healthy(self):
+        return self.open_until <= time.monotonic()
+
+
+class NodePool:
+    """
+    Priority ordered pool of nodes with failover and circuit breaking.
+
+    :param nodes: List of (endpoint, priority) tuples.
+    :param max_errors: Number of consecutive failures after which a node is
+                       skipped.
+    :param cooldown: Number of seconds during which a failing node is skipped,
+                     after which it gets one query to prove it is back.
+    :param errors: Exception classes which mean that the node is failing, as
+                   opposed to the query being invalid. requests exceptions
+                   are OSError subclasses, see :py:meth:`is_failure()`.
+    """
+    latency_weight = .2
+
+    def __init__(self, nodes, max_errors=3, cooldown=30, errors=(OSError,)):
+        if not nodes:
+            raise Exception('Node pool needs at least one node')
+        self.nodes = [
+            NodeState(endpoint, priority)
+            for endpoint, priority in sorted(
+                nodes,
+                key=lambda node: -node[1],
+            )
+        ]
+        self.max_errors = max_errors
+        self.cooldown = cooldown
+        self.errors = errors
+        self.lock = threading.Lock()
+        self.rotation = itertools.count()
+
+    @classmethod
+    def for_blockchain(cls, blockchain, **kwargs):
+        """
+        Return a pool of the active nodes of a blockchain.
+
+        Uses the ``node_max_errors`` and ``node_cooldown`` keys of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration` if any.
+        """
+        nodes = blockchain.node_set.filter(
+            is_active=True,
+        ).order_by('-priority', 'id').values_list('endpoint', 'priority')
+        for key in ('max_errors', 'cooldown'):
+            if f'node_{key}' in blockchain.configuration:
+                kwargs.setdefault(key, blockchain.configuration[f'node_{key}'])
+        return cls([*nodes], **kwargs)
+
+    @property
+    def primary(self):
+        """
+        Return the endpoint of the healthy node with the highest priority.
+        """
+        return self.candidates()[0].endpoint
+
+    def candidates(self, spread=False):
+        """
+        Return nodes in the order they should be tried.
+
+        Healthy nodes come first by priority then latency, or in rotation if
+        spread is True, then failing nodes as a last resort.
+
+        :param spread: Rotate over healthy nodes, for read-only queries.
+        """
+        healthy = sorted(
+            [node for node in self.nodes if node.healthy],
+            key=lambda node: (-node.priority, node.latency or 0),
+        )
+        failing = sorted(
+            [node for node in self.nodes if not node.healthy],
+            key=lambda node: node.open_until,
+        )
+        if spread and len(healthy) > 1:
+            start = next(self.rotation) % len(healthy)
+            healthy = healthy[start:] + healthy[:start]
+        return healthy + failing
+
+    def success(self, node, latency):
+        """
+        Record a successful query, close the circuit of the node.
+        """
+        with self.lock:
+            node.errors = 0
+            node.open_until = 0
+            if node.latency is None:
+                node.latency = latency
+            else:
+                node.latency += self.latency_weight * (latency - node.latency)
+
+    def failure(self, node):
+        """
+        Record a failed query, open the circuit after too many failures.
+        """
+        with self.lock:
+            node.errors += 1
+            if node.errors >= self.max_errors:
+                node.open_until = time.monotonic() + self.cooldown
+
+    def is_failure(self, exception):
+        """
+        Return True if an exception means that the node is failing.
+
+        Only exceptions of :py:attr:`errors` count, and among HTTP errors
+        only connection errors, timeouts and 5xx responses: other responses
+        mean that the query is invalid, on any node.
+        """
+        if not isinstance(exception, self.errors):
+            return False
+        if isinstance(exception, urllib.error.HTTPError):
+            return exception.code >= 500
+        if isinstance(exception, requests.RequestException):
+            if isinstance(exception, (
+                requests.ConnectionError,
+                requests.Timeout,
+            )):
+                return True
+            response = exception.response
+            return (
+                isinstance(exception, requests.HTTPError)
+                and (response is None or response.status_code >= 500)
+            )
+        return True
+
+    def request(self, function, spread=False):
+        """
+        Call function with node endpoints until one does not fail.
+
+        :param function: Callable that takes an endpoint and queries it.
+        :param spread: Spread the query over healthy nodes, for read-only
+                       queries.
+        """
+        error = behind = None
+        for node in self.candidates(spread):
+            start = time.monotonic()
+            try:
+                result = function(node.endpoint)
+            except NodeBehind as exception:
+                behind = exception
+                continue
+            except Exception as exception:
+                if not self.is_failure(exception):
+                    raise
+                self.failure(node)
+                error = exception
+                continue
+            self.success(node, time.monotonic() - start)
+            return result
+
+        if not behind:
+            raise error
+        elif isinstance(behind.result, Exception):
+            raise behind.result
+        return behind.result
+
+    def check(self, probe):
+        """
+        Query every node with probe to update their health.
+
+        :param probe: Callable that takes an endpoint and queries it.
+        """
+        for node in self.nodes:
+            start = time.monotonic()
+            try:
+                probe(node.endpoint)
+            except Exception as exception:
+                if self.is_failure(exception):
+                    self.failure(node)
+            else:
+                self.success(node, time.monotonic() - start)
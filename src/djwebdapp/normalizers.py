@@ -6,6 +6,26 @@ Normalizer classes are optionnal helpers to easy contract indexation.
 class Normalizer:
     """
     Base Normalizer class.
+
+    Callbacks are methods named after the function of the call, or
+    :py:attr:`deploy_method_name` for the contract origination, which take
+    the call and the contract.
+
+    A callback may have a batch variant, suffixed with ``__batch``, which
+    takes the list of consecutive calls of a contract to that function
+    during a page of :py:meth:`~djwebdapp.provider.Provider.normalize()`,
+    so that the normalizer can aggregate them in memory and write them at
+    once. If a batch callback fails, calls are normalized one by one again.
+
+    Example::
+
+        class TokenNormalizer(Normalizer):
+            def transfer__batch(self, calls, contract):
+                # sum amounts by account, then update balances at once
+                ...
+
+    Without a callback of its own, a single call is passed to the batch
+    callback.
     """
     _registry = {}
     deploy_method_name = 'deploy'
@@ -15,16 +35,44 @@ class Normalizer:
         cls._registry[cls.__name__] = cls
 
     @classmethod
-    def normalize(cls, transaction, contract):
-        normalizer = cls()
+    def callback_name(cls, transaction):
+        """
+        Return the name of the callback for a transaction.
+        """
         if transaction.kind == 'function':
-            callback_name = transaction.function
+            return transaction.function
         elif transaction.kind == 'contract':
-            callback_name = cls.deploy_method_name
+            return cls.deploy_method_name
 
-        callback = getattr(normalizer, callback_name, None)
+    @classmethod
+    def batch_callback_name(cls, transaction):
+        """
+        Return the name of the batch callback for a transaction, if any.
+        """
+        callback_name = cls.callback_name(transaction)
+        if callback_name and hasattr(cls, f'{callback_name}__batch'):
+            return f'{callback_name}__batch'
+
+    @classmethod
+    def normalize(cls, transaction, contract):
+        normalizer = cls()
+        callback_name = cls.callback_name(transaction)
+
+        callback = getattr(normalizer, callback_name or '', None)
         if callback:
             callback(transaction, contract)
+        elif cls.batch_callback_name(transaction):
+            cls.normalize_batch([transaction], contract)
+
+    @classmethod
+    def normalize_batch(cls, transactions, contract):
+        """
+        Call the batch callback of transactions with the same
+        :py:meth:`batch_callback_name()`.
+        """
+        normalizer = cls()
+        callback_name = cls.batch_callback_name(transactions[0])
+        getattr(normalizer, callback_name)(transactions, contract)
 
     @classmethod
     def normalize_event(cls, event, contract):
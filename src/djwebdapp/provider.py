@@ -1,11 +1,34 @@
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
 from multiprocessing import get_context
+from types import MappingProxyType
+import atexit
+import datetime
+import json
 import logging
+import os
+import queue
 import random
+import threading
+import time
 
 from django import db
-from django.db.models import Q
-
-from djwebdapp.models import Event, Transaction
+from django.db import transaction as db_transaction
+from django.db.models import F, OrderBy, Q, Window, signals
+from django.db.models.functions import RowNumber
+from django.dispatch import receiver
+from django.utils import timezone
+
+from djwebdapp.models import (
+    SETTINGS,
+    Account,
+    Blockchain,
+    Event,
+    Lease,
+    Node,
+    Transaction,
+)
 
 
 def call_deploy(arg):
@@ -16,6 +39,8 @@ def call_deploy(arg):
     """
     logger, call = arg
 
+    # workers keep their connection, unless it is broken or expired
+    db.close_old_connections()
     logger.debug(f'starting {call} ...')
     try:
         call.deploy()
@@ -27,21 +52,368 @@ def call_deploy(arg):
     return call
 
 
+def call_normalize(arg):
+    """
+    Normalize a partition in a worker, see
+    :py:meth:`Provider.normalize_parallel()`.
+
+    :param arg: Tuple of (provider class, blockchain id, contract ids)
+    """
+    provider_class, blockchain_id, contracts = arg
+
+    db.close_old_connections()
+    provider = provider_class(
+        blockchain=Blockchain.objects.get(pk=blockchain_id),
+    )
+    try:
+        return provider.normalize_partition(contracts)
+    except Exception:
+        provider.logger.exception(f'failed normalizing {contracts}')
+        return False
+
+
+def get_ordering(queryset):
+    """
+    Return the ordering of a QuerySet as a list of OrderBy expressions,
+    ending with the primary key so that it is total.
+
+    Field names, ``-`` prefixed or not, as well as expressions such as
+    ``F('level').desc(nulls_last=True)`` are supported. Random ordering is
+    dropped.
+    """
+    ordering = []
+    for field in queryset.query.order_by:
+        if isinstance(field, str):
+            if field == '?':
+                continue
+            elif field.startswith('-'):
+                field = F(field[1:]).desc()
+            else:
+                field = F(field.lstrip('+')).asc()
+        elif not isinstance(field, OrderBy):
+            field = field.asc()
+        ordering.append(field)
+    return [*ordering, F('pk').asc()]
+
+
 def get_calls_distinct_sender(calls_query_set, n_calls):
     """
     Given a QS of calls, return a list of calls with distinct senders.
 
+    The first call of each sender according to the ordering of the QS is
+    selected by the database, with DISTINCT ON where supported, or with a
+    ROW_NUMBER() window otherwise, so that the backlog of calls is never
+    loaded.
+
     :param calls_query_set: Queryset of Calls
     :param n_calls: Number of calls to return
     """
-    senders = set()
-    distinct_calls = []
-    for call in calls_query_set:
-        if call.sender not in senders and len(distinct_calls) < n_calls:
-            distinct_calls.append(call)
-            senders.add(call.sender)
+    ordering = get_ordering(calls_query_set)
+    if db.connection.features.can_distinct_on_fields:
+        first_calls = calls_query_set.filter(
+            pk__in=calls_query_set.order_by(
+                'sender_id',
+                *ordering,
+            ).distinct('sender_id').values('pk'),
+        )
+    else:
+        first_calls = calls_query_set.annotate(
+            sender_row=Window(
+                RowNumber(),
+                partition_by=[F('sender_id')],
+                order_by=ordering,
+            ),
+        ).filter(sender_row=1)
+
+    return list(
+        first_calls.select_related('sender').order_by(*ordering)[:n_calls]
+    )
+
+
+class DeployPool:
+    """
+    Persistent pool of workers to deploy calls in parallel in
+    :py:meth:`Provider.spool()`, also used to normalize contracts in
+    parallel by :py:meth:`Provider.normalize_parallel()`.
+
+    Workers are started on the first :py:meth:`map()` and reused by the next
+    ones, so that each of them keeps its own database connection and its
+    own clients per wallet.
+
+    :param size: Number of workers.
+    :param kind: ``process`` for forked worker processes, or ``thread`` for
+                 worker threads.
+    """
+    kinds = ('process', 'thread')
+
+    def __init__(self, size, kind='process'):
+        if kind not in self.kinds:
+            raise Exception(f'Deploy pool kind must be in {self.kinds}')
+        self.size = size
+        self.kind = kind
+        self.pool = None
+        self.pid = None
+
+    def start(self):
+        """
+        Start the workers.
+        """
+        if self.kind == 'thread':
+            self.pool = ThreadPoolExecutor(
+                max_workers=self.size,
+                thread_name_prefix='deploy',
+            )
+        else:
+            # forked workers must not share the connections of the spooler
+            db.connections.close_all()
+            self.pool = get_context('fork').Pool(self.size)
+        self.pid = os.getpid()
+
+    def map(self, function, args):
+        """
+        Return the list of results of function for each arg, start the
+        workers if necessary.
+        """
+        if self.pool is None or self.pid != os.getpid():
+            # workers of a parent process are not ours to use
+            self.start()
+        return list(self.pool.map(function, args))
+
+    def close(self):
+        """
+        Wait for the workers to finish their current task and stop them.
+        """
+        if self.pool is None:
+            return
+        if self.pid == os.getpid():
+            if self.kind == 'thread':
+                self.pool.shutdown()
+            else:
+                self.pool.close()
+                self.pool.join()
+        self.pool = None
+
+
+deploy_pool = None
+
+
+def get_deploy_pool():
+    """
+    Return the :py:class:`DeployPool` of the process, create it if necessary.
+
+    Configured by the ``DEPLOY_POOL`` and ``DEPLOY_POOL_SIZE`` keys of the
+    ``DJBLOCKCHAIN`` setting, and closed at exit.
+    """
+    global deploy_pool
+    if deploy_pool is None:
+        deploy_pool = DeployPool(
+            SETTINGS['DEPLOY_POOL_SIZE'],
+            SETTINGS['DEPLOY_POOL'],
+        )
+        atexit.register(deploy_pool.close)
+    return deploy_pool
+
+
+class NormalizePipeline:
+    """
+    Worker thread which normalizes the transactions of indexed levels as
+    soon as they are committed, see :py:attr:`Provider.index_normalize`.
+
+    The worker has its own provider and database connection. Levels are
+    normalized in the order they were indexed, after the older un-normalized
+    transactions of their contracts, see
+    :py:meth:`Provider.normalize_transactions()`.
+
+    :param provider: Provider of the indexer.
+    :param size: Number of committed levels that may wait in the queue,
+                 :py:meth:`put()` blocks the indexer when it is full.
+    """
+    def __init__(self, provider, size):
+        self.provider_class = type(provider)
+        self.blockchain_id = provider.blockchain.pk
+        self.logger = provider.logger
+        self.queue = queue.Queue(maxsize=size)
+        self.thread = threading.Thread(
+            target=self.run,
+            name=f'normalize-{self.blockchain_id}',
+            daemon=True,
+        )
+        self.thread.start()
+
+    def put(self, ids):
+        """
+        Queue the ids of transactions to normalize, wait for a free slot.
+        """
+        self.queue.put(ids)
+
+    def run(self):
+        """
+        Normalize queued transactions until :py:meth:`close()`.
+        """
+        provider = None
+        try:
+            while (ids := self.queue.get()) is not None:
+                try:
+                    if not provider:
+                        provider = self.provider_class(
+                            blockchain=Blockchain.objects.get(
+                                pk=self.blockchain_id,
+                            ),
+                        )
+                    provider.normalize_transactions(ids)
+                except Exception:
+                    # left for the next normalize() run
+                    self.logger.exception('Failed normalizing indexed level')
+        finally:
+            db.connection.close()
+
+    def close(self):
+        """
+        Wait for the queued transactions to be normalized, stop the worker.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class ClientRegistry:
+    """
+    Per-process registry of blockchain clients.
+
+    Clients are reused by every provider instance of the same blockchain and
+    wallet. They are rebuilt when the provider class or the configuration of
+    the blockchain changes, or when the secret key of the wallet changes. They
+    are dropped when a node of the blockchain is saved or deleted, as well as
+    after a fork.
+
+    Nodes may also change in another process, such as the admin, or through
+    ``Node.objects.update()``, which do not send signals to this process.
+    The nodes of a blockchain are then compared with the database every
+    :py:attr:`nodes_ttl` seconds, see :py:meth:`generation()`.
+
+    Clients are built outside of the lock, so that building a client which
+    queries its node does not block the other threads.
+
+    .. py:attribute:: generations
+
+        Number of invalidations per blockchain id, so that providers can
+        tell if their client was dropped without taking the lock.
+
+    .. py:attribute:: nodes_ttl
+
+        Number of seconds during which the nodes of a blockchain are not
+        compared with the database again.
+    """
+    nodes_ttl = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = dict()
+        self.generations = dict()
+        self.nodes = dict()
+
+    def get(self, provider):
+        """
+        Return the client for a provider, build it if necessary.
+        """
+        blockchain = provider.blockchain
+        wallet = provider.wallet
+        if not blockchain.pk or (wallet and not wallet.pk):
+            # not saved yet, nothing to key the client on
+            return provider.get_client()
+
+        key = (blockchain.pk, wallet.pk if wallet else None)
+        version = (
+            blockchain.provider_class,
+            json.dumps(blockchain.configuration, sort_keys=True, default=str),
+            wallet.secret_key if wallet else None,
+        )
+        generation = self.generation(blockchain.pk)
+        with self.lock:
+            cached = self.clients.get(key, None)
+            if cached and cached[0] == version:
+                return cached[1]
+
+        client = provider.get_client()
+
+        with self.lock:
+            cached = self.clients.get(key, None)
+            if cached and cached[0] == version:
+                # built by another thread in the meantime
+                return cached[1]
+            if generation == self.generations.get(blockchain.pk, 0):
+                # not invalidated while building
+                self.clients[key] = (version, client)
+            return client
+
+    def generation(self, blockchain_id):
+        """
+        Return the number of invalidations of a blockchain.
+
+        The clients of the blockchain are invalidated first if its nodes
+        changed in the database since they were last checked, more than
+        :py:attr:`nodes_ttl` seconds ago.
+        """
+        checked = self.nodes.get(blockchain_id, None)
+        now = time.monotonic()
+        if not checked or now - checked[0] >= self.nodes_ttl:
+            nodes = self.nodes_fingerprint(blockchain_id)
+            if checked and checked[1] != nodes:
+                self.invalidate(blockchain_id)
+            self.nodes[blockchain_id] = (now, nodes)
+        return self.generations.get(blockchain_id, 0)
+
+    def nodes_fingerprint(self, blockchain_id):
+        """
+        Return the sorted endpoint, priority and active status of the nodes
+        of a blockchain.
+        """
+        return sorted(Node.objects.filter(
+            blockchain_id=blockchain_id,
+        ).values_list('endpoint', 'priority', 'is_active'))
 
-    return distinct_calls
+    def invalidate(self, blockchain_id):
+        """
+        Drop the clients of a blockchain.
+        """
+        with self.lock:
+            self.generations[blockchain_id] = (
+                self.generations.get(blockchain_id, 0) + 1
+            )
+            # checked again on the next generation()
+            self.nodes.pop(blockchain_id, None)
+            for key in [*self.clients.keys()]:
+                if key[0] == blockchain_id:
+                    del self.clients[key]
+
+    def reset(self):
+        """
+        Drop all clients, used after a fork.
+        """
+        # the lock may have been held by another thread of the parent
+        self.lock = threading.Lock()
+        self.clients = dict()
+        self.generations = dict()
+        self.nodes = dict()
+
+
+clients = ClientRegistry()
+os.register_at_fork(after_in_child=clients.reset)
+
+
+@receiver([signals.post_save, signals.post_delete], sender=Node)
+def node_clients_invalidate(sender, instance, **kwargs):
+    """
+    Drop the clients of the blockchain of a saved or deleted node.
+    """
+    clients.invalidate(instance.blockchain_id)
+
+
+@receiver(signals.post_delete, sender=Blockchain)
+def blockchain_clients_invalidate(sender, instance, **kwargs):
+    """
+    Drop the clients of a deleted blockchain.
+    """
+    clients.invalidate(instance.pk)
 
 
 class Provider:
@@ -94,14 +466,101 @@ class Provider:
     .. py:attribute:: exclude_states
 
         States to exclude when searching for transactions to deploy.
+
+    .. py:attribute:: head_ttl
+
+        Number of seconds during which :py:attr:`head` is served from cache,
+        can be overridden by the ``head_ttl`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration`.
+
+    .. py:attribute:: spool_batch
+
+        Maximum number of calls from distinct senders that :py:meth:`spool()`
+        deploys at once, can be overridden by the ``spool_batch`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration`.
+
+    .. py:attribute:: spool_level_gate
+
+        Let a sender deploy only once per level, for blockchains where the
+        provider cannot have several pending transactions per sender.
+
+    .. py:attribute:: deploy_update_fields
+
+        Fields that :py:meth:`deploy()` may set, saved with the state by
+        :py:meth:`~djwebdapp.models.Transaction.deploy()`.
+
+    .. py:attribute:: index_update_fields
+
+        Fields written by :py:meth:`index_flush()` for transactions which
+        were already in the database.
+
+    .. py:attribute:: index_normalize
+
+        Number of committed levels which transactions may wait for a
+        :py:class:`NormalizePipeline` during :py:meth:`index()`, 0 to
+        leave them to :py:meth:`normalize()`. Can be overridden by the
+        ``index_normalize`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration`.
+
+    .. py:attribute:: normalize_batch
+
+        Number of transactions that :py:meth:`normalize()` processes per
+        page, can be overridden by the ``normalize_batch`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration`.
+
+    .. py:attribute:: normalize_update_fields
+
+        Fields written by :py:meth:`normalize_page()` for normalized
+        transactions.
+
+    .. py:attribute:: normalize_lease
+
+        Number of seconds a worker of :py:meth:`normalize_parallel()` holds
+        a contract for, renewed after each page.
+
+    .. py:attribute:: normalize_backoff
+
+        Number of seconds to wait before normalizing a failed transaction
+        again, doubled after each failure, can be overridden by the
+        ``normalize_backoff`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration`.
+
+    .. py:attribute:: normalize_max_fails
+
+        Number of normalization failures after which a transaction is not
+        retried until :py:meth:`normalize_requeue()`, can be overridden by
+        the ``normalize_max_fails`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration`.
     """
     exclude_states = (
         'held', 'aborted', 'import', 'importing', 'confirm', 'done'
     )
+    head_ttl = 1
+    spool_batch = 15
+    spool_level_gate = True
+    deploy_update_fields = (
+        'level', 'hash', 'address', 'counter', 'nonce', 'gas',
+    )
+    index_update_fields = (
+        'level', 'hash', 'address', 'counter', 'nonce', 'number', 'gas',
+        'amount', 'function', 'args', 'metadata', 'sender', 'state',
+        'history', 'updated_at', 'code', 'has_code',
+    )
+    index_normalize = 0
+    normalize_batch = 100
+    normalize_update_fields = (
+        'normalized', 'error', 'last_fail', 'normalize_fails',
+        'normalize_after', 'updated_at',
+    )
+    normalize_lease = 300
+    normalize_backoff = 60
+    normalize_max_fails = 10
 
     def __init__(self, blockchain=None, wallet=None):
         self.wallet = wallet
         self.blockchain = wallet.blockchain if wallet else blockchain
+        self._head = None
+        self._head_time = None
 
     def generate_secret_key(self):
         """
@@ -111,14 +570,38 @@ class Provider:
         """
         raise NotImplementedError()
 
+    def get_head(self):
+        """
+        Query the blockchain and return the current block number.
+
+        Raises NotImplemented in base Provider class.
+        """
+        raise NotImplementedError()
+
     @property
     def head(self):
         """
         Return the current block number.
 
-        Raises NotImplemented in base Provider class.
+        Served from cache until :py:attr:`head_ttl` expires, use
+        :py:meth:`head_refresh()` to force a query.
         """
-        raise NotImplementedError()
+        ttl = self.blockchain.configuration.get('head_ttl', self.head_ttl)
+        if (
+            self._head is None
+            or time.monotonic() - self._head_time >= ttl
+        ):
+            self.head_refresh()
+        return self._head
+
+    def head_refresh(self):
+        """
+        Query the current block number with :py:meth:`get_head()`, cache it
+        for :py:attr:`head` and return it.
+        """
+        self._head = self.get_head()
+        self._head_time = time.monotonic()
+        return self._head
 
     def download(self, target: str):
         """
@@ -132,10 +615,24 @@ class Provider:
         """
         raise NotImplementedError()
 
-    def index_level(self, level: int):
+    def get_block(self, level: int):
+        """
+        Fetch the block data that :py:meth:`index_level()` needs.
+
+        This is the network part of indexing a level, it must not touch the
+        database so that :py:meth:`blocks()` can call it from threads.
+
+        Left to implement in new provider subclasses.
+        """
+        raise NotImplementedError()
+
+    def index_level(self, level: int, block=None):
         """
         Index a given block level.
 
+        :param block: Result of :py:meth:`get_block()` for this level, if
+                      already fetched.
+
         Left to implement in new provider subclasses.
         """
         raise NotImplementedError()
@@ -153,13 +650,22 @@ class Provider:
     @property
     def client(self):
         """
-        Cached result of :py:meth:`get_client()`
+        Cached result of :py:meth:`get_client()`, shared with the other
+        providers of the same blockchain and wallet in this process through
+        :py:class:`ClientRegistry`.
+
+        The client is then kept by the provider instance until the nodes of
+        the blockchain change, see :py:meth:`ClientRegistry.generation()`,
+        get a new provider to apply a configuration change.
         """
         cached = getattr(self, '_client', None)
         if cached:
             return cached
-        self._client = self.get_client()
-        return self._client
+        registered = getattr(self, '_registered', None)
+        generation = clients.generation(self.blockchain.pk)
+        if not registered or registered[0] != generation:
+            registered = self._registered = (generation, clients.get(self))
+        return registered[1]
 
     @client.setter
     def client(self, value):
@@ -170,15 +676,31 @@ class Provider:
         Query the database for transactions hashes and contract addresses to
         index in :py:meth:`index()`
 
-        Provisions
+        Provisions read-only lookup tables, built once per indexing run so
+        that matching a block operation costs a single dict lookup rather
+        than a scan of every pending hash or indexed address:
+
+        - :py:attr:`hashes`: mapping of transaction hash to level, for
+          transactions which are awaiting indexation,
+        - :py:attr:`contracts`: QuerySet of contracts to index,
+        - :py:attr:`addresses`: mapping of contract address to contract id.
+
+        Also resets the :py:meth:`get_account()` cache and the
+        :py:meth:`index_save()` queues.
         """
-        self.hashes = list(self.transaction_class.objects.filter(
-            blockchain=self.blockchain
-        ).filter(
-            Q(state='confirm') | ~Q(hash=None)
-        ).exclude(
-            state='done'
-        ).values_list('hash', 'level'))
+        self.accounts = dict()
+        self.indexed_ids = []
+        self.index_updates = dict()
+
+        self.hashes = MappingProxyType(dict(
+            self.transaction_class.objects.filter(
+                blockchain=self.blockchain
+            ).filter(
+                Q(state='confirm') | ~Q(hash=None)
+            ).exclude(
+                state='done'
+            ).values_list('hash', 'level')
+        ))
 
         self.logger.info(f'Found {len(self.hashes)} transactions to index')
 
@@ -191,17 +713,137 @@ class Provider:
         )
         print(f'Found {len(self.contracts)} contracts to index')
 
-        self.addresses = self.contracts.values_list(
-            'address',
-            flat=True,
-        )
+        self.addresses = self.get_addresses(self.contracts)
         self.logger.info(f'Found {len(self.addresses)} addresses to index')
 
+    def get_addresses(self, contracts):
+        """
+        Return a read-only mapping of address to id for a contract QuerySet.
+        """
+        return MappingProxyType(dict(
+            contracts.values_list('address', 'id')
+        ))
+
     def check_hash(self, hash_to_check):
         """
         Returns True if hash is in self.hashes
         """
-        return any(hash_to_check == hash for hash, _ in self.hashes)
+        return hash_to_check in self.hashes
+
+    def get_account(self, address, index=False):
+        """
+        Return the :py:class:`~djwebdapp.models.Account` of an address,
+        create it if necessary.
+
+        Accounts are cached for the indexing run.
+
+        :param address: Address of the account.
+        :param index: Index value for the account if it is created.
+        """
+        if address in self.accounts:
+            return self.accounts[address]
+
+        account = Account.objects.filter(
+            address=address,
+            blockchain=self.blockchain,
+        ).first()
+
+        if not account:
+            account = Account.objects.create(
+                address=address,
+                blockchain=self.blockchain,
+                index=index,
+            )
+
+        self.accounts[address] = account
+        return account
+
+    def index_save(self, transaction, state='done'):
+        """
+        Set the state of an indexed transaction and persist it.
+
+        Transactions that are not in the database yet are inserted right
+        away, as internal calls reference their caller, and so are the ones
+        which code changed, as the code is stored on save. Others are queued
+        for :py:meth:`index_flush()`.
+
+        Their ids are also queued for :py:meth:`index_commit()`.
+        """
+        if transaction._state.adding or transaction.code_changed:
+            transaction.state_set(
+                state,
+                provider=self,
+                update_fields=self.index_update_fields,
+            )
+        else:
+            transaction.state_set(state, commit=False, provider=self)
+            self.index_updates[transaction.pk] = transaction
+        self.indexed_ids.append(transaction.pk)
+
+    def index_flush(self):
+        """
+        Write the :py:attr:`index_update_fields` of the transactions queued
+        by :py:meth:`index_save()` with one bulk_update.
+
+        The pre_save and post_save signals are sent for each of them with
+        those update_fields, like save() would.
+        """
+        updates = [*self.index_updates.values()]
+        self.index_updates = dict()
+        if not updates:
+            return
+
+        update_fields = frozenset(self.index_update_fields)
+        using = db.router.db_for_write(Transaction)
+        now = timezone.now()
+        for transaction in updates:
+            transaction.updated_at = now
+            signals.pre_save.send(
+                sender=type(transaction),
+                instance=transaction,
+                raw=False,
+                using=using,
+                update_fields=update_fields,
+            )
+        # fields are all on the parent table
+        Transaction.objects.using(using).bulk_update(
+            updates,
+            self.index_update_fields,
+        )
+        for transaction in updates:
+            signals.post_save.send(
+                sender=type(transaction),
+                instance=transaction,
+                created=False,
+                raw=False,
+                using=using,
+                update_fields=update_fields,
+            )
+
+    def index_pipeline(self):
+        """
+        Return a started :py:class:`NormalizePipeline` if
+        :py:attr:`index_normalize` is set, None otherwise.
+        """
+        size = self.blockchain.configuration.get(
+            'index_normalize',
+            self.index_normalize,
+        )
+        if size:
+            return NormalizePipeline(self, size)
+
+    def index_commit(self, pipeline):
+        """
+        Write the queued updates with :py:meth:`index_flush()`, then pass
+        the transactions indexed since the last call to the pipeline, once
+        the current database transaction commits.
+
+        :param pipeline: Result of :py:meth:`index_pipeline()`.
+        """
+        self.index_flush()
+        ids, self.indexed_ids = self.indexed_ids, []
+        if pipeline and ids:
+            db_transaction.on_commit(lambda: pipeline.put(ids))
 
     def deploy(self, transaction):
         """
@@ -221,7 +863,7 @@ class Provider:
         greater than or equal to the current head level, and set their state to
         `deleted`.
         """
-        current_level = self.head
+        current_level = self.head_refresh()
         reorg = (
             self.blockchain.index_level
             and current_level < self.blockchain.index_level
@@ -245,6 +887,55 @@ class Provider:
             self.blockchain.save()
             return True  # commit to reorg in a transaction
 
+    def blocks(self, level):
+        """
+        Yield (level, block) tuples from a level up to the head level.
+
+        Levels are always yielded in order. By default, block is None and
+        left for :py:meth:`index_level()` to fetch.
+
+        The head level is only queried again once the last known head level
+        has been reached.
+
+        If the ``index_prefetch`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration` is above 1, up to
+        that number of upcoming blocks are fetched concurrently with
+        :py:meth:`get_block()` in a thread pool, so that catching up does not
+        cost a full network round trip per level.
+
+        :param level: First level to yield.
+        """
+        window = self.blockchain.configuration.get('index_prefetch', 0)
+        head = self.head
+        if window <= 1:
+            while True:
+                if level > head:
+                    head = self.head_refresh()
+                if level > head:
+                    return
+                yield level, None
+                level += 1
+
+        executor = ThreadPoolExecutor(max_workers=window)
+        futures = deque()
+        try:
+            while True:
+                if level > head:
+                    head = self.head_refresh()
+                while len(futures) < window and level <= head:
+                    futures.append(
+                        (level, executor.submit(self.get_block, level))
+                    )
+                    level += 1
+                if not futures:
+                    return
+                block_level, future = futures.popleft()
+                yield block_level, future.result()
+        finally:
+            for _, future in futures:
+                future.cancel()
+            executor.shutdown()
+
     def index(self):
         """
         Index the blockchain.
@@ -253,7 +944,18 @@ class Provider:
 
         Iterate over each level from the last indexed level in the
         :py:attr:`djwebdapp.models.Blockchain.index_level` column (or 0) up to
-        the current head level. Call :py:meth:`index_level()` for each level.
+        the current head level. Call :py:meth:`index_level()` for each level
+        yielded by :py:meth:`blocks()`.
+
+        Each level is written in a single database transaction, together with
+        the new :py:attr:`djwebdapp.models.Blockchain.index_level`, so that an
+        interrupted run resumes from the last committed level. Set the
+        ``index_atomic_levels`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration` to commit
+        groups of levels instead.
+
+        Committed transactions are normalized right away by a
+        :py:class:`NormalizePipeline` if :py:attr:`index_normalize` is set.
         """
         if self.reorg():
             return  # commit to reorg in a transaction
@@ -272,13 +974,44 @@ class Provider:
             else:
                 level = self.blockchain.index_level = 0
 
-        while level <= self.head:
-            self.logger.info(f'Indexing level {level}')
-            self.index_level(level)
-            self.blockchain.index_level = level
-            level += 1
+        atomic_levels = self.blockchain.configuration.get(
+            'index_atomic_levels',
+            1,
+        )
+        blocks = self.blocks(level)
+        pipeline = self.index_pipeline()
+        try:
+            while group := list(islice(blocks, atomic_levels)):
+                with db_transaction.atomic():
+                    for level, block in group:
+                        self.logger.info(f'Indexing level {level}')
+                        self.index_level(level, block)
+                        self.blockchain.index_level = level
+                    self.blockchain.save()
+                    self.index_commit(pipeline)
+        finally:
+            blocks.close()
+            if pipeline:
+                pipeline.close()
         self.blockchain.save()
 
+    def spool_senders(self, null=True):
+        """
+        Return the filter on the senders of transactions to deploy.
+
+        Senders which have deployed during this level according to
+        :py:attr:`head` and :py:attr:`djwebdapp.models.Account.last_level`
+        are excluded, unless :py:attr:`spool_level_gate` is False.
+
+        :param null: Accept senders which have never deployed.
+        """
+        if not self.spool_level_gate:
+            return Q()
+        senders = Q(sender__last_level__lt=self.head)
+        if null:
+            senders |= Q(sender__last_level=None)
+        return senders
+
     def spool_contracts(self):
         """
         Return the contracts to deploy, used by :py:meth:`~spool()`.
@@ -311,14 +1044,16 @@ class Provider:
             Q(address='')
             | Q(address=None)
         ).filter(
-            Q(sender__last_level__lt=self.head)
-            | Q(sender__last_level=None)
+            self.spool_senders()
         ).exclude(
             Q(sender__balance=None)
             | Q(sender__balance=0)
             | Q(state__in=self.exclude_states)
         ).select_related(
-            'blockchain'
+            'blockchain',
+            'code',
+        ).defer(
+            'metadata'
         ).order_by(
             'created_at'
         ).select_subclasses()
@@ -349,8 +1084,7 @@ class Provider:
             hash=None,
             sender__blockchain__is_active=True,
         ).filter(
-            Q(sender__last_level__lt=self.head)
-            | Q(sender__last_level__isnull=True)
+            self.spool_senders()
         ).exclude(
             Q(sender__balance=None)
             | Q(sender__balance=0)
@@ -359,6 +1093,8 @@ class Provider:
             | Q(contract__address__isnull=True)
         ).select_related(
             'blockchain'
+        ).defer(
+            'metadata'
         ).order_by(
             'created_at'
         ).select_subclasses()
@@ -386,13 +1122,16 @@ class Provider:
             kind='transfer',
             hash=None,
             sender__blockchain__is_active=True,
-            sender__last_level__lt=self.head,
+        ).filter(
+            self.spool_senders(null=False)
         ).exclude(
             Q(sender__balance=None)
             | Q(sender__balance=0)
             | Q(state__in=self.exclude_states)
         ).select_related(
             'blockchain'
+        ).defer(
+            'metadata'
         ).order_by(
             'created_at'
         )
@@ -406,7 +1145,16 @@ class Provider:
         - :py:meth:`~spool_transfers()`: is there any new transfer to deploy?
         - :py:meth:`~spool_contracts()`: is there any *new* contract to deploy
           from an account with balance?
+
+        The head level is queried once at the start of the pass and shared by
+        every query of the pass.
+
+        Calls from distinct senders are deployed in parallel by the
+        :py:class:`DeployPool` of the process, see
+        :py:func:`get_deploy_pool()`.
         """
+        self.head_refresh()
+
         # senders which have already deployed during this block must be
         # excluded
         # is there any new transfer to deploy from an account with balance?
@@ -428,19 +1176,19 @@ class Provider:
             return contract
         self.logger.info('Found 0 contracts to deploy')
 
-        n_calls = 15
+        n_calls = self.blockchain.configuration.get(
+            'spool_batch',
+            self.spool_batch,
+        )
         calls = self.spool_calls().filter(last_fail=None)
         distinct_calls = get_calls_distinct_sender(calls, n_calls)
 
         if distinct_calls:
-            db.connections.close_all()
-            pool = get_context("fork").Pool(n_calls)
-            results = pool.map(
+            # calls save their own fields in Transaction.deploy()
+            get_deploy_pool().map(
                 call_deploy,
-                [(self.logger, call) for call in list(distinct_calls)]
+                [(self.logger, call) for call in distinct_calls]
             )
-            for result in results:
-                result.save()
 
             if len(distinct_calls) == 1:
                 return distinct_calls[0]
@@ -472,44 +1220,434 @@ class Provider:
             return call
         self.logger.info('Found 0 call to retry')
 
-    def normalize(self):
+    def normalize_queryset(self):
+        """
+        Return the transactions to normalize, except internal ones which
+        are normalized with their caller.
+
+        These are the new transactions, and the failed ones which back-off
+        delay has passed, both found with a partial index so that failing
+        transactions do not slow down normalization.
+        """
+        return self.transaction_class.objects.filter(
+            Q(normalize_fails=0)
+            | Q(normalize_after__lte=timezone.now()),
+            blockchain=self.blockchain,
+            normalized=False,
+            caller=None,
+            state='done',
+        )
+
+    def normalize_retry_after(self, fails):
+        """
+        Return the datetime after which to normalize a transaction which
+        failed a number of times, None if it should not be retried.
+
+        :param fails: Number of consecutive failures.
+        """
+        configuration = self.blockchain.configuration
+        max_fails = configuration.get(
+            'normalize_max_fails',
+            self.normalize_max_fails,
+        )
+        if fails >= max_fails:
+            self.logger.warning(f'Giving up normalization after {fails} fails')
+            return None
+        backoff = configuration.get(
+            'normalize_backoff',
+            self.normalize_backoff,
+        )
+        return timezone.now() + datetime.timedelta(
+            seconds=backoff * 2 ** (fails - 1),
+        )
+
+    def normalize_requeue(self):
+        """
+        Requeue the transactions which failed normalization too many times,
+        return their number.
+        """
+        return Transaction.objects.filter(
+            blockchain=self.blockchain,
+            normalized=False,
+            normalize_fails__gt=0,
+            normalize_after=None,
+        ).update(
+            normalize_fails=0,
+            updated_at=timezone.now(),
+        )
+
+    def normalize(self, contracts=None, leases=None, ids=None):
         """
         Run `normalize()` on all un-normalized transactions.
 
-        Call
-        :py:meth:`~djwebdapp.models.Transaction.normalize()`
-        on each transaction that has not been normalized.
+        Transactions are processed by pages of :py:attr:`normalize_batch`
+        in :py:meth:`normalize_page()`, in order of creation.
+
+        Failed transactions are retried once their back-off delay has passed,
+        see :py:meth:`normalize_retry_after()`.
 
         Internal transactions are normalized after their caller is normalized.
+
+        :param contracts: Ids of contracts, to only normalize them and their
+                          calls, see :py:meth:`normalize_partitions()`.
+        :param leases: Dict of contract id to
+                       :py:class:`~djwebdapp.models.Lease`, renewed before
+                       each page, normalization stops if one was lost. Leases
+                       of the other contracts that a page reaches are added,
+                       see :py:meth:`normalize_reach()`.
+        :param ids: Ids of transactions, to only normalize them, see
+                    :py:meth:`normalize_transactions()`.
         """
-        def normalize_internal(transaction):
-            if not transaction.normalized:
-                return
+        n_transactions = self.blockchain.configuration.get(
+            'normalize_batch',
+            self.normalize_batch,
+        )
+        transactions = self.normalize_queryset().order_by(
+            'created_at',
+            'pk',
+        )
+        if contracts:
+            transactions = transactions.filter(
+                Q(pk__in=contracts, kind='contract')
+                | Q(contract__in=contracts)
+            )
+        if ids is not None:
+            transactions = transactions.filter(pk__in=ids)
+
+        page = [*transactions[:n_transactions]]
+        while page:
+            if leases is not None:
+                reached = self.normalize_reach(page, leases)
+                if reached != page:
+                    # the next transaction waits for the next pass, so that
+                    # the order of the contracts it reaches is kept
+                    if reached:
+                        self.normalize_page(reached)
+                    return
+            self.normalize_page(page)
+            if leases:
+                lost = [
+                    lease for lease in leases.values()
+                    if not lease.renew(self.normalize_lease)
+                ]
+                if lost:
+                    self.logger.warning(f'Lost {lost[0]}, stopping')
+                    return
+            # transactions which failed are still un-normalized, continue
+            # after the last one of the page
+            last = page[-1]
+            page = [*transactions.filter(
+                Q(created_at__gt=last.created_at)
+                | Q(created_at=last.created_at, pk__gt=last.pk)
+            )[:n_transactions]]
+
+    def normalize_transactions(self, ids):
+        """
+        Normalize transactions by id, used by :py:class:`NormalizePipeline`
+        for the transactions of indexed levels.
+
+        Transactions are normalized directly, unless their contract has
+        older un-normalized transactions, such as retries which back-off
+        delay has passed: the history of that contract is then normalized
+        instead, so that it is normalized in order. Contracts are leased
+        like in :py:meth:`normalize_partition()`, if another worker holds
+        one of them then it normalizes them instead.
+
+        :param ids: Ids of the transactions, internal ones are normalized
+                    with their caller.
+        """
+        transactions = self.normalize_queryset().filter(pk__in=ids)
+        contracts = {
+            *transactions.filter(
+                kind='contract',
+            ).values_list('pk', flat=True),
+            *transactions.exclude(
+                contract=None,
+            ).values_list('contract_id', flat=True).distinct(),
+        }
+        if not contracts:
+            return
+
+        older = self.normalize_queryset().exclude(pk__in=ids)
+        behind = {
+            *older.filter(
+                pk__in=contracts,
+                kind='contract',
+            ).values_list('pk', flat=True),
+            *older.filter(
+                contract__in=contracts,
+            ).values_list('contract_id', flat=True).distinct(),
+        }
+        if behind:
+            self.normalize_partition(sorted(behind))
+        if contracts - behind:
+            self.normalize_partition(sorted(contracts - behind), ids=ids)
+
+    def normalize_partitions(self):
+        """
+        Return the partitions of the contracts with un-normalized
+        transactions, as sorted lists of contract ids.
+
+        Transactions of distinct partitions may be normalized in parallel,
+        as order only matters within the history of a contract. Internal
+        calls are normalized with their caller, so a contract shares its
+        partition with the contracts that its internal calls reach, see
+        :py:meth:`normalize_links()`.
+        """
+        transactions = self.normalize_queryset()
+        partitions = {
+            contract: {contract}
+            for contract in chain(
+                transactions.filter(
+                    kind='contract',
+                ).values_list('pk', flat=True),
+                transactions.exclude(
+                    contract=None,
+                ).values_list('contract_id', flat=True).distinct(),
+            )
+        }
+        for caller, callee, transaction in self.normalize_links(
+            transactions,
+        ):
+            merged = partitions.setdefault(caller, {caller})
+            merged |= partitions.setdefault(callee, {callee})
+            for contract in merged:
+                partitions[contract] = merged
+        return sorted(
+            sorted(partition)
+            for partition in {
+                min(partition): partition
+                for partition in partitions.values()
+            }.values()
+        )
 
-            internal_calls_qs = transaction._internal_calls.order_by("nonce")
-            for internal in internal_calls_qs.all():
-                internal.normalize()
+    def normalize_links(self, callers):
+        """
+        Return the (caller contract id, callee contract id, caller id)
+        tuples of the internal calls of transactions that reach another
+        contract.
 
-        def normalize_event(event):
-            if event.normalized:
-                return
+        :param callers: Transactions, or their ids.
+        """
+        links = []
+        for values in self.transaction_class.objects.filter(
+            caller__in=callers,
+        ).values_list(
+            'caller__kind', 'caller_id', 'caller__contract_id',
+            'kind', 'pk', 'contract_id',
+        ).order_by('nonce'):
+            caller = values[1] if values[0] == 'contract' else values[2]
+            callee = values[4] if values[3] == 'contract' else values[5]
+            if caller and callee and caller != callee:
+                links.append((caller, callee, values[1]))
+        return links
+
+    def normalize_reach(self, page, leases):
+        """
+        Return the transactions of a page up to the first one that reaches,
+        with its internal calls, a contract leased by another worker.
+
+        Leases of the other contracts reached by the returned transactions
+        are acquired and added to leases, as contracts may be linked after
+        :py:meth:`normalize_partitions()`.
+
+        :param leases: Dict of contract id to
+                       :py:class:`~djwebdapp.models.Lease`.
+        """
+        reached = defaultdict(set)
+        for caller, callee, transaction in self.normalize_links(
+            [transaction.pk for transaction in page],
+        ):
+            reached[transaction].add(callee)
+
+        for index, transaction in enumerate(page):
+            for contract in sorted(reached[transaction.pk] - {*leases}):
+                lease = Lease.acquire(
+                    f'normalize:{contract}',
+                    self.normalize_lease,
+                )
+                if not lease:
+                    self.logger.info(
+                        f'Contract {contract} is leased, stopping before'
+                        f' {transaction}'
+                    )
+                    return page[:index]
+                leases[contract] = lease
+        return page
+
+    def normalize_partition(self, contracts, ids=None):
+        """
+        Normalize a partition of contracts and their calls, unless another
+        worker holds the lease on one of them. Return True if it was
+        normalized.
+
+        :param contracts: Ids of the contracts, see
+                          :py:meth:`normalize_partitions()`.
+        :param ids: Ids of transactions, to only normalize them, see
+                    :py:meth:`normalize_transactions()`.
+        """
+        leases = dict()
+        try:
+            for contract in contracts:
+                lease = Lease.acquire(
+                    f'normalize:{contract}',
+                    self.normalize_lease,
+                )
+                if not lease:
+                    self.logger.info(
+                        f'Contract {contract} is leased, skipping'
+                    )
+                    return False
+                leases[contract] = lease
+            self.normalize(contracts=contracts, leases=leases, ids=ids)
+        finally:
+            for lease in leases.values():
+                lease.release()
+        return True
+
+    def normalize_parallel(self, size=None, kind='process'):
+        """
+        Normalize every partition of :py:meth:`normalize_partitions()` with
+        a pool of workers, return the number of partitions normalized.
 
-            event.normalize()
+        Several processes, or hosts, can run this at the same time, as
+        contracts are leased to one worker at a time.
 
-        transactions = self.transaction_class.objects.filter(
+        :param size: Number of workers, number of CPUs by default.
+        :param kind: Kind of :py:class:`DeployPool` workers.
+        """
+        pool = DeployPool(size or os.cpu_count(), kind)
+        try:
+            results = pool.map(call_normalize, [
+                (type(self), self.blockchain.pk, contracts)
+                for contracts in self.normalize_partitions()
+            ])
+        finally:
+            pool.close()
+        return sum(results)
+
+    def normalize_page(self, page):
+        """
+        Normalize a page of transactions, their internal calls and events.
+
+        Contract subclasses, internal calls and event subclasses of the page
+        are queried at once, then normalizer callbacks are dispatched in the
+        same order as one by one, and the normalized flags of the page are
+        saved with a bulk_update.
+
+        Consecutive calls of a contract which normalizer has a batch
+        callback for them are passed together to
+        :py:meth:`~djwebdapp.normalizers.Normalizer.normalize_batch()`, see
+        :py:class:`~djwebdapp.normalizers.Normalizer`.
+
+        The page is normalized in a database transaction, so that a crash
+        does not leave normalized data without its flag.
+        """
+        ids = [transaction.pk for transaction in page]
+
+        internal_calls = defaultdict(list)
+        for internal in self.transaction_class.objects.filter(
+            caller__in=ids,
+        ).order_by('nonce'):
+            internal_calls[internal.caller_id].append(internal)
+
+        events = defaultdict(list)
+        transactions = {transaction.pk: transaction for transaction in page}
+        for event in Event.objects.filter(
+            transaction__in=ids,
             normalized=False,
-            caller=None,
-            state='done',
-        ).order_by(
-            'created_at',
-        )
+        ).order_by('pk').select_subclasses():
+            # set the relation from the page to spare a query
+            event.transaction = transactions[event.transaction_id]
+            events[event.transaction_id].append(event)
+
+        contract_ids = {
+            obj.contract_subclass_id()
+            for obj in chain(
+                page,
+                *internal_calls.values(),
+                *events.values(),
+            )
+        }
+        contracts = {
+            contract.pk: contract
+            for contract in Transaction.objects.filter(
+                pk__in=contract_ids - {None},
+            ).select_subclasses()
+        }
+
+        normalized_transactions = []
+        normalized_events = []
+        run = []
+
+        def flush():
+            # calls of a run share their contract and batch callback
+            if not run:
+                return
+            contract = contracts[run[0].contract_subclass_id()]
+            try:
+                with db_transaction.atomic():
+                    contract.normalizer_get().normalize_batch(run, contract)
+            except Exception:
+                self.logger.exception(
+                    'Exception in batch normalization, retrying one by one'
+                )
+                for transaction in run:
+                    transaction.normalize(contract, commit=False)
+            else:
+                for transaction in run:
+                    transaction.normalize_success()
+            normalized_transactions.extend(run)
+            run.clear()
+
+        def batch_key(transaction):
+            contract = contracts.get(transaction.contract_subclass_id())
+            normalizer = contract.normalizer_get() if contract else None
+            if normalizer:
+                batch = normalizer.batch_callback_name(transaction)
+                if batch:
+                    return (contract.pk, batch)
+
+        def dispatch(transaction):
+            key = batch_key(transaction)
+            if run and key != batch_key(run[0]):
+                flush()
+            if key:
+                run.append(transaction)
+                return
 
-        for transaction in transactions:
-            transaction.normalize()
-            normalize_internal(transaction)
-            for event in transaction.transactionevent_set.all():
-                event_subclass = Event.objects.get_subclass(pk=event.pk)
-                normalize_event(event_subclass)
+            contract = contracts.get(transaction.contract_subclass_id())
+            if contract and transaction.normalize(contract, commit=False):
+                normalized_transactions.append(transaction)
+
+        with db_transaction.atomic():
+            for transaction in page:
+                dispatch(transaction)
+
+                if internal_calls[transaction.pk]:
+                    # internal calls wait for their caller to be normalized
+                    flush()
+                    if transaction.normalized:
+                        for internal in internal_calls[transaction.pk]:
+                            dispatch(internal)
+
+                if events[transaction.pk]:
+                    flush()
+                for event in events[transaction.pk]:
+                    contract = contracts.get(event.contract_subclass_id())
+                    if contract and event.normalize(contract, commit=False):
+                        normalized_events.append(event)
+            flush()
+
+            now = timezone.now()
+            for transaction in normalized_transactions:
+                transaction.updated_at = now
+            # fields are all on the parent table
+            Transaction.objects.bulk_update(
+                normalized_transactions,
+                self.normalize_update_fields,
+            )
+            Event.objects.bulk_update(normalized_events, ['normalized'])
 
     def get_balance(self, address=None):
         """
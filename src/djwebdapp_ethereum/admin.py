@@ -1,3 +1,4 @@
+from django import forms
 from django.contrib import admin
 
 from djwebdapp.admin import TransactionAdmin
@@ -5,6 +6,40 @@ from djwebdapp.admin import TransactionAdmin
 from .models import EthereumTransaction
 
 
+class EthereumTransactionForm(forms.ModelForm):
+    """
+    Edit :py:attr:`~djwebdapp_ethereum.models.EthereumTransaction.abi` and
+    :py:attr:`~djwebdapp_ethereum.models.EthereumTransaction.bytecode`,
+    which are stored in :py:class:`~djwebdapp.models.Code` and not model
+    fields.
+    """
+    abi = forms.JSONField(
+        required=False,
+        help_text='Smart contract ABI, if this is a smart contract',
+    )
+    bytecode = forms.CharField(
+        required=False,
+        widget=forms.Textarea,
+        help_text='Contract bytecode if this is a smart contract to deploy',
+    )
+
+    class Meta:
+        model = EthereumTransaction
+        fields = '__all__'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.initial.setdefault('abi', self.instance.abi)
+            self.initial.setdefault('bytecode', self.instance.bytecode)
+
+    def save(self, commit=True):
+        for name in ('abi', 'bytecode'):
+            if name in self.changed_data:
+                setattr(self.instance, name, self.cleaned_data[name])
+        return super().save(commit=commit)
+
+
 @admin.register(EthereumTransaction)
 class EthereumTransactionAdmin(TransactionAdmin):
-    pass
+    form = EthereumTransactionForm
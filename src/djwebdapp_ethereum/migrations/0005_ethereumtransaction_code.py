@@ -0,0 +1,75 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:42
+
+import hashlib
+import json
+
+from django.db import migrations
+
+
+def code_hash(code):
+    # frozen copy of djwebdapp.models.code_hash
+    return hashlib.sha256(
+        json.dumps(code, sort_keys=True, separators=(',', ':')).encode()
+    ).hexdigest()
+
+
+def abi_to_code(apps, schema_editor):
+    Code = apps.get_model('djwebdapp', 'Code')
+    Transaction = apps.get_model('djwebdapp', 'Transaction')
+    EthereumTransaction = apps.get_model(
+        'djwebdapp_ethereum',
+        'EthereumTransaction',
+    )
+    contracts = EthereumTransaction.objects.values_list(
+        'pk',
+        'abi',
+        'bytecode',
+    )
+    for pk, abi, bytecode in contracts.iterator():
+        data = {
+            key: value
+            for key, value in dict(abi=abi, bytecode=bytecode).items()
+            if value
+        }
+        if not data:
+            continue
+        code, _ = Code.objects.get_or_create(
+            hash=code_hash(data),
+            defaults=dict(code=data),
+        )
+        Transaction.objects.filter(pk=pk).update(code=code)
+
+
+def code_to_abi(apps, schema_editor):
+    EthereumTransaction = apps.get_model(
+        'djwebdapp_ethereum',
+        'EthereumTransaction',
+    )
+    contracts = EthereumTransaction.objects.exclude(
+        code=None,
+    ).select_related('code')
+    for contract in contracts.iterator():
+        EthereumTransaction.objects.filter(pk=contract.pk).update(
+            abi=contract.code.code.get('abi', None),
+            bytecode=contract.code.code.get('bytecode', None),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djwebdapp', '0019_code'),
+        ('djwebdapp_ethereum', '0004_ethereumevent'),
+    ]
+
+    operations = [
+        migrations.RunPython(abi_to_code, code_to_abi),
+        migrations.RemoveField(
+            model_name='ethereumtransaction',
+            name='abi',
+        ),
+        migrations.RemoveField(
+            model_name='ethereumtransaction',
+            name='bytecode',
+        ),
+    ]
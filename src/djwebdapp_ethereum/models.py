@@ -15,6 +15,8 @@ class EthereumTransaction(Transaction):
     .. py:attribute:: bytecode
 
         Smart contract bytecode.
+
+    Both are stored together in :py:attr:`~djwebdapp.models.Transaction.code`.
     """
     contract = models.ForeignKey(
         'self',
@@ -30,42 +32,51 @@ class EthereumTransaction(Transaction):
         null=True,
         related_name='_internal_calls',
     )
-    abi = models.JSONField(
-        default=dict,
-        blank=True,
-        null=True,
-        help_text='Smart contract ABI, if this is a smart contract',
-    )
     input = models.TextField(
         blank=True,
         null=True,
         help_text='Input hex string if any',
     )
-    bytecode = models.TextField(
-        blank=True,
-        null=True,
-        help_text='Contract bytecode if this is a smart contract to deploy',
-    )
 
     def save(self, *args, **kwargs):
         """
         Sets :py:attr:`~djwebdapp.models.Transaction.has_code` if
         :py:attr:`bytecode` is set.
         """
-        if self.bytecode and self.abi:
+        if self.code_changed and self.bytecode and self.abi:
             self.has_code = True
         return super().save(*args, **kwargs)
 
+    @property
+    def abi(self):
+        return (self.code_get() or {}).get('abi', None)
+
+    @abi.setter
+    def abi(self, abi):
+        self.code_update(abi=abi)
+
+    @property
+    def bytecode(self):
+        return (self.code_get() or {}).get('bytecode', None)
+
+    @bytecode.setter
+    def bytecode(self, bytecode):
+        self.code_update(bytecode=bytecode)
+
+    def code_update(self, **code):
+        """
+        Update the ``abi`` and ``bytecode`` keys of the code.
+        """
+        code = {**(self.code_get() or {}), **code}
+        self.code_set({key: value for key, value in code.items() if value})
+
     @property
     def receipt(self):
         return self.provider.client.eth.get_transaction_receipt(self.hash)
 
     @property
     def contract_ci(self):
-        return self.provider.client.eth.contract(
-            address=self.contract.address,
-            abi=self.contract.abi,
-        )
+        return self.provider.get_interface(self.contract)
 
     def get_event(self, event_name):
         event = getattr(
@@ -142,5 +153,8 @@ class EthereumEvent(Event):
         related_name="contractevent_set",
     )
 
+    def contract_subclass_id(self):
+        return self.contract_id
+
     def contract_subclass(self):
         return Transaction.objects.get_subclass(pk=self.contract.pk)
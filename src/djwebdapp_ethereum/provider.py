@@ -1,21 +1,232 @@
+from collections import OrderedDict, defaultdict
+import json
 import logging
+import threading
+import time
 
+from eth_utils import keccak, to_canonical_address, to_checksum_address
 from eth_utils.abi import event_abi_to_log_topic
 from hexbytes import HexBytes
+import rlp
 from web3 import Web3
 from web3.exceptions import ContractLogicError
+from web3.providers import HTTPProvider, JSONBaseProvider
 
 from django.conf import settings
 
 from django.db import transaction as db_transaction
-from djwebdapp.models import Account
+from django.db.models import F, Q
+from djwebdapp.models import SETTINGS, Account, Transaction
 from djwebdapp_ethereum.models import EthereumEvent, EthereumTransaction
+from djwebdapp.nodes import NodeBehind, NodePool, get_session
 from djwebdapp.provider import Provider
 
 
+class SessionHTTPProvider(HTTPProvider):
+    """
+    Web3 provider that posts through the keep-alive session of its endpoint,
+    see :py:func:`~djwebdapp.nodes.get_session`.
+    """
+    timeout = 10
+
+    def make_request(self, method, params):
+        kwargs = self.get_request_kwargs()
+        kwargs.setdefault('timeout', self.timeout)
+        response = get_session(self.endpoint_uri).post(
+            self.endpoint_uri,
+            data=self.encode_rpc_request(method, params),
+            **kwargs,
+        )
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
+
+    def make_batch_request(self, requests):
+        """
+        Send a list of (method, params) in a single JSON-RPC batch and return
+        the list of responses in the same order.
+        """
+        ids = [next(self.request_counter) for request in requests]
+        kwargs = self.get_request_kwargs()
+        kwargs.setdefault('timeout', self.timeout)
+        response = get_session(self.endpoint_uri).post(
+            self.endpoint_uri,
+            data=json.dumps([
+                dict(jsonrpc='2.0', method=method, params=params, id=id)
+                for id, (method, params) in zip(ids, requests)
+            ]),
+            **kwargs,
+        )
+        response.raise_for_status()
+        responses = {
+            response['id']: response
+            for response in response.json()
+        }
+        return [responses[id] for id in ids]
+
+
+class PoolHTTPProvider(JSONBaseProvider):
+    """
+    Web3 provider that sends requests through a
+    :py:class:`~djwebdapp.nodes.NodePool`.
+
+    Read-only methods of :py:attr:`spread_methods` are spread over the
+    healthy nodes, other methods go to the node with the highest priority, so
+    that nonces and sends stay consistent. A null result of a spread method is
+    queried on the next node, which might not be behind.
+    """
+    spread_methods = (
+        'eth_getBalance',
+        'eth_getBlockByNumber',
+        'eth_getBlockReceipts',
+        'eth_getLogs',
+        'eth_getTransactionReceipt',
+    )
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+        self.providers = dict()
+
+    def __str__(self):
+        return f'Node pool {self.pool.primary}'
+
+    def get_provider(self, endpoint):
+        if endpoint not in self.providers:
+            self.providers[endpoint] = SessionHTTPProvider(endpoint)
+        return self.providers[endpoint]
+
+    def make_request(self, method, params):
+        spread = method in self.spread_methods
+
+        def request(endpoint):
+            response = self.get_provider(endpoint).make_request(method, params)
+            if spread and response.get('result', False) is None:
+                raise NodeBehind(response)
+            return response
+
+        return self.pool.request(request, spread=spread)
+
+    def make_batch_request(self, requests):
+        """
+        Send a list of (method, params) in a single JSON-RPC batch to the node
+        with the highest priority.
+        """
+        return self.pool.request(
+            lambda endpoint: self.get_provider(
+                endpoint
+            ).make_batch_request(requests)
+        )
+
+
+fees = dict()
+
+# monotonic time of the last nonce sync per account
+nonce_syncs = dict()
+
+
+interfaces = OrderedDict()
+event_topics = OrderedDict()
+caches_lock = threading.Lock()
+
+
+def cache_get(cache, key):
+    """
+    Return the value of a key in a process-level LRU cache, None if missing.
+    """
+    with caches_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+
+def cache_set(cache, key, value):
+    """
+    Set the value of a key in a process-level LRU cache, of up to
+    ``ETHEREUM_INTERFACES`` entries according to the ``DJBLOCKCHAIN`` setting.
+    """
+    with caches_lock:
+        cache[key] = value
+        while len(cache) > SETTINGS['ETHEREUM_INTERFACES']:
+            cache.popitem(last=False)
+    return value
+
+
+def get_interface(client, contract):
+    """
+    Return the web3 contract object of a contract transaction.
+
+    Contract objects are cached per code hash and address. A cached object
+    built with another client, ie. after the nodes of the blockchain
+    changed, is rebuilt, so that no stale client is kept in use.
+    """
+    if contract.code_changed:
+        # code_id is only updated on save
+        return client.eth.contract(address=contract.address, abi=contract.abi)
+
+    key = (contract.code_id, contract.address)
+    cached = cache_get(interfaces, key)
+    if cached and cached[0] is client:
+        return cached[1]
+    interface = client.eth.contract(address=contract.address, abi=contract.abi)
+    cache_set(interfaces, key, (client, interface))
+    return interface
+
+
+def parse_event_topics(abi):
+    """
+    Return a dict of event topic, the first topic of a log, to the list of
+    names of the events of an ABI with that topic.
+
+    :param abi: ABI, as a list or as a JSON string.
+    """
+    if isinstance(abi, str):
+        abi = json.loads(abi)
+    topics = defaultdict(list)
+    for entry in abi or []:
+        if entry.get('type', None) == 'event' and 'name' in entry:
+            topic = '0x' + event_abi_to_log_topic(entry).hex()
+            topics[topic].append(entry['name'])
+    return dict(topics)
+
+
+def get_event_topics(abi, hash):
+    """
+    Return the :py:func:`parse_event_topics()` of an ABI, cached per code
+    hash.
+
+    :param hash: :py:attr:`~djwebdapp.models.Transaction.code_id` of the
+                 contract with that ABI.
+    """
+    topics = cache_get(event_topics, hash)
+    if topics is None:
+        topics = cache_set(event_topics, hash, parse_event_topics(abi))
+    return topics
+
+
 class EthereumProvider(Provider):
+    """
+    Ethereum provider, using web3.
+
+    Nonces are reserved by :py:meth:`nonce_reserve()`, so a sender can have
+    several pending transactions and is not limited to one deploy per level.
+
+    .. py:attribute:: nonce_sync_ttl
+
+        Number of seconds between two comparisons of the nonce counter of
+        a sender with the node in :py:meth:`nonce_sync()`, can be
+        overridden by the ``nonce_sync_ttl`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration`.
+
+    .. py:attribute:: nonce_failed_states
+
+        States of a transaction which will never be sent again with its
+        nonce, which :py:meth:`nonce_sync()` can then reserve again.
+    """
     logger = logging.getLogger('djwebdapp_ethereum')
     transaction_class = EthereumTransaction
+    spool_level_gate = False
+    nonce_sync_ttl = 60
+    nonce_failed_states = ('aborted',)
 
     def generate_secret_key(self):
         wallet = self.client.eth.account.create()
@@ -37,8 +248,9 @@ class EthereumProvider(Provider):
         return len([substr in endpoint for substr in middleware_endpoints])
 
     def get_client(self, **kwargs):
-        endpoint = self.blockchain.node_set.first().endpoint
-        client = Web3(Web3.HTTPProvider(endpoint))
+        pool = NodePool.for_blockchain(self.blockchain)
+        endpoint = pool.primary
+        client = Web3(PoolHTTPProvider(pool))
 
         if settings.DEBUG and not self.wallet:  # geth default account
             client.eth.default_account = client.eth.accounts[0]
@@ -57,21 +269,142 @@ class EthereumProvider(Provider):
         )
         return self.client.from_wei(weis, 'ether')
 
-    @property
-    def head(self):
+    def get_fees(self):
+        """
+        Return a dict with the chain id and the fee parameters of sends.
+
+        Fees are queried in a single JSON-RPC batch and cached per head level
+        for every provider of the blockchain in this process. The chain id
+        is taken from :py:attr:`~djwebdapp.models.Blockchain.chain_id` if
+        set, otherwise it is queried once and saved there.
+
+        ``max_fee`` and ``max_priority_fee`` are None on chains without
+        EIP-1559 fees, otherwise ``max_fee`` leaves room for the base fee to
+        double, like web3 does.
+        """
+        head = self.head
+        cached = fees.get(self.blockchain.pk, None)
+        if cached and cached[0] == head:
+            return cached[1]
+
+        requests = [
+            ('eth_gasPrice', []),
+            ('eth_maxPriorityFeePerGas', []),
+            ('eth_getBlockByNumber', ['latest', False]),
+        ]
+        if not self.blockchain.chain_id:
+            requests.append(('eth_chainId', []))
+        responses = self.client.provider.make_batch_request(requests)
+        if 'error' in responses[0]:
+            raise ValueError(responses[0]['error'])
+        results = [response.get('result', None) for response in responses]
+
+        if not self.blockchain.chain_id:
+            self.blockchain.chain_id = int(results[3], 16)
+            self.blockchain.save(update_fields=['chain_id'])
+
+        params = dict(
+            chain_id=self.blockchain.chain_id,
+            gas_price=int(results[0], 16),
+            max_fee=None,
+            max_priority_fee=None,
+        )
+        base_fee = (results[2] or {}).get('baseFeePerGas', None)
+        if results[1] and base_fee:
+            params['max_priority_fee'] = int(results[1], 16)
+            params['max_fee'] = (
+                params['max_priority_fee'] + 2 * int(base_fee, 16)
+            )
+
+        fees[self.blockchain.pk] = (head, params)
+        return params
+
+    def get_interface(self, contract):
+        """
+        Return the web3 contract object of a contract transaction, cached
+        with its code hash and address by :py:func:`get_interface()`.
+        """
+        return get_interface(self.client, contract)
+
+    def get_head(self):
         """
         Return the current block number.
         """
         return self.client.eth.get_block_number()
 
-    def index_level(self, level):
-        block = self.client.eth.get_block(level, True)
+    def get_block(self, level):
+        return self.client.eth.get_block(level, True)
+
+    def index_level(self, level, block=None):
+        if block is None:
+            block = self.get_block(level)
+        found = []
         for transaction in block.transactions:
             to = transaction.get('to', None)
             if to is None and self.check_hash(transaction['hash'].hex()):
-                self.index_contract(level, transaction)
+                found.append((transaction, True))
             elif to in self.addresses:
-                self.index_call(level, transaction)
+                found.append((transaction, False))
+        self.index_transactions(level, found)
+
+    def index_transactions(self, level, found):
+        """
+        Index the transactions found in a level.
+
+        The receipts of the calls are fetched at once with
+        :py:meth:`get_statuses()` beforehand.
+
+        :param found: List of (transaction, is_contract) tuples in block
+                      order.
+        """
+        statuses = self.get_statuses(level, [
+            transaction['hash'].hex()
+            for transaction, is_contract in found
+            if not is_contract
+        ])
+        for transaction, is_contract in found:
+            if is_contract:
+                self.index_contract(level, transaction)
+            else:
+                self.index_call(
+                    level,
+                    transaction,
+                    statuses.get(transaction['hash'].hex(), None),
+                )
+
+    def get_statuses(self, level, hashes):
+        """
+        Return a dict of transaction hash to receipt status, for the hashes
+        of transactions included in a level.
+
+        Receipts are fetched in a single JSON-RPC batch, or with
+        ``eth_getBlockReceipts`` if the ``index_block_receipts`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration` is set, for
+        nodes which support it. Hashes which have no receipt yet are left
+        out.
+        """
+        if not hashes:
+            return dict()
+
+        if self.blockchain.configuration.get('index_block_receipts', False):
+            receipts = self.client.provider.make_request(
+                'eth_getBlockReceipts',
+                [hex(level)],
+            ).get('result', None) or []
+        else:
+            receipts = [
+                response.get('result', None)
+                for response in self.client.provider.make_batch_request([
+                    ('eth_getTransactionReceipt', [hash]) for hash in hashes
+                ])
+            ]
+
+        hashes = {hash.lower() for hash in hashes}
+        return {
+            receipt['transactionHash'].lower(): int(receipt['status'], 16)
+            for receipt in receipts
+            if receipt and receipt['transactionHash'].lower() in hashes
+        }
 
     def index_contract(self, level, transaction):
         self.logger.info(f'Syncing origination {transaction["hash"]}')
@@ -82,9 +415,15 @@ class EthereumProvider(Provider):
         contract.level = level
         contract.gas = transaction['gas']
         contract.metadata = self.json(transaction)
-        contract.state_set('done')
+        self.index_save(contract)
+
+    def index_call(self, level, transaction, status=None):
+        """
+        Index a call transaction.
 
-    def index_call(self, level, transaction):
+        :param status: Receipt status of the transaction if already known,
+                       see :py:meth:`get_statuses()`.
+        """
         self.logger.info(f'EthereumProvider.index_call({transaction})')
 
         contract = EthereumTransaction.objects.filter(
@@ -103,11 +442,12 @@ class EthereumProvider(Provider):
             hash=transaction['hash'].hex(),
         ).first()
 
-        tx_receipt = self.client.eth.get_transaction_receipt(
-            transaction['hash'].hex(),
-        )
+        if status is None:
+            status = self.client.eth.get_transaction_receipt(
+                transaction['hash'].hex(),
+            ).status
 
-        if tx_receipt.status == 0:
+        if status == 0:
             return
 
         if not call:
@@ -119,25 +459,18 @@ class EthereumProvider(Provider):
         call.metadata = self.json(transaction)
         call.gas = transaction['gas']
         call.level = level
-        call.sender, _ = Account.objects.get_or_create(
-            address=transaction['from'],
-            blockchain=self.blockchain,
-        )
-        if contract.abi:
-            interface = self.client.eth.contract(
-                address=contract.address,
-                abi=contract.abi,
-            )
-
+        call.sender = self.get_account(transaction['from'], index=True)
         if self.is_smart_contract_transfer_only(call):
             call.function = 'receive'
             call.amount = self.client.from_wei(call.metadata['value'], 'ether')
         elif contract.abi:
-            fn, args = interface.decode_function_input(call.metadata['input'])
+            fn, args = self.get_interface(contract).decode_function_input(
+                call.metadata['input'],
+            )
             call.function = fn.fn_name
             call.args = args
 
-        call.state_set('done')
+        self.index_save(call)
 
     def is_smart_contract_transfer_only(self, call):
         """
@@ -158,10 +491,7 @@ class EthereumProvider(Provider):
         }
 
     def send(self, transaction):
-        Contract = self.client.eth.contract(  # noqa
-            abi=transaction.contract.abi,
-            address=transaction.contract.address,
-        )
+        Contract = self.get_interface(transaction.contract)  # noqa
         funcs = Contract.find_functions_by_name(transaction.function)
         if not funcs:
             raise Exception(
@@ -198,16 +528,20 @@ class EthereumProvider(Provider):
         if transaction.kind == 'contract':
             transaction.sender.last_level = self.head
             self.originate(transaction)
-            transaction.sender.save()
+            transaction.sender.save(update_fields=['last_level'])
         elif transaction.kind == 'function':
             transaction.sender.last_level = self.head
             self.send(transaction)
-            transaction.sender.save()
+            transaction.sender.save(update_fields=['last_level'])
         elif transaction.kind == 'transfer':
             transaction.hash = self.transfer(transaction)
         else:
             transaction.error = f'Unknown transaction kind {transaction.kind}'
-            transaction.state_set('failed')
+            transaction.state_set(
+                'failed',
+                provider=self,
+                update_fields=('error',),
+            )
             return
 
         self.logger.info(f'{transaction}.deploy(): success')
@@ -218,20 +552,24 @@ class EthereumProvider(Provider):
             'from': transaction.sender.address,
             'value': self.client.to_wei(transaction.amount, 'ether'),
         }
-        tx['gas'] = self.client.eth.estimate_gas(tx)
-        tx['gasPrice'] = self.client.eth.gas_price
-        tx['nonce'] = self.client.eth.get_transaction_count(
-            transaction.sender.address
-        )
-        tx['chainId'] = self.client.eth.chain_id
-        signed_txn = self.client.eth.account.sign_transaction(
-            tx,
-            private_key=transaction.sender.get_secret_key(),
-        )
-        self.client.eth.send_raw_transaction(signed_txn.rawTransaction)
-        return self.client.to_hex(
-            self.client.keccak(signed_txn.rawTransaction)
-        )
+        sender = transaction.sender
+        nonce = self.nonce_reserve(sender)
+        try:
+            fee = self.get_fees()
+            tx['gas'] = self.client.eth.estimate_gas(tx)
+            tx['gasPrice'] = fee['gas_price']
+            tx['nonce'] = nonce
+            tx['chainId'] = fee['chain_id']
+            signed_txn = self.client.eth.account.sign_transaction(
+                tx,
+                private_key=sender.get_secret_key(),
+            )
+        except Exception:
+            self.nonce_release(sender, nonce)
+            raise
+
+        transaction.nonce = nonce
+        return self.send_raw_transaction(sender, signed_txn, nonce)
 
     def originate(self, transaction):
         Contract = self.client.eth.contract(  # noqa
@@ -241,54 +579,205 @@ class EthereumProvider(Provider):
 
         tx = Contract.constructor(*transaction.get_args())
         transaction.hash = self.write_transaction(transaction, tx)
-        receipt = self.client.eth.wait_for_transaction_receipt(
-            transaction.hash)
-        transaction.address = receipt.contractAddress
+        # known before the transaction is mined, no need to wait for it
+        transaction.address = self.get_contract_address(
+            transaction.sender.address,
+            transaction.nonce,
+        )
+
+    def get_contract_address(self, address, nonce):
+        """
+        Return the address of the contract created by an address with a
+        nonce.
+        """
+        return to_checksum_address(keccak(rlp.encode([
+            to_canonical_address(address),
+            nonce,
+        ]))[12:])
+
+    def spool_calls(self):
+        """
+        Return the calls to deploy in :py:meth:`~spool()`.
+
+        Contract addresses are known as soon as they are sent, calls from
+        other senders wait for the contract to be found in a block by the
+        indexer, so that they do not reach the address before the contract.
+        The state of the contract is not enough: it is already ``done``
+        right after sending when ``min_confirmations`` is 0.
+        """
+        return super().spool_calls().exclude(
+            Q(contract__hash__isnull=False)
+            & ~Q(contract__metadata__has_key='blockNumber')
+            & ~Q(contract__sender=F('sender'))
+        )
 
     def write_transaction(self, djwebdapp_transaction, tx):
         sender = djwebdapp_transaction.sender
-        nonce = self.client.eth.get_transaction_count(sender.address)
-        options = {
-            'from': sender.address,
-            'nonce': nonce,
-        }
+        nonce = self.nonce_reserve(sender)
         try:
-            built = tx.build_transaction(options)
-        except ContractLogicError as e:
-            djwebdapp_transaction.error = e.message
-            raise e
-        options['gas'] = self.client.eth.estimate_gas(built)
-        signed_txn = self.client.eth.account.sign_transaction(
-            built,
-            private_key=sender.get_secret_key(),
-        )
+            fee = self.get_fees()
+            options = {
+                'from': sender.address,
+                'nonce': nonce,
+                'chainId': fee['chain_id'],
+            }
+            if fee['max_fee']:
+                options['maxFeePerGas'] = fee['max_fee']
+                options['maxPriorityFeePerGas'] = fee['max_priority_fee']
+            else:
+                options['gasPrice'] = fee['gas_price']
+            try:
+                # only estimates gas, other parameters are set
+                built = tx.build_transaction(options)
+            except ContractLogicError as e:
+                djwebdapp_transaction.error = e.message
+                raise e
+            signed_txn = self.client.eth.account.sign_transaction(
+                built,
+                private_key=sender.get_secret_key(),
+            )
+        except Exception:
+            self.nonce_release(sender, nonce)
+            raise
+
+        djwebdapp_transaction.nonce = nonce
+        return self.send_raw_transaction(sender, signed_txn, nonce)
+
+    def send_raw_transaction(self, sender, signed_txn, nonce):
+        """
+        Send a signed transaction and return its hash.
 
-        self.client.eth.send_raw_transaction(signed_txn.rawTransaction)
+        If the node rejects it, for example because the wallet was used by
+        another client, the nonce is given back and the counter of the
+        sender is compared with the node on the next reservation.
+        """
+        try:
+            self.client.eth.send_raw_transaction(signed_txn.rawTransaction)
+        except Exception:
+            self.nonce_release(sender, nonce)
+            nonce_syncs.pop(sender.pk, None)
+            raise
         return self.client.to_hex(
             self.client.keccak(signed_txn.rawTransaction)
         )
 
+    def nonce_reserve(self, sender):
+        """
+        Reserve the next nonce of a sender and return it.
+
+        Nonces are counted in :py:attr:`~djwebdapp.models.Account.counter`,
+        with the account row locked so that concurrent spoolers never
+        reserve the same one, which allows several pending transactions per
+        sender. :py:attr:`~djwebdapp.models.Account.nonce_gaps` are reserved
+        first, and the counter is compared with the node by
+        :py:meth:`nonce_sync()`.
+        """
+        with db_transaction.atomic():
+            account = Account.objects.select_for_update().get(pk=sender.pk)
+            self.nonce_sync(account)
+            if account.nonce_gaps:
+                nonce = min(account.nonce_gaps)
+                account.nonce_gaps.remove(nonce)
+            else:
+                nonce = account.counter
+                account.counter += 1
+            account.save(update_fields=account.nonce_fields)
+        sender.counter = account.counter
+        sender.nonce_gaps = account.nonce_gaps
+        return nonce
+
+    def nonce_sync(self, account):
+        """
+        Compare the counter of a locked account with the pending
+        transaction count of the node, at most every
+        :py:attr:`nonce_sync_ttl` seconds.
+
+        If the counter is unknown, or behind the node because another
+        client used the wallet, it is set to the count of the node.
+
+        If the node is behind, its next nonce is added to the gaps to be
+        reserved again only if the transactions which had it are all in
+        :py:attr:`nonce_failed_states`. Nonces which are still in flight,
+        however long ago they were reserved, are never reserved again.
+        """
+        ttl = self.blockchain.configuration.get(
+            'nonce_sync_ttl',
+            self.nonce_sync_ttl,
+        )
+        now = time.monotonic()
+        last = nonce_syncs.get(account.pk, None)
+        if account.counter is not None and last and now - last < ttl:
+            return
+
+        pending = self.client.eth.get_transaction_count(
+            account.address,
+            'pending',
+        )
+        gaps = {gap for gap in account.nonce_gaps if gap >= pending}
+        if account.counter is None or pending > account.counter:
+            account.counter = pending
+        elif pending < account.counter and self.nonce_failed(
+            account,
+            pending,
+        ):
+            self.logger.warning(f'Nonce {pending} of {account} was dropped')
+            gaps.add(pending)
+        account.nonce_gaps = sorted(gaps)
+        nonce_syncs[account.pk] = now
+
+    def nonce_failed(self, account, nonce):
+        """
+        Return True if the transactions of account with nonce all failed.
+
+        A nonce without any transaction may be reserved by a transaction
+        which is not saved yet, so it is not considered as failed.
+        """
+        states = set(
+            Transaction.objects.filter(
+                sender=account,
+                nonce=nonce,
+            ).values_list('state', flat=True)
+        )
+        return bool(states) and states <= {*self.nonce_failed_states}
+
+    def nonce_release(self, sender, nonce):
+        """
+        Give back a reserved nonce which was not sent.
+
+        The counter is rewound if no other nonce was reserved since,
+        otherwise the nonce is added to the gaps of the sender, so that the
+        next reservation fills it and does not block the next transactions.
+        """
+        with db_transaction.atomic():
+            account = Account.objects.select_for_update().get(pk=sender.pk)
+            gaps = {*account.nonce_gaps, nonce}
+            while account.counter and account.counter - 1 in gaps:
+                account.counter -= 1
+                gaps.remove(account.counter)
+            account.nonce_gaps = sorted(gaps)
+            account.save(update_fields=account.nonce_fields)
+        sender.counter = account.counter
+        sender.nonce_gaps = account.nonce_gaps
+
 
 class EthereumEventProvider(EthereumProvider):
     event_class = EthereumEvent
 
     def index_init(self):
         super().index_init()
+        self.log_contracts = dict()
         self.contracts = self.contracts.exclude(
-            abi=None,
+            code=None,
         )
 
-        self.addresses = self.contracts.values_list(
-            'address',
-            flat=True,
-        )
+        self.addresses = self.get_addresses(self.contracts)
 
-        head = self.head
+        head = self.head_refresh()
 
         event_filter = {
             'fromBlock': self.blockchain.index_level or 0,
             'toBlock': head,
-            'address': self.addresses,
+            'address': list(self.addresses),
         }
 
         try:
@@ -314,8 +803,16 @@ class EthereumEventProvider(EthereumProvider):
         self.logs = logs
         self.last_indexed_block = head
 
-    def get_min_level(self, items, key):
-        return min((item[key] for item in items), default=None)
+        # group pending hashes and logs by level once, so that each level
+        # gets its own work without filtering the whole lists again
+        self.level_hashes = defaultdict(set)
+        for hash, level in self.hashes.items():
+            if level is not None:
+                self.level_hashes[level].add(hash)
+
+        self.level_logs = defaultdict(list)
+        for log in self.logs:
+            self.level_logs[log['blockNumber']].append(log)
 
     def index(self):
         """
@@ -323,32 +820,30 @@ class EthereumEventProvider(EthereumProvider):
 
         Iterate over each level that included txs and events
         related to indexed contracts.
+
+        Committed transactions are normalized right away if
+        :py:attr:`~djwebdapp.provider.Provider.index_normalize` is set.
         """
         self.index_init()
 
-        while len(self.hashes) or len(self.logs):
-            index_of_level_in_hashes_tuple = 1
-            min_level_hashes = self.get_min_level(
-                self.hashes,
-                key=index_of_level_in_hashes_tuple,
-            )
-            min_level_logs = self.get_min_level(
-                self.logs,
-                key='blockNumber',
-            )
-
-            level_to_index = min(
-                filter(None, [min_level_hashes, min_level_logs])
-            )
-
-            self.logger.info(f'Indexing level {level_to_index}')
-            self.index_level(level_to_index)
-            self.blockchain.index_level = level_to_index
+        levels = sorted({*self.level_hashes, *self.level_logs})
+        pipeline = self.index_pipeline()
+        try:
+            for level_to_index in levels:
+                self.logger.info(f'Indexing level {level_to_index}')
+                with db_transaction.atomic():
+                    self.index_level(level_to_index)
+                    self.blockchain.index_level = level_to_index
+                    self.blockchain.save()
+                    self.index_commit(pipeline)
+        finally:
+            if pipeline:
+                pipeline.close()
 
         self.blockchain.index_level = self.last_indexed_block
         self.blockchain.save()
 
-    def index_level(self, level):
+    def index_level(self, level, block=None):
         """
         To optimize for compute units on Alchemy/Moralis nodes, we:
 
@@ -370,59 +865,60 @@ class EthereumEventProvider(EthereumProvider):
         transactions awaiting confirmation nor any events were emitted
         at the current level.
         """
-        logs_at_level = list(filter(
-            lambda log: log["blockNumber"] == level,
-            self.logs,
-        ))
-        logs_tx_hash = [log["transactionHash"].hex() for log in logs_at_level]
+        logs_at_level = self.level_logs.pop(level, [])
+        logs_tx_hash = {log["transactionHash"].hex() for log in logs_at_level}
 
-        hashes_at_level = list(filter(
-            lambda hash_tuple: hash_tuple[1] == level,
-            self.hashes,
-        ))
-        hashes = [hash_tuple[0] for hash_tuple in hashes_at_level]
+        hashes = self.level_hashes.pop(level, set())
 
         if len(hashes):
-            block = self.client.eth.get_block(level, True)
+            if block is None:
+                block = self.get_block(level)
+            found = []
             for transaction in block.transactions:
                 to = transaction.get('to', None)
                 if to is None and transaction['hash'].hex() in hashes:
-                    self.index_contract(level, transaction)
+                    found.append((transaction, True))
                 elif (
                     to in self.addresses
                     or (transaction['hash'].hex() in logs_tx_hash and to)
                 ):
-                    self.index_call(level, transaction)
+                    found.append((transaction, False))
+            self.index_transactions(level, found)
 
         for log in logs_at_level:
             if not log["removed"]:
                 self.index_log(log)
 
-        self.hashes = list(filter(
-            lambda hash_tuple: hash_tuple[1] > level,
-            self.hashes,
-        ))
-
-        self.logs = list(filter(
-            lambda log: log['blockNumber'] != level,
-            self.logs
-        ))
-
-    def get_contract_event_names(self, contract_abi, encoded_event_name):
-        events = []
-        for entry in contract_abi:
-            if (
-                "type" in entry
-                and entry["type"] == "event"
-                and "name" in entry
-            ):
-                candidate_encoded_event_name = "0x" + event_abi_to_log_topic(
-                    entry,
-                ).hex()
-                if candidate_encoded_event_name == encoded_event_name:
-                    events.append(entry["name"])
-
-        return events
+    def get_contract_event_names(
+        self,
+        contract_abi,
+        encoded_event_name,
+        hash=None,
+    ):
+        """
+        Return the names of the events of an ABI with a given topic.
+
+        :param hash: Code hash of the contract with that ABI, to get topics
+                     from the cache of :py:func:`get_event_topics()`.
+        """
+        if hash:
+            topics = get_event_topics(contract_abi, hash)
+        else:
+            topics = parse_event_topics(contract_abi)
+        return topics.get(encoded_event_name, [])
+
+    def get_log_contract(self, address):
+        """
+        Return the contract of a log address, cached for the indexing run.
+        """
+        if address not in self.log_contracts:
+            self.log_contracts[address] = (
+                self.transaction_class.objects.filter(
+                    blockchain=self.blockchain,
+                    address=address,
+                ).first()
+            )
+        return self.log_contracts[address]
 
     def index_log(self, log):
         # In case of it's a log for the contract creation, right now it
@@ -430,44 +926,41 @@ class EthereumEventProvider(EthereumProvider):
         # so the transaction is not created
         # So right now I return if the tx not exists
 
-        with db_transaction.atomic():
-            transaction, created = self.transaction_class.objects.update_or_create(  # noqa: E501
+        try:
+            transaction = self.transaction_class.objects.get(
                 blockchain=self.blockchain,
                 hash=log["transactionHash"].hex(),
-                defaults=dict(
-                    level=log["blockNumber"],
-                )
             )
-            transaction.state_set("done")
-
-            if created:
-                """
-                If the transaction was created, then it's from the log of an
-                indexed contract, we consider the original transaction to be
-                a `function` kind which we don't index.
-
-                This is crucial as it will otherwise by default be saved as
-                an indexed contract. If so, then the indexer will try to
-                index a contract with no address and raise!!
-
-                Hence this must also be in the atomic block.
-                """
-                transaction.kind = "function"
-                transaction.index = False
-                transaction.save()
-
-        contract = self.transaction_class.objects.filter(
-            address=log["address"]
-        ).first()
-        contract_ci = self.client.eth.contract(
-            address=contract.address,
-            abi=contract.abi,
-        )
+        except self.transaction_class.DoesNotExist:
+            """
+            If the transaction is new, then it's from the log of an indexed
+            contract, we consider the original transaction to be a
+            `function` kind which we don't index.
+
+            This is crucial as it will otherwise by default be saved as an
+            indexed contract. If so, then the indexer will try to index a
+            contract with no address and raise!!
+
+            Hence this must be set before it is saved.
+            """
+            transaction = self.transaction_class(
+                blockchain=self.blockchain,
+                hash=log["transactionHash"].hex(),
+                kind="function",
+                index=False,
+            )
+        transaction.level = log["blockNumber"]
+        # queued for the normalize pipeline with the other transactions
+        self.index_save(transaction)
+
+        contract = self.get_log_contract(log["address"])
+        contract_ci = self.get_interface(contract)
         # first topic encodes event name
         encoded_log_name = log["topics"][0].hex()
         event_names = self.get_contract_event_names(
-            contract_ci.abi,
+            contract.abi,
             encoded_log_name,
+            None if contract.code_changed else contract.code_id,
         )
         for event_name in event_names:
             event = getattr(contract_ci.events, event_name)
@@ -37,6 +37,6 @@ print(first_mint.level, first_mint.hash)
 second_mint.refresh_from_db()
 print(second_mint.level, second_mint.hash)
 
-# Given all these transactions are sent from the same account, each was done in
-# a different block to prevent noonce issues
-assert contract.level < first_mint.level < second_mint.level
+# Nonces are reserved by the provider, so transactions of the same account
+# may be sent during the same block
+assert contract.level <= first_mint.level <= second_mint.level
@@ -1,3 +1,5 @@
+from collections import defaultdict
+
 from djwebdapp.models import Account
 
 from djwebdapp_fa2.models import Balance, Fa2Token
@@ -36,6 +38,12 @@ class Fa2Normalizer(Normalizer):
             account=from_account,
             token=token,
         )
+        # debit first, so that a transfer to the sender itself is credited
+        # back instead of overwritten
+        from_balance.amount -= sum(
+            transfer["amount"] for transfer in call.args[0]["txs"]
+        )
+        from_balance.save()
 
         for transfer in call.args[0]["txs"]:
             to_account, _ = Account.objects.get_or_create(
@@ -49,12 +57,72 @@ class Fa2Normalizer(Normalizer):
             if created:
                 to_balance.amount = 0
 
-            from_balance.amount -= transfer["amount"]
-
             to_balance.amount += transfer["amount"]
             to_balance.save()
 
-        from_balance.save()
+    def transfer__batch(self, calls, contract):
+        """
+        Sum the balance changes of transfer calls, and write them with a
+        single upsert.
+
+        Unknown accounts are created with get_or_create() as in
+        :py:meth:`transfer()`, so that their pre_save setup runs.
+        """
+        tokens = {
+            token.token_id: token
+            for token in contract.fa2token_set.filter(
+                token_id__in={
+                    call.args[0]["txs"][0]["token_id"] for call in calls
+                },
+            )
+        }
+
+        deltas = defaultdict(int)
+        for call in calls:
+            token = tokens[call.args[0]["txs"][0]["token_id"]]
+            from_key = (call.args[0]["from_"], token)
+            deltas.setdefault(from_key, 0)
+            for transfer in call.args[0]["txs"]:
+                deltas[from_key] -= transfer["amount"]
+                deltas[(transfer["to_"], token)] += transfer["amount"]
+
+        addresses = {address for address, token in deltas}
+        accounts = {
+            account.address: account
+            for account in Account.objects.filter(
+                blockchain_id=calls[0].blockchain_id,
+                address__in=addresses,
+            )
+        }
+        for address in addresses - set(accounts):
+            accounts[address], _ = Account.objects.get_or_create(
+                blockchain_id=calls[0].blockchain_id,
+                address=address,
+            )
+
+        amounts = {
+            (balance.account_id, balance.token_id): balance.amount
+            for balance in Balance.objects.filter(
+                token__in=tokens.values(),
+                account__in=accounts.values(),
+            )
+        }
+        Balance.objects.bulk_create(
+            [
+                Balance(
+                    account=accounts[address],
+                    token=token,
+                    amount=amounts.get(
+                        (accounts[address].pk, token.pk),
+                        0,
+                    ) + delta,
+                )
+                for (address, token), delta in deltas.items()
+            ],
+            update_conflicts=True,
+            unique_fields=("token", "account"),
+            update_fields=("amount",),
+        )
 
     def burn(self, call, contract):
         token = contract.fa2token_set.filter(
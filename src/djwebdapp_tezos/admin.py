@@ -1,3 +1,4 @@
+from django import forms
 from django.contrib import admin
 
 from djwebdapp.admin import TransactionAdmin
@@ -5,6 +6,32 @@ from djwebdapp.admin import TransactionAdmin
 from .models import TezosTransaction
 
 
+class TezosTransactionForm(forms.ModelForm):
+    """
+    Edit :py:attr:`~djwebdapp_tezos.models.TezosTransaction.micheline`,
+    which is stored in :py:class:`~djwebdapp.models.Code` and not a model
+    field.
+    """
+    micheline = forms.JSONField(
+        required=False,
+        help_text='Smart contract Micheline, if this is a smart contract',
+    )
+
+    class Meta:
+        model = TezosTransaction
+        fields = '__all__'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.initial.setdefault('micheline', self.instance.micheline)
+
+    def save(self, commit=True):
+        if 'micheline' in self.changed_data:
+            self.instance.micheline = self.cleaned_data['micheline']
+        return super().save(commit=commit)
+
+
 @admin.register(TezosTransaction)
 class TezosTransactionAdmin(TransactionAdmin):
-    pass
+    form = TezosTransactionForm
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:42
+
+import hashlib
+import json
+
+from django.db import migrations
+
+
+def code_hash(code):
+    # frozen copy of djwebdapp.models.code_hash
+    return hashlib.sha256(
+        json.dumps(code, sort_keys=True, separators=(',', ':')).encode()
+    ).hexdigest()
+
+
+def micheline_to_code(apps, schema_editor):
+    Code = apps.get_model('djwebdapp', 'Code')
+    Transaction = apps.get_model('djwebdapp', 'Transaction')
+    TezosTransaction = apps.get_model('djwebdapp_tezos', 'TezosTransaction')
+    contracts = TezosTransaction.objects.exclude(
+        micheline=None,
+    ).exclude(
+        micheline={},
+    ).values_list('pk', 'micheline')
+    for pk, micheline in contracts.iterator():
+        code, _ = Code.objects.get_or_create(
+            hash=code_hash(micheline),
+            defaults=dict(code=micheline),
+        )
+        Transaction.objects.filter(pk=pk).update(code=code)
+
+
+def code_to_micheline(apps, schema_editor):
+    TezosTransaction = apps.get_model('djwebdapp_tezos', 'TezosTransaction')
+    contracts = TezosTransaction.objects.exclude(
+        code=None,
+    ).select_related('code')
+    for contract in contracts.iterator():
+        TezosTransaction.objects.filter(pk=contract.pk).update(
+            micheline=contract.code.code,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djwebdapp', '0019_code'),
+        ('djwebdapp_tezos', '0005_tezoscall_tezoscontract'),
+    ]
+
+    operations = [
+        migrations.RunPython(micheline_to_code, code_to_micheline),
+        migrations.RemoveField(
+            model_name='tezostransaction',
+            name='micheline',
+        ),
+    ]
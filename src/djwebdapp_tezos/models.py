@@ -1,5 +1,7 @@
+from collections import OrderedDict
 import json
 import os
+import threading
 
 import dateutil.parser
 
@@ -9,17 +11,51 @@ from django.db import models
 from django.db.models import signals
 from django.dispatch import receiver
 
-from djwebdapp.models import Transaction
+from djwebdapp.models import SETTINGS, Code, Transaction, code_hash
 from djwebdapp.normalizers import Normalizer
 
 
+interfaces = OrderedDict()
+interfaces_lock = threading.Lock()
+
+
+def get_interface(micheline=None, hash=None):
+    """
+    Return the ContractInterface of a Micheline script.
+
+    Parsed interfaces are kept in a process-level LRU cache keyed by code
+    hash, and shared by every contract with that code, of up to
+    ``TEZOS_INTERFACES`` entries according to the ``DJBLOCKCHAIN`` setting.
+
+    :param micheline: Micheline code of the contract, loaded from
+                      :py:class:`~djwebdapp.models.Code` by hash if None.
+    :param hash: :py:func:`~djwebdapp.models.code_hash()` of the code, if
+                 known already.
+    """
+    key = hash or code_hash(micheline)
+    with interfaces_lock:
+        if key in interfaces:
+            interfaces.move_to_end(key)
+            return interfaces[key]
+
+    if micheline is None:
+        micheline = Code.objects.get(hash=key).code
+    interface = ContractInterface.from_micheline(micheline)
+    with interfaces_lock:
+        interfaces[key] = interface
+        while len(interfaces) > SETTINGS['TEZOS_INTERFACES']:
+            interfaces.popitem(last=False)
+    return interface
+
+
 class TezosTransaction(Transaction):
     """
     Base class for tezos transactions.
 
     .. py:attribute:: micheline
 
-        Smart contract micheline JSON code.
+        Smart contract micheline JSON code, stored in
+        :py:attr:`~djwebdapp.models.Transaction.code`.
     """
     unit_smallest = 'xTZ'
     contract = models.ForeignKey(
@@ -30,12 +66,6 @@ class TezosTransaction(Transaction):
         blank=True,
         help_text='Smart contract, appliable to method call',
     )
-    micheline = models.JSONField(
-        default=dict,
-        blank=True,
-        null=True,
-        help_text='Smart contract Micheline, if this is a smart contract',
-    )
     caller = models.ForeignKey(
         "TezosTransaction",
         on_delete=models.CASCADE,
@@ -48,13 +78,28 @@ class TezosTransaction(Transaction):
         Set :py:attr:`~djwebdapp.models.Transaction.has_code` if
         :py:attr:`~micheline`.
         """
-        if self.micheline:
+        if self.code_id or self.micheline:
             self.has_code = True
         return super().save(*args, **kwargs)
 
+    @property
+    def micheline(self):
+        return self.code_get()
+
+    @micheline.setter
+    def micheline(self, micheline):
+        self.code_set(micheline)
+
     @property
     def interface(self):
-        return ContractInterface.from_micheline(self.micheline)
+        """
+        ContractInterface of :py:attr:`micheline`, see
+        :py:func:`get_interface()`.
+        """
+        if self.code_changed or not self.code_id:
+            return get_interface(self.micheline)
+        # the code is only loaded if not in cache
+        return get_interface(hash=self.code_id)
 
     @property
     def is_internal(self):
@@ -91,7 +136,7 @@ class TezosTransaction(Transaction):
 
 @receiver(signals.pre_save, sender=TezosTransaction)
 def contract_micheline(sender, instance, **kwargs):
-    if not instance.address or instance.micheline:
+    if not instance.address or instance.code_id or instance.micheline:
         return
 
     if instance.kind != 'contract':
@@ -99,6 +144,8 @@ def contract_micheline(sender, instance, **kwargs):
 
     interface = instance.blockchain.provider.client.contract(instance.address)
     instance.micheline = interface.to_micheline()
+    # Transaction.save() has stored the code already
+    instance.code_store()
 
 
 class TezosContract(TezosTransaction):
@@ -113,18 +160,16 @@ class TezosContract(TezosTransaction):
         Set :py:attr:`~djwebdapp_tezos.models.TezosTransaction.micheline` if
         :py:attr:`~djwebdapp.models.Transaction.contract_name` is set.
         """
-        if self.contract_name and not self.micheline:
+        if self.contract_name and not (self.code_id or self.micheline):
             self.micheline = self.get_contract_interface().to_micheline()
         return super().save(*args, **kwargs)
 
     def get_contract_interface(self):
-        if self.micheline:
-            return ContractInterface.from_micheline(self.micheline)
+        if self.code_id or self.micheline:
+            return self.interface
         elif os.path.exists(f'{self.contract_path}.json'):
             with open(f'{self.contract_path}.json') as micheline:
-                return ContractInterface.from_micheline(
-                    json.loads(micheline.read())
-                )
+                return get_interface(json.loads(micheline.read()))
         elif os.path.exists(f'{self.contract_path}.tz'):
             with open(f'{self.contract_path}.tz') as michelson:
                 return ContractInterface.from_michelson(michelson.read())
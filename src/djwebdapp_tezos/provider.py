@@ -1,15 +1,24 @@
 from decimal import Decimal
 import logging
-import requests
-import urllib
+import re
+import time
 
-from django.db.models import Q, signals
+from django.db import transaction as db_transaction
+from django.db.models import BigIntegerField, Max, Q
+from django.db.models.fields.json import KeyTextTransform
+from django.db.models.functions import Cast
 from django.core.exceptions import ValidationError
 from pytezos.operation.result import OperationResult
-from pytezos.rpc import RpcError
+from pytezos.rpc import RpcError, ShellQuery
+from pytezos.rpc.node import (
+    RpcForbiddenError,
+    RpcNode,
+    RpcNotFoundError,
+)
 
 from djwebdapp.exceptions import PermanentError
-from djwebdapp.models import Account, account_setup
+from djwebdapp.models import Account
+from djwebdapp.nodes import NodeBehind, NodePool, get_session
 from djwebdapp.provider import Provider
 
 from djwebdapp_tezos.models import TezosTransaction
@@ -17,9 +26,156 @@ from djwebdapp_tezos.models import TezosTransaction
 from pytezos import pytezos, Key
 
 
+class RpcNodeError(RpcError):
+    """
+    Raised for HTTP 5xx answers which are not protocol errors, such as a
+    temporary error or a failing proxy, so that
+    :py:class:`~djwebdapp.nodes.NodePool` counts them as failures of the
+    node.
+    """
+
+
+class SessionRpcNode(RpcNode):
+    """
+    pytezos RPC node that queries through the keep-alive session of its
+    endpoint, see :py:func:`~djwebdapp.nodes.get_session`.
+    """
+    retries = 3
+    retry_delay = .25
+
+    def get_errors(self, response):
+        """
+        Return the list of errors of a node response, None if the response
+        is not an error trace.
+        """
+        try:
+            errors = response.json()
+        except ValueError:
+            return None
+        if not isinstance(errors, list):
+            return None
+        return [error for error in errors if isinstance(error, dict)]
+
+    def is_protocol_error(self, errors):
+        """
+        Return True if an error trace has errors of the protocol, which
+        would be the same on any node.
+        """
+        return any(
+            error.get('id', '').startswith('proto.') for error in errors or []
+        )
+
+    def is_transient(self, response):
+        """
+        Return True for temporary node errors which are not protocol errors.
+        """
+        errors = self.get_errors(response)
+        return (
+            any(error.get('kind') == 'temporary' for error in errors or [])
+            and not self.is_protocol_error(errors)
+        )
+
+    def request(self, method, path, **kwargs):
+        endpoint = self.uri[0]
+        kwargs['timeout'] = kwargs.get('timeout', None) or 60
+        for attempt in range(self.retries):
+            response = get_session(endpoint).request(
+                method=method,
+                url='/'.join((endpoint.rstrip('/'), path.lstrip('/'))),
+                headers={
+                    'content-type': 'application/json',
+                    'user-agent': 'djwebdapp',
+                    **self.headers,
+                },
+                **kwargs,
+            )
+            if response.status_code < 500 or not self.is_transient(response):
+                break
+            if attempt + 1 < self.retries:
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+        if response.status_code in (401, 403):
+            raise RpcForbiddenError(f'{response.reason}: {path}')
+        if response.status_code == 404:
+            raise RpcNotFoundError(f'Not found: {path}')
+        if response.status_code >= 500 and not self.is_protocol_error(
+            self.get_errors(response)
+        ):
+            raise RpcNodeError(
+                f'{response.status_code} {response.reason}: {path}',
+                response.text,
+            )
+        if response.status_code != 200:
+            raise RpcError.from_response(response)
+        return response
+
+
+class PoolRpcNode(RpcNode):
+    """
+    pytezos RPC node that sends requests through a
+    :py:class:`~djwebdapp.nodes.NodePool`.
+
+    Queries of blocks by level and balance queries are spread over the
+    healthy nodes, other queries go to the node with the highest priority,
+    so that counters and injections stay consistent. A block which is not
+    found is queried on the next node, which might not be behind.
+
+    Network errors and :py:class:`RpcNodeError` count as failures of the
+    node.
+    """
+    spread_paths = re.compile(
+        r'^/?chains/main/blocks/(\d+/|[^/]+/context/contracts/[^/]+/balance$)'
+    )
+
+    def __init__(self, pool):
+        super().__init__([node.endpoint for node in pool.nodes])
+        self.pool = pool
+        self.nodes = dict()
+
+    def get_node(self, endpoint):
+        if endpoint not in self.nodes:
+            self.nodes[endpoint] = SessionRpcNode(
+                endpoint,
+                headers=self.headers,
+            )
+        return self.nodes[endpoint]
+
+    def request(self, method, path, **kwargs):
+        spread = method == 'GET' and bool(self.spread_paths.match(path))
+
+        def request(endpoint):
+            try:
+                return self.get_node(endpoint).request(method, path, **kwargs)
+            except RpcNotFoundError as exception:
+                if spread:
+                    raise NodeBehind(exception)
+                raise
+
+        return self.pool.request(request, spread=spread)
+
+
 class TezosProvider(Provider):
+    """
+    Tezos provider, using pytezos.
+
+    .. py:attribute:: spool_bulk
+
+        Maximum number of calls and transfers of a sender that
+        :py:meth:`deploy()` packs in a single operation group, can be
+        overridden by the ``spool_bulk`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration`. Disabled by
+        default.
+
+    .. py:attribute:: download_limit
+
+        Number of tzkt operations per page for :py:meth:`download()`, can be
+        overridden by the ``download_limit`` key of
+        :py:attr:`~djwebdapp.models.Blockchain.configuration`.
+    """
     logger = logging.getLogger('djwebdapp_tezos')
     transaction_class = TezosTransaction
+    spool_bulk = 1
+    download_limit = 1000
 
     def generate_secret_key(self):
         key = Key.generate(export=False)
@@ -30,13 +186,16 @@ class TezosProvider(Provider):
             kwargs['key'] = Key.from_secret_exponent(
                 self.wallet.get_secret_key()
             )
+        pool = NodePool.for_blockchain(
+            self.blockchain,
+            errors=(OSError, RpcNodeError),
+        )
         return pytezos.using(
-            shell=self.blockchain.node_set.first().endpoint,
+            shell=ShellQuery(node=PoolRpcNode(pool)),
             **kwargs,
         )
 
-    @property
-    def head(self):
+    def get_head(self):
         return self.client.shell.head.metadata()['level_info']['level']
 
     def get_address(self):
@@ -47,9 +206,13 @@ class TezosProvider(Provider):
             self.client.account(address or self.get_address())['balance']
         )
 
-    def index_level(self, level):
-        block = self.client.shell.blocks[level]
-        for ops in block.operations():
+    def get_block(self, level):
+        return self.client.shell.blocks[level].operations()
+
+    def index_level(self, level, block=None):
+        if block is None:
+            block = self.get_block(level)
+        for ops in block:
             for number, op in enumerate(ops):
                 for content in op.get('contents', []):
                     self.index_content(level, number, op, content)
@@ -107,11 +270,14 @@ class TezosProvider(Provider):
         contract.gas = content['fee']
         contract.metadata = content
         contract.number = number
-        contract.sender, _ = self.blockchain.account_set.get_or_create(
-            address=op['contents'][0]['source'],
-            blockchain=self.blockchain,
+        if not contract.code_id and 'script' in content:
+            # no need to fetch the code from the node
+            contract.micheline = content['script']['code']
+        contract.sender = self.get_account(
+            op['contents'][0]['source'],
+            index=True,
         )
-        contract.state_set('done')
+        self.index_save(contract)
 
     def is_implicit_contract(self, address):
         return len(address) == 36 and address[:2] == 'tz'
@@ -126,6 +292,10 @@ class TezosProvider(Provider):
                 address=originated_address,
                 blockchain=self.blockchain,
                 caller=caller,
+                # no need to fetch the code from the node
+                defaults=dict(
+                    micheline=content.get('script', {}).get('code', None),
+                ),
             )
             contract.level = level
             contract.hash = hash
@@ -134,26 +304,11 @@ class TezosProvider(Provider):
             contract.nonce = content.get('nonce', -1)
             contract.sender = self.get_account(content['source'])
             contract.number = number
-            contract.state_set('done')
+            self.index_save(contract)
             originated_contracts.append(contract)
 
         return originated_contracts
 
-    def get_account(self, address):
-        sender = Account.objects.filter(
-            address=address,
-            blockchain=self.blockchain,
-        ).first()
-
-        if not sender:
-            sender = Account.objects.create(
-                address=address,
-                blockchain=self.blockchain,
-                index=False,
-            )
-
-        return sender
-
     def index_transaction(self, level, hash, content, caller=None,
                           number=None):
         self.logger.info(f'Syncing transaction {hash}')
@@ -166,10 +321,7 @@ class TezosProvider(Provider):
         if self.is_implicit_contract(destination_address):
             # this transaction targets an account
             contract = None
-            receiver, _ = Account.objects.get_or_create(
-                blockchain=self.blockchain,
-                address=destination_address,
-            )
+            receiver = self.get_account(destination_address, index=True)
             qs = receiver.transaction_received
         else:
             # this transaction targets a contract
@@ -230,7 +382,7 @@ class TezosProvider(Provider):
                     call.args = args[call.function]
 
         # save and return call
-        call.state_set('done')
+        self.index_save(call)
 
         return call
 
@@ -285,10 +437,7 @@ class TezosProvider(Provider):
               'id': 'proto.006-PsCARTHA.contract.balance_too_low',
               'kind': 'temporary'},)
         """
-        tx = self.client.transaction(
-            destination=transaction.receiver.address,
-            amount=transaction.amount,
-        ).autofill().sign()
+        tx = self.get_transfer(transaction).autofill().sign()
         result = self.write_transaction(tx, transaction)
         return result
 
@@ -306,22 +455,31 @@ class TezosProvider(Provider):
                 if not exc.args[0]['id'].endswith('previously_revealed_key'):
                     raise
             self.wallet.revealed = True
-            self.wallet.save()
+            self.wallet.save(update_fields=('revealed', 'updated_at'))
 
         self.logger.debug(f'{transaction}.deploy(): start')
         if transaction.kind == 'contract':
             self.originate(transaction)
+        elif (
+            transaction.kind in ('function', 'transfer')
+            and self.send_bulk(transaction)
+        ):
+            pass
         elif transaction.kind == 'function':
             self.send(transaction)
         elif transaction.kind == 'transfer':
             self.transfer(transaction)
         else:
             transaction.error = f'Unknown transaction kind {transaction.kind}'
-            transaction.state_set('failed')
+            transaction.state_set(
+                'failed',
+                provider=self,
+                update_fields=('error',),
+            )
             return
 
         transaction.sender.last_level = self.head
-        transaction.sender.save()
+        transaction.sender.save(update_fields=('last_level', 'updated_at'))
         self.logger.info(f'{transaction}.deploy(): success')
 
     def originate(self, transaction):
@@ -333,19 +491,29 @@ class TezosProvider(Provider):
         self.write_transaction(tx, transaction)
 
     def write_transaction(self, tx, transaction):
+        self.write_transactions(tx, [transaction])
+
+    def write_transactions(self, tx, transactions):
+        """
+        Inject an operation group and save the hash of each transaction, with
+        the counter of its content, so that the indexer can tell them apart.
+        """
         origination = tx.inject(
             _async=False,
         )
-        transaction.level = self.head + 1  # it'll be in the next block
-        transaction.gas = origination['contents'][0]['fee']
-        transaction.hash = origination['hash']
-        transaction.counter = origination['contents'][0]['counter']
-        transaction.save()
-
-    def send(self, transaction):
-        self.logger.debug(
-            f'{transaction}: counter = {self.client.account()["counter"]}'
-        )
+        for transaction, content in zip(transactions, origination['contents']):
+            transaction.level = self.head + 1  # it'll be in the next block
+            transaction.gas = content['fee']
+            transaction.hash = origination['hash']
+            transaction.counter = content['counter']
+            transaction.save(update_fields=(
+                'level', 'gas', 'hash', 'counter', 'updated_at',
+            ))
+
+    def get_call(self, transaction):
+        """
+        Return the pytezos contract call of a function transaction.
+        """
         ci = self.client.contract(transaction.contract.address)
         method = getattr(ci, transaction.function)
         try:
@@ -358,121 +526,243 @@ class TezosProvider(Provider):
                 tx = tx.with_amount(transaction.amount)
         except ValueError as e:
             raise PermanentError(*e.args)
-        self.write_transaction(tx, transaction)
+        return tx
+
+    def get_transfer(self, transaction):
+        """
+        Return the pytezos operation group of a transfer transaction.
+        """
+        return self.client.transaction(
+            destination=transaction.receiver.address,
+            amount=transaction.amount,
+        )
+
+    def send(self, transaction):
+        self.logger.debug(
+            f'{transaction}: counter = {self.client.account()["counter"]}'
+        )
+        self.write_transaction(self.get_call(transaction), transaction)
+
+    def send_bulk(self, transaction):
+        """
+        Deploy a call or transfer together with the next pending calls and
+        transfers of the same sender, in a single operation group.
+
+        Transactions that fail to encode are left for a deploy of their own.
+        Return False if :py:attr:`spool_bulk` leaves no room for other
+        transactions, or if there are none.
+        """
+        limit = self.blockchain.configuration.get(
+            'spool_bulk',
+            self.spool_bulk,
+        ) - 1
+        if limit < 1:
+            return False
+
+        others = sorted(
+            [
+                *self.spool_calls().filter(
+                    sender=transaction.sender,
+                    last_fail=None,
+                ).exclude(pk=transaction.pk)[:limit],
+                *self.spool_transfers().filter(
+                    sender=transaction.sender,
+                    last_fail=None,
+                ).exclude(pk=transaction.pk)[:limit],
+            ],
+            key=lambda other: other.created_at,
+        )[:limit]
+
+        transactions, operations = [], []
+        for member in [transaction, *others]:
+            try:
+                if member.kind == 'function':
+                    operations.append(self.get_call(member))
+                else:
+                    operations.append(self.get_transfer(member))
+            except PermanentError:
+                if member is transaction:
+                    raise
+                self.logger.exception(f'{member}: left out of bulk')
+                continue
+            transactions.append(member)
+
+        if len(transactions) < 2:
+            return False
+
+        self.logger.info(f'{transaction}: bulk of {len(transactions)}')
+        tx = self.client.bulk(*operations).autofill().sign()
+        self.write_transactions(tx, transactions)
+        for member in transactions[1:]:
+            member.last_fail = None
+            member.error = ''
+            member.state_set(
+                'done',
+                provider=self,
+                update_fields=('last_fail', 'error'),
+            )
+        return True
 
     def download(self, target):
         """
-        Import transactions from tzkt for a contract
+        Import transactions from tzkt for a contract.
+
+        Operations are streamed by pages of :py:attr:`download_limit`
+        following the tzkt ``id`` cursor, each page is saved in a single
+        database transaction.
+
+        The tzkt operation of every imported call is kept in
+        :py:attr:`~djwebdapp.models.Transaction.metadata`, so the last
+        imported id is the checkpoint from which an interrupted download
+        resumes.
         """
         api = self.blockchain.configuration.get(
             'tzkt_url',
             'https://api.tzkt.io',  # default indexer?
         )
-        url = f'{api}/v1/operations/transactions?'
-        url += f'&target={urllib.parse.quote(target)}'
-        url += f'&level.le={self.head - 1}'
+        limit = self.blockchain.configuration.get(
+            'download_limit',
+            self.download_limit,
+        )
 
         contract, _ = self.transaction_class.objects.get_or_create(
             blockchain=self.blockchain,
             address=target,
         )
 
-        def get(offset, limit):
-            return requests.get(url + f'&offset={offset}&limit={limit}').json()
-
-        def yield_operations():
-            offset = 0
-            limit = 10_000
-            while data := get(offset, limit):
-                for operation in data:
-                    if operation['type'] != 'transaction':
-                        continue
-
-                    if operation['status'] != 'applied':
-                        continue
-
-                    yield operation
-                offset += limit
+        cursor = self.download_cursor(contract)
+        self.logger.info(f'Downloading {target} from {api} after {cursor}')
 
+        session = get_session(api)
+        level = self.head - 1
         total = 0
-        operations = dict()
-        for operation in yield_operations():
-            total += 1
-
-            # generate a key for the operation group
-            key = (
-                operation['level'],
-                operation['hash'],
-                operation['counter'],
-                operation.get('nonce', 0),
+        while True:
+            response = session.get(
+                f'{api}/v1/operations/transactions',
+                params={
+                    'target': target,
+                    'level.le': level,
+                    'id.gt': cursor,
+                    'sort.asc': 'id',
+                    'limit': limit,
+                },
             )
+            response.raise_for_status()
+            page = response.json()
+            if not page:
+                break
 
-            operations[key] = operation
+            with db_transaction.atomic():
+                total += self.download_page(contract, page)
+            cursor = page[-1]['id']
+            self.logger.debug(f'Downloaded {total} calls until {cursor}')
 
-        # disable automatic refresh of balances to speed up the whole process
-        signals.pre_save.disconnect(account_setup, sender=Account)
-        # we're also going to cache Account objects
-        accounts = dict()
+        return total
 
-        # fetch all calls we already have in DB
-        calls = {
-            (call.level, call.hash, call.counter, call.nonce): call
-            for call in self.transaction_class.objects.filter(
+    def download_cursor(self, contract):
+        """
+        Return the tzkt id of the last call imported by :py:meth:`download()`
+        for a contract, 0 if none.
+        """
+        return self.transaction_class.objects.filter(
+            contract=contract,
+            metadata__has_key='id',
+        ).aggregate(
+            cursor=Max(Cast(
+                KeyTextTransform('id', 'metadata'),
+                BigIntegerField(),
+            )),
+        )['cursor'] or 0
+
+    def download_page(self, contract, page):
+        """
+        Save the applied calls of a page of tzkt operations, return how many
+        were created.
+
+        Calls that are already in the database are skipped, and the
+        accounts of the page are queried and created at once.
+        """
+        operations = [
+            operation for operation in page
+            if operation['type'] == 'transaction'
+            and operation['status'] == 'applied'
+        ]
+        if not operations:
+            return 0
+
+        # calls we already have in DB
+        calls = set(
+            self.transaction_class.objects.filter(
                 contract=contract,
+                hash__in={operation['hash'] for operation in operations},
                 state__in=('confirm', 'done'),
+            ).values_list('level', 'hash', 'counter', 'nonce')
+        )
+
+        addresses = {
+            operation['sender']['address'] for operation in operations
+        }
+        accounts = {
+            account.address: account
+            for account in Account.objects.filter(
+                blockchain=self.blockchain,
+                address__in=addresses,
             )
         }
+        if addresses - set(accounts):
+            # bulk_create does not trigger the balance refresh of
+            # account_setup, which would slow down the whole process
+            Account.objects.bulk_create(
+                [
+                    Account(address=address, blockchain=self.blockchain)
+                    for address in addresses - set(accounts)
+                ],
+                ignore_conflicts=True,
+            )
+            accounts = {
+                account.address: account
+                for account in Account.objects.filter(
+                    blockchain=self.blockchain,
+                    address__in=addresses,
+                )
+            }
 
-        number = 0
-        for key in sorted(operations.keys()):
-            number += 1
-            level, hash, counter, nonce = key
-            self.logger.debug(' '.join((
-                f'[{number}/{total}]',
-                hash,
-                f'level={level}',
-                f'counter={counter}',
-                f'nonce={nonce if isinstance(nonce, int) else -1}',
-            )))
-
+        created = 0
+        for operation in operations:
+            nonce = operation.get('nonce', None)
+            nonce = nonce if isinstance(nonce, int) else -1
+            key = (
+                operation['level'],
+                operation['hash'],
+                operation['counter'],
+                nonce,
+            )
             if key in calls:
                 continue  # let's not update for now
 
-            operation = operations[key]
-
-            if operation['sender']['address'] in accounts:
-                sender = accounts[operation['sender']['address']]
-            else:
-                sender, _ = Account.objects.get_or_create(
-                    address=operation['sender']['address'],
-                    blockchain=self.blockchain,
-                )
-                accounts[sender.address] = sender
-
-            function = operation['parameter']['entrypoint']
             args = operation['parameter']['value']
-
-            for key, value in args.items():
-                try:
-                    args[key] = int(value)
-                except ValueError:
-                    continue
+            if isinstance(args, dict):
+                for name, value in args.items():
+                    try:
+                        args[name] = int(value)
+                    except (TypeError, ValueError):
+                        continue
 
             call = self.transaction_class(
                 blockchain=self.blockchain,
                 contract=contract,
-                sender=sender,
-                level=level,
-                hash=hash,
-                counter=counter,
-                nonce=nonce if isinstance(nonce, int) else -1,
+                sender=accounts[operation['sender']['address']],
+                level=operation['level'],
+                hash=operation['hash'],
+                counter=operation['counter'],
+                nonce=nonce,
                 kind='call',
-                function=function,
+                function=operation['parameter']['entrypoint'],
                 args=args,
                 metadata=operation,
                 gas=operation['gasUsed'],
             )
-            call.state_set('done')
-
-        # reconnect Account signal
-        signals.pre_save.connect(account_setup, sender=Account)
+            # bulk_create does not support multi-table inheritance
+            call.state_set('done', provider=self)
+            created += 1
+        return created
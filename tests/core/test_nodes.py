@@ -0,0 +1,169 @@
+import json
+import urllib.request
+from multiprocessing import get_context
+
+import pytest
+import requests
+
+from djwebdapp import nodes
+from djwebdapp.models import SETTINGS
+from djwebdapp.nodes import NodeBehind, NodePool, get_session
+
+
+def get(endpoint):
+    with urllib.request.urlopen(endpoint, timeout=1) as response:
+        return json.loads(response.read())
+
+
+def counting_server(http_stub, name, hits):
+    def handler(method, path, body):
+        hits.append(name)
+        return 200, name
+    return http_stub(handler)
+
+
+def test_failover_priority(http_stub, http_dead):
+    hits = []
+    live = counting_server(http_stub, 'live', hits)
+    pool = NodePool([(live, 0), (http_dead, 10)], max_errors=2)
+    assert pool.primary == http_dead
+
+    assert pool.request(get) == 'live'
+    dead = pool.nodes[0]
+    assert dead.endpoint == http_dead
+    assert dead.errors == 1
+    assert dead.healthy
+
+    assert pool.request(get) == 'live'
+    assert dead.errors == 2
+    assert not dead.healthy
+    assert pool.primary == live
+    assert pool.nodes[1].latency is not None
+
+
+def test_circuit_half_open(http_stub, http_dead):
+    hits = []
+    live = counting_server(http_stub, 'live', hits)
+    pool = NodePool([(http_dead, 10)], max_errors=1, cooldown=0)
+    with pytest.raises(OSError):
+        pool.request(get)
+
+    # node comes back after cooldown and closes its circuit on success
+    pool.nodes[0].endpoint = live
+    assert pool.request(get) == 'live'
+    assert pool.nodes[0].errors == 0
+    assert pool.nodes[0].healthy
+
+
+def status_server(http_stub, status, hits):
+    def handler(method, path, body):
+        hits.append(status)
+        return status, status
+    return http_stub(handler)
+
+
+def test_client_errors(http_stub):
+    def request(endpoint):
+        response = get_session(endpoint).get(endpoint, timeout=1)
+        response.raise_for_status()
+        return response.json()
+
+    hits = []
+    invalid = status_server(http_stub, 400, hits)
+    pool = NodePool([(invalid, 10), (status_server(http_stub, 200, hits), 0)])
+
+    # an invalid query is raised right away, the node is not failing
+    with pytest.raises(requests.HTTPError):
+        pool.request(request)
+    assert hits == [400]
+    assert pool.nodes[0].errors == 0
+    assert pool.nodes[0].healthy
+    assert pool.nodes[0].latency is None
+
+    # server errors fail over
+    pool.nodes[0].endpoint = status_server(http_stub, 503, hits)
+    hits.clear()
+    assert pool.request(request) == 200
+    assert hits == [503, 200]
+    assert pool.nodes[0].errors == 1
+
+
+def test_spread(http_stub):
+    hits = []
+    first = counting_server(http_stub, 'first', hits)
+    second = counting_server(http_stub, 'second', hits)
+    pool = NodePool([(first, 2), (second, 1)])
+
+    for i in range(4):
+        pool.request(get)
+    assert hits == ['first'] * 4
+
+    hits.clear()
+    for i in range(4):
+        pool.request(get, spread=True)
+    assert sorted(hits) == ['first', 'first', 'second', 'second']
+
+
+def test_behind():
+    pool = NodePool([('a', 1), ('b', 0)])
+
+    def request(endpoint):
+        if endpoint == 'a':
+            raise NodeBehind(None)
+        return endpoint
+
+    assert pool.request(request) == 'b'
+    assert pool.nodes[0].errors == 0
+
+    def request(endpoint):
+        raise NodeBehind(KeyError(endpoint))
+
+    with pytest.raises(KeyError):
+        pool.request(request)
+
+
+def test_check(http_stub, http_dead):
+    live = http_stub(lambda method, path, body: (200, 'ok'))
+    pool = NodePool([(live, 0), (http_dead, 0)], max_errors=1)
+    pool.check(get)
+    assert pool.nodes[0].healthy
+    assert not pool.nodes[1].healthy
+
+
+@pytest.mark.django_db
+def test_for_blockchain(blockchain):
+    blockchain.configuration = dict(node_max_errors=5)
+    blockchain.node_set.create(endpoint='http://low', priority=0)
+    blockchain.node_set.create(endpoint='http://high', priority=2)
+    blockchain.node_set.create(
+        endpoint='http://inactive',
+        priority=3,
+        is_active=False,
+    )
+
+    pool = NodePool.for_blockchain(blockchain)
+    assert [node.endpoint for node in pool.nodes] == [
+        'http://high',
+        'http://low',
+    ]
+    assert pool.max_errors == 5
+
+
+def sessions_count():
+    return len(nodes.sessions)
+
+
+def test_get_session(http_stub):
+    endpoint = http_stub(lambda method, path, body: (200, 'ok'))
+    session = get_session(endpoint)
+    assert get_session(endpoint) is session
+    assert get_session('http://other') is not session
+    assert session.get_adapter(endpoint)._pool_maxsize == (
+        SETTINGS['HTTP_POOL_MAXSIZE']
+    )
+    assert session.get(endpoint).json() == 'ok'
+
+    # forked workers must not share connections with their parent
+    with get_context('fork').Pool(1) as pool:
+        assert pool.apply(sessions_count) == 0
+    assert sessions_count()
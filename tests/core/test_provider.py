@@ -1,6 +1,18 @@
+import os
+import threading
+import time
+
 import pytest
 
-from djwebdapp.models import Account, Blockchain, Transaction
+from django.db import connection
+
+from djwebdapp.models import Account, Blockchain, Node, Transaction
+from djwebdapp.provider import (
+    DeployPool,
+    Success,
+    clients,
+    get_calls_distinct_sender,
+)
 
 
 @pytest.mark.django_db
@@ -70,3 +82,544 @@ def test_excluded_states():
     # one TezosTransaction has an address, so `spool_contracts` only
     # returns 3
     assert len(provider.spool_contracts()) == 3
+
+
+class IndexProvider(Success):
+    transaction_class = Transaction
+
+
+def index_provider(blockchain, hashes):
+    Transaction.objects.bulk_create([
+        Transaction(
+            blockchain=blockchain,
+            hash=f'hash{number}',
+            level=number,
+            state='confirm',
+        )
+        for number in range(hashes)
+    ])
+    provider = IndexProvider(blockchain=blockchain)
+    provider.index_init()
+    return provider
+
+
+@pytest.mark.django_db
+def test_index_init_lookups(blockchain):
+    contract = Transaction.objects.create(
+        blockchain=blockchain,
+        kind='contract',
+        address='KT1',
+        state='done',
+    )
+    provider = index_provider(blockchain, 3)
+
+    assert provider.hashes == {'hash0': 0, 'hash1': 1, 'hash2': 2}
+    assert provider.check_hash('hash1')
+    assert not provider.check_hash('unknown')
+    assert provider.addresses == {'KT1': contract.id}
+    with pytest.raises(TypeError):
+        provider.hashes['new'] = 1
+
+
+class Probe(str):
+    """
+    Operation hash which counts the comparisons made to match it.
+    """
+    comparisons = 0
+
+    def __eq__(self, other):
+        Probe.comparisons += 1
+        return super().__eq__(other)
+
+    __hash__ = str.__hash__
+
+
+@pytest.mark.django_db
+def test_index_init_lookup_comparisons(blockchain):
+    def block_comparisons(provider):
+        # simulate matching the operations of a 1000 operation block
+        Probe.comparisons = 0
+        for number in range(1000):
+            op = Probe(f'op{number}')
+            provider.check_hash(op) or op in provider.addresses
+        return Probe.comparisons
+
+    small = block_comparisons(index_provider(blockchain, 10))
+    Transaction.objects.all().delete()
+    large = block_comparisons(index_provider(blockchain, 20_000))
+
+    # per-block cost must not grow with the number of tracked hashes, only
+    # hash collisions may cost a comparison
+    assert large <= small + 10
+    assert large < 1000
+
+
+class PrefetchProvider(IndexProvider):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.indexed = []
+        self.fetching = 0
+        self.max_fetching = 0
+
+    def get_head(self):
+        return 20
+
+    def get_block(self, level):
+        self.fetching += 1
+        self.max_fetching = max(self.max_fetching, self.fetching)
+        # later levels answer faster, to shuffle completion order
+        time.sleep(.001 * (20 - level))
+        self.fetching -= 1
+        return f'block{level}'
+
+    def index_level(self, level, block=None):
+        self.indexed.append((level, block or self.get_block(level)))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('prefetch', (0, 4))
+def test_index_prefetch(blockchain, prefetch):
+    blockchain.configuration['index_prefetch'] = prefetch
+    blockchain.index_level = 3
+    blockchain.save()
+
+    provider = PrefetchProvider(blockchain=blockchain)
+    provider.index()
+
+    assert provider.indexed == [
+        (level, f'block{level}') for level in range(3, 21)
+    ]
+    assert (provider.max_fetching > 1) == bool(prefetch)
+    assert provider.max_fetching <= 4
+    blockchain.refresh_from_db()
+    assert blockchain.index_level == 20
+
+
+class HeadProvider(IndexProvider):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.head_queries = 0
+
+    def get_head(self):
+        self.head_queries += 1
+        return min(10 + self.head_queries, 15)
+
+
+@pytest.mark.django_db
+def test_head_cache(blockchain):
+    provider = HeadProvider(blockchain=blockchain)
+    assert provider.head == 11
+    assert provider.head == 11
+    assert provider.head_queries == 1
+
+    assert provider.head_refresh() == 12
+    assert provider.head == 12
+
+    blockchain.configuration['head_ttl'] = 0
+    assert provider.head == 13
+    assert provider.head == 14
+
+
+@pytest.mark.django_db
+def test_index_head_queries(blockchain):
+    blockchain.index_level = 3
+    blockchain.save()
+
+    provider = HeadProvider(blockchain=blockchain)
+    provider.index_level = lambda level, block: None
+    provider.index()
+
+    # one query for reorg, then one each time the known head is reached
+    assert blockchain.index_level == 15
+    assert provider.head_queries == 6
+
+
+class AtomicProvider(IndexProvider):
+    fail_level = None
+
+    def get_head(self):
+        return 15
+
+    def index_level(self, level, block=None):
+        for transaction in Transaction.objects.filter(level=level):
+            transaction.gas = level
+            self.index_save(transaction, 'held')
+        self.index_save(
+            Transaction(
+                blockchain=self.blockchain,
+                hash=f'new{level}',
+                level=level,
+            ),
+            'held',
+        )
+        if level == self.fail_level:
+            raise Exception('Indexer crash')
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('atomic_levels', (1, 2))
+def test_index_atomic_levels(blockchain, atomic_levels):
+    blockchain.index_level = 10
+    blockchain.configuration['index_atomic_levels'] = atomic_levels
+    blockchain.save()
+    for level in range(10, 16):
+        Transaction.objects.create(
+            blockchain=blockchain,
+            hash=f'hash{level}',
+            level=level,
+        )
+
+    provider = AtomicProvider(blockchain=blockchain)
+    provider.fail_level = 13
+    with pytest.raises(Exception):
+        provider.index()
+
+    # levels of the group that crashed were rolled back
+    last_level = 12 if atomic_levels == 1 else 11
+    blockchain.refresh_from_db()
+    assert blockchain.index_level == last_level
+    assert [*Transaction.objects.filter(
+        state='held',
+        hash__startswith='hash',
+    ).order_by('level').values_list('level', 'gas')] == [
+        (level, level) for level in range(10, last_level + 1)
+    ]
+    assert Transaction.objects.filter(
+        hash__startswith='new',
+    ).count() == last_level - 9
+
+    provider = AtomicProvider(blockchain=blockchain)
+    provider.index()
+    blockchain.refresh_from_db()
+    assert blockchain.index_level == 15
+    assert [*Transaction.objects.filter(
+        state='held',
+        hash__startswith='hash',
+    ).order_by('level').values_list('level', 'gas')] == [
+        (level, level) for level in range(10, 16)
+    ]
+
+
+@pytest.mark.django_db
+def test_index_save_no_extra_provider(blockchain, monkeypatch):
+    provider = HeadProvider(blockchain=blockchain)
+    provider.index_init()
+    monkeypatch.setattr(
+        Blockchain,
+        'provider',
+        property(lambda self: pytest.fail('new provider instanciated')),
+    )
+
+    for level in range(11):
+        provider.index_save(Transaction(
+            blockchain=blockchain,
+            hash=f'hash{level}',
+            level=level,
+        ))
+
+    assert provider.head_queries == 1
+    assert [*Transaction.objects.order_by('level').values_list(
+        'state',
+        flat=True,
+    )] == ['done'] * 10 + ['confirm']
+
+
+@pytest.mark.django_db
+def test_index_save_signals(blockchain, django_assert_num_queries):
+    from django.db.models import signals
+
+    contract = Transaction.objects.create(
+        blockchain=blockchain,
+        kind='contract',
+        state='confirm',
+        level=1,
+    )
+    calls = [
+        Transaction.objects.create(
+            blockchain=blockchain,
+            function='mint',
+            state='confirm',
+            level=1,
+        )
+        for i in range(2)
+    ]
+    saved = []
+
+    def receiver(sender, instance, update_fields, **kwargs):
+        saved.append((instance.pk, update_fields))
+
+    signals.post_save.connect(receiver, sender=Transaction)
+    try:
+        provider = HeadProvider(blockchain=blockchain)
+        provider.index_init()
+        contract.address = 'KT1'
+        contract.code_set({'code': 'contract'})
+        provider.index_save(contract)
+        for call in calls:
+            call.gas = 2
+            provider.index_save(call)
+
+        # rows which code changed are saved right away
+        [(pk, update_fields)] = saved
+        assert pk == contract.pk
+        assert {'address', 'state', 'code'} <= update_fields
+        assert 'description' not in update_fields
+
+        # others are written at once, with their signals
+        with django_assert_num_queries(1):
+            provider.index_flush()
+    finally:
+        signals.post_save.disconnect(receiver, sender=Transaction)
+
+    assert saved[1:] == [
+        (call.pk, frozenset(provider.index_update_fields)) for call in calls
+    ]
+    contract.refresh_from_db()
+    assert contract.address == 'KT1'
+    assert contract.code_get() == {'code': 'contract'}
+    assert [*Transaction.objects.filter(
+        function='mint',
+    ).values_list('gas', 'state')] == [(2, 'done')] * 2
+
+
+class ClientProvider(Success):
+    def get_client(self):
+        return object()
+
+
+@pytest.mark.django_db
+def test_client_registry(blockchain, account):
+    blockchain.provider_class = 'tests.core.test_provider.ClientProvider'
+    blockchain.save()
+    assert blockchain.provider_cls is blockchain.provider_cls
+    assert blockchain.provider_cls.__name__ == 'ClientProvider'
+
+    client = blockchain.provider.client
+    assert blockchain.provider.client is client
+    assert Blockchain.objects.get(pk=blockchain.pk).provider.client is client
+
+    # wallet providers have their own client
+    wallet_client = account.provider.client
+    assert wallet_client is not client
+    assert account.provider.client is wallet_client
+
+    # saving the blockchain without changing configuration keeps clients
+    blockchain.save()
+    assert blockchain.provider.client is client
+
+    blockchain.configuration['foo'] = 'bar'
+    assert blockchain.provider.client is not client
+    client = blockchain.provider.client
+
+    blockchain.node_set.create(endpoint='http://localhost')
+    assert blockchain.provider.client is not client
+    assert account.provider.client is not wallet_client
+
+
+class LockedClientProvider(Success):
+    def get_client(self):
+        # clients are built outside of the registry lock
+        assert not clients.lock.locked()
+        return object()
+
+
+@pytest.mark.django_db
+def test_client_provider_cache(blockchain, monkeypatch):
+    blockchain.provider_class = 'tests.core.test_provider.LockedClientProvider'
+    blockchain.save()
+    provider = blockchain.provider
+    client = provider.client
+
+    # the provider keeps its client without going through the registry
+    monkeypatch.setattr(
+        clients,
+        'get',
+        lambda provider: pytest.fail('registry queried again'),
+    )
+    assert provider.client is client
+    monkeypatch.undo()
+
+    # until the nodes of the blockchain change
+    blockchain.node_set.create(endpoint='http://localhost')
+    assert provider.client is not client
+    client = provider.client
+
+    # even without signals, ie. from another process
+    Node.objects.update(is_active=False)
+    assert provider.client is client
+    monkeypatch.setattr(clients, 'nodes_ttl', 0)
+    assert provider.client is not client
+    client = provider.client
+    assert provider.client is client
+
+
+def worker_id(arg):
+    return os.getpid(), threading.get_ident()
+
+
+@pytest.mark.parametrize('kind', ['process', 'thread'])
+def test_deploy_pool(kind):
+    pool = DeployPool(2, kind)
+    first = set(pool.map(worker_id, range(8)))
+    second = set(pool.map(worker_id, range(8)))
+    # workers are started once and reused
+    assert len(first | second) <= 2
+    assert (os.getpid() not in dict(first)) == (kind == 'process')
+
+    pool.close()
+    assert pool.pool is None
+    # started again when needed
+    assert len(pool.map(worker_id, range(2))) == 2
+    assert pool.pool is not None
+    pool.close()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_spool_calls_update_fields(blockchain, monkeypatch):
+    from django.db.models import signals
+
+    from djwebdapp import provider as provider_module
+    from djwebdapp_tezos.models import TezosTransaction
+
+    def deploy(self, transaction):
+        transaction.hash = f'hash-{transaction.function}'
+        transaction.level = self.head
+
+    monkeypatch.setattr(
+        Success, 'transaction_class', TezosTransaction, raising=False
+    )
+    monkeypatch.setattr(Success, 'get_head', lambda self: 1)
+    monkeypatch.setattr(Success, 'deploy', deploy)
+    # one worker thread, as sqlite fails concurrent writers
+    pool = DeployPool(1, 'thread')
+    monkeypatch.setattr(provider_module, 'get_deploy_pool', lambda: pool)
+
+    contract = TezosTransaction.objects.create(
+        blockchain=blockchain,
+        address='KT1',
+        micheline=[dict(prim='code')],
+        state='done',
+    )
+    calls = [
+        TezosTransaction.objects.create(
+            blockchain=blockchain,
+            sender=Account.objects.create(
+                blockchain=blockchain,
+                address=str(i),
+            ),
+            contract=contract,
+            function=f'foo{i}',
+        )
+        for i in range(2)
+    ]
+
+    saves = []
+
+    def saved(sender, instance, update_fields, **kwargs):
+        if isinstance(instance, Transaction):
+            saves.append(update_fields)
+
+    signals.post_save.connect(saved)
+    try:
+        assert blockchain.provider.spool() == calls
+    finally:
+        signals.post_save.disconnect(saved)
+        pool.close()
+
+    # only deploy() saves the calls, with their fields
+    fields = {
+        'state', 'history', 'updated_at', 'last_fail', 'error',
+        *Success.deploy_update_fields,
+    }
+    assert len(saves) == 4
+    assert all(update_fields <= fields for update_fields in saves)
+    for call in calls:
+        call.refresh_from_db()
+        assert call.hash == f'hash-{call.function}'
+        assert call.level == 1
+
+
+@pytest.mark.django_db
+def test_calls_distinct_sender(blockchain, django_assert_num_queries):
+    senders = [
+        Account.objects.create(blockchain=blockchain, address=str(i))
+        for i in range(3)
+    ]
+    calls = [
+        Transaction.objects.create(
+            blockchain=blockchain,
+            sender=senders[i % 3],
+            function=f'foo{i}',
+        )
+        for i in range(9)
+    ]
+    calls_qs = Transaction.objects.order_by('created_at')
+
+    with django_assert_num_queries(1):
+        distinct_calls = get_calls_distinct_sender(calls_qs, 10)
+        assert [call.sender for call in distinct_calls] == senders
+    assert distinct_calls == calls[:3]
+
+    assert get_calls_distinct_sender(calls_qs, 2) == calls[:2]
+
+    newest = get_calls_distinct_sender(calls_qs.order_by('-created_at'), 10)
+    assert newest == calls[-1:-4:-1]
+
+    subclasses = get_calls_distinct_sender(
+        calls_qs.select_related('blockchain').select_subclasses(),
+        10,
+    )
+    assert subclasses == calls[:3]
+
+
+def distinct_sender_calls(blockchain):
+    from djwebdapp_tezos.models import TezosTransaction
+
+    senders = [
+        Account.objects.create(blockchain=blockchain, address=str(i))
+        for i in range(3)
+    ]
+    return [
+        TezosTransaction.objects.create(
+            blockchain=blockchain,
+            sender=senders[i % 3],
+            function=f'foo{i}',
+            level=None if i < 3 else i,
+        )
+        for i in range(9)
+    ]
+
+
+@pytest.mark.django_db
+def test_calls_distinct_sender_expressions(blockchain):
+    from django.db.models import F
+
+    calls = distinct_sender_calls(blockchain)
+    calls_qs = Transaction.objects.order_by(
+        F('level').desc(nulls_last=True),
+        F('created_at'),
+    ).select_subclasses()
+
+    distinct_calls = get_calls_distinct_sender(calls_qs, 10)
+    assert distinct_calls == calls[-1:-4:-1]
+    assert type(distinct_calls[0]).__name__ == 'TezosTransaction'
+
+
+@pytest.mark.django_db
+@pytest.mark.skipif(
+    not connection.features.can_distinct_on_fields,
+    reason='DISTINCT ON is not supported by this database',
+)
+def test_calls_distinct_sender_distinct_on(blockchain):
+    from django.test.utils import CaptureQueriesContext
+
+    calls = distinct_sender_calls(blockchain)
+    calls_qs = Transaction.objects.filter(
+        blockchain=blockchain,
+    ).order_by('-created_at').select_subclasses()
+
+    with CaptureQueriesContext(connection) as queries:
+        distinct_calls = get_calls_distinct_sender(calls_qs, 10)
+    assert 'DISTINCT ON' in queries.captured_queries[0]['sql']
+    assert distinct_calls == calls[-1:-4:-1]
+    assert type(distinct_calls[0]).__name__ == 'TezosTransaction'
@@ -0,0 +1,59 @@
+import pytest
+
+from djwebdapp.models import Blockchain
+from djwebdapp_ethereum.provider import EthereumProvider
+
+
+@pytest.mark.django_db
+def test_get_fees(http_stub):
+    batches = []
+    head = [10]
+
+    def result(request):
+        results = dict(
+            eth_blockNumber=hex(head[0]),
+            eth_gasPrice=hex(30),
+            eth_maxPriorityFeePerGas=hex(2),
+            eth_getBlockByNumber=dict(baseFeePerGas=hex(head[0])),
+            eth_chainId=hex(1337),
+        )
+        return dict(
+            jsonrpc='2.0',
+            id=request['id'],
+            result=results[request['method']],
+        )
+
+    def handler(method, path, body):
+        if isinstance(body, list):
+            batches.append([request['method'] for request in body])
+            return 200, [result(request) for request in reversed(body)]
+        return 200, result(body)
+
+    blockchain = Blockchain.objects.create(
+        name='ethstub',
+        provider_class='djwebdapp_ethereum.provider.EthereumProvider',
+    )
+    blockchain.node_set.create(endpoint=http_stub(handler))
+    provider = EthereumProvider(blockchain=blockchain)
+
+    assert provider.get_fees() == dict(
+        chain_id=1337,
+        gas_price=30,
+        max_fee=22,
+        max_priority_fee=2,
+    )
+    assert Blockchain.objects.get(pk=blockchain.pk).chain_id == 1337
+    assert len(batches) == 1
+
+    # cached for the level, shared with other providers
+    assert EthereumProvider(blockchain=blockchain).get_fees()['max_fee'] == 22
+    assert len(batches) == 1
+
+    head[0] = 11
+    provider.head_refresh()
+    assert provider.get_fees()['max_fee'] == 24
+    assert batches[1] == [
+        'eth_gasPrice',
+        'eth_maxPriorityFeePerGas',
+        'eth_getBlockByNumber',
+    ]
@@ -0,0 +1,81 @@
+from eth_utils import keccak
+import pytest
+from web3 import Web3
+
+from djwebdapp.models import Blockchain
+from djwebdapp_ethereum.models import EthereumTransaction
+from djwebdapp_ethereum.provider import (
+    EthereumEventProvider,
+    get_event_topics,
+    get_interface,
+    interfaces,
+)
+
+
+def test_interfaces():
+    with open('src/djwebdapp_example_ethereum/contracts/FA12.abi') as f:
+        abi = f.read()
+    address = '0xC5fdf4076b8F3A5357c5E395ab970B5B54098Fef'
+
+    contract = EthereumTransaction(address=address, code_id='fa12')
+    contract.code_get = lambda: dict(abi=abi)
+
+    client = Web3()
+    interface = get_interface(client, contract)
+    assert interface.address == address
+    assert get_interface(client, contract) is interface
+    assert interfaces[('fa12', address)] == (client, interface)
+
+    # rebuilt with a new client, which replaces the stale one
+    other = Web3()
+    assert get_interface(other, contract) is not interface
+    assert interfaces[('fa12', address)][0] is other
+
+    topic = '0x' + keccak(text='Mint(address,uint256)').hex()
+    assert get_event_topics(abi, 'fa12') == {topic: ['Mint']}
+    assert get_event_topics('[]', 'fa12') == {topic: ['Mint']}
+
+    provider = EthereumEventProvider()
+    assert provider.get_contract_event_names(abi, topic) == ['Mint']
+    assert provider.get_contract_event_names(abi, topic, 'fa12') == ['Mint']
+    assert provider.get_contract_event_names(abi, '0x00', 'fa12') == []
+
+
+@pytest.mark.django_db
+def test_index_log_transaction(monkeypatch):
+    from hexbytes import HexBytes
+
+    monkeypatch.setattr(EthereumEventProvider, 'get_head', lambda self: 10)
+    blockchain = Blockchain.objects.create(
+        provider_class='djwebdapp_ethereum.provider.EthereumEventProvider',
+        min_confirmations=0,
+    )
+    # not queried, the log matches no event
+    blockchain.node_set.create(endpoint='http://localhost:1')
+    with open('src/djwebdapp_example_ethereum/contracts/FA12.abi') as f:
+        abi = f.read()
+    contract = EthereumTransaction.objects.create(
+        blockchain=blockchain,
+        kind='contract',
+        address='0xC5fdf4076b8F3A5357c5E395ab970B5B54098Fef',
+        abi=abi,
+        state='done',
+    )
+    provider = blockchain.provider
+    provider.indexed_ids = []
+    provider.log_contracts = {contract.address: contract}
+
+    provider.index_log(dict(
+        address=contract.address,
+        blockNumber=5,
+        topics=[HexBytes('0x00')],
+        transactionHash=HexBytes('0x01'),
+    ))
+    # the transaction that emitted the log is created, not indexed itself
+    transaction = EthereumTransaction.objects.get(hash='0x01')
+    assert transaction.kind == 'function'
+    assert not transaction.index
+    assert transaction.level == 5
+    assert transaction.state == 'done'
+    # and queued for the normalize pipeline
+    assert provider.indexed_ids == [transaction.pk]
@@ -0,0 +1,130 @@
+import pytest
+
+from djwebdapp.models import Account, Blockchain
+from djwebdapp_ethereum.models import EthereumTransaction
+from djwebdapp_ethereum.provider import EthereumProvider
+
+
+@pytest.mark.django_db
+def test_nonce_reserve(http_stub, monkeypatch):
+    counts = []
+    pending = [7]
+
+    def handler(method, path, body):
+        assert body['method'] == 'eth_getTransactionCount'
+        assert body['params'][1] == 'pending'
+        counts.append(body['params'][0])
+        return 200, dict(jsonrpc='2.0', id=body['id'], result=hex(pending[0]))
+
+    blockchain = Blockchain.objects.create(
+        name='ethstub',
+        provider_class='djwebdapp_ethereum.provider.EthereumProvider',
+    )
+    blockchain.node_set.create(endpoint=http_stub(handler))
+    sender = Account.objects.create(
+        blockchain=blockchain,
+        address='0xC5fdf4076b8F3A5357c5E395ab970B5B54098Fef',
+        balance=1,
+    )
+    provider = EthereumProvider(wallet=sender)
+
+    # synchronised from the node once, then reserved from the database
+    assert [provider.nonce_reserve(sender) for i in range(3)] == [7, 8, 9]
+    assert len(counts) == 1
+    assert Account.objects.get(pk=sender.pk).counter == 10
+
+    # refreshing the balance of a stale instance keeps the counter
+    monkeypatch.setattr(EthereumProvider, 'get_balance', lambda s, a: 2)
+    stale = Account.objects.get(pk=sender.pk)
+    assert provider.nonce_reserve(sender) == 10
+    assert stale.refresh_balance() == 2
+    assert Account.objects.get(pk=sender.pk).counter == 11
+
+    # the last nonce is given back
+    provider.nonce_release(sender, 10)
+    assert provider.nonce_reserve(sender) == 10
+
+    # a gap is filled by the next reservation, in flight nonces are kept
+    provider.nonce_release(sender, 8)
+    assert Account.objects.get(pk=sender.pk).nonce_gaps == [8]
+    assert provider.nonce_reserve(sender) == 8
+    assert provider.nonce_reserve(sender) == 11
+    assert len(counts) == 1
+
+    # compare with the node on each reservation from now on
+    monkeypatch.setattr(provider, 'nonce_sync_ttl', 0)
+
+    # the node is ahead, another client used the wallet
+    pending[0] = 14
+    assert provider.nonce_reserve(sender) == 14
+
+    # the node stays behind while the nonce is in flight
+    assert provider.nonce_reserve(sender) == 15
+    transaction = EthereumTransaction.objects.create(
+        blockchain=blockchain,
+        sender=sender,
+        nonce=14,
+        state='retrying',
+    )
+    assert provider.nonce_reserve(sender) == 16
+
+    # the transaction was aborted: reserve its nonce again
+    transaction.state_set('aborted')
+    assert provider.nonce_reserve(sender) == 14
+    assert Account.objects.get(pk=sender.pk).counter == 17
+    assert len(counts) == 5
+
+
+def test_contract_address():
+    provider = EthereumProvider()
+    address = '0x6ac7ea33f8831ea9dcc53393aaa88b25a785dbf0'
+    assert provider.get_contract_address(address, 0) == (
+        '0xcd234A471b72ba2F1Ccf0A70FCABA648a5eeCD8d'
+    )
+    assert provider.get_contract_address(address, 1) == (
+        '0x343c43A37D37dfF08AE8C4A11544c718AbB4fCF8'
+    )
+
+
+@pytest.mark.django_db
+def test_spool_calls_wait_for_contract():
+    blockchain = Blockchain.objects.create(
+        name='ethstub',
+        provider_class='djwebdapp_ethereum.provider.EthereumProvider',
+        min_confirmations=0,
+    )
+    owner, other = [
+        Account.objects.create(
+            blockchain=blockchain,
+            address=f'0x{number}',
+            balance=1,
+        )
+        for number in range(2)
+    ]
+    # sent, done right away without confirmations, but not mined yet
+    contract = EthereumTransaction.objects.create(
+        blockchain=blockchain,
+        sender=owner,
+        kind='contract',
+        hash='0xcontract',
+        address='0xaddress',
+        level=10,
+        state='done',
+    )
+    calls = [
+        EthereumTransaction.objects.create(
+            blockchain=blockchain,
+            sender=sender,
+            contract=contract,
+            function='mint',
+        )
+        for sender in (owner, other)
+    ]
+    provider = blockchain.provider
+
+    # the nonce of the owner orders its calls after the contract
+    assert [*provider.spool_calls()] == calls[:1]
+
+    contract.metadata = dict(blockNumber=11)
+    contract.save()
+    assert [*provider.spool_calls()] == calls
@@ -0,0 +1,40 @@
+from djwebdapp.nodes import NodePool
+from djwebdapp_ethereum.provider import PoolHTTPProvider
+
+
+def test_pool_http_provider(http_stub, http_dead):
+    hits = []
+
+    def node(name, head):
+        def handler(method, path, body):
+            hits.append((name, body['method']))
+            if body['method'] == 'eth_blockNumber':
+                result = hex(head)
+            elif int(body['params'][0], 16) > head:
+                result = None
+            else:
+                result = dict(number=body['params'][0], node=name)
+            return 200, dict(jsonrpc='2.0', id=body['id'], result=result)
+        return http_stub(handler)
+
+    pool = NodePool([
+        (http_dead, 2),
+        (node('primary', 10), 1),
+        (node('behind', 5), 0),
+    ])
+    provider = PoolHTTPProvider(pool)
+
+    # the dead node fails over to the primary one
+    assert provider.make_request('eth_blockNumber', [])['result'] == '0xa'
+    assert hits == [('primary', 'eth_blockNumber')]
+    assert pool.nodes[0].errors == 1
+
+    results = [
+        provider.make_request('eth_getBlockByNumber', [hex(level), True])
+        for level in (8, 8, 8)
+    ]
+    assert all(result['result']['node'] == 'primary' for result in results)
+    assert ('behind', 'eth_getBlockByNumber') in hits
+
+    response = provider.make_request('eth_getBlockByNumber', ['0x14', True])
+    assert response['result'] is None
@@ -0,0 +1,48 @@
+import pytest
+
+from djwebdapp.models import Blockchain
+from djwebdapp_ethereum.provider import EthereumProvider
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('block_receipts', [False, True])
+def test_get_statuses(http_stub, block_receipts):
+    posts = []
+    receipts = {
+        '0xaa': dict(transactionHash='0xAA', status='0x1'),
+        '0xbb': dict(transactionHash='0xbb', status='0x0'),
+        '0xcc': dict(transactionHash='0xcc', status='0x1'),
+    }
+
+    def response(request):
+        if request['method'] == 'eth_getBlockReceipts':
+            assert request['params'] == ['0xa']
+            result = [*receipts.values()]
+        else:
+            result = receipts.get(request['params'][0], None)
+        return dict(jsonrpc='2.0', id=request['id'], result=result)
+
+    def handler(method, path, body):
+        posts.append(body)
+        if isinstance(body, list):
+            return 200, [response(request) for request in body]
+        return 200, response(body)
+
+    blockchain = Blockchain.objects.create(
+        name='ethstub',
+        provider_class='djwebdapp_ethereum.provider.EthereumProvider',
+        configuration=dict(index_block_receipts=block_receipts),
+    )
+    blockchain.node_set.create(endpoint=http_stub(handler))
+    provider = EthereumProvider(blockchain=blockchain)
+
+    assert provider.get_statuses(10, []) == dict()
+    assert not posts
+
+    # receipts of transactions which are not asked for are left out, as
+    # well as transactions without receipts
+    assert provider.get_statuses(10, ['0xaa', '0xbb', '0xdd']) == {
+        '0xaa': 1,
+        '0xbb': 0,
+    }
+    assert len(posts) == 1
@@ -73,3 +73,35 @@ def test_normalize_success(account, blockchain, transaction_normalizer):
     assert tx.normalized
     assert not tx.error
     assert not tx.last_fail
+
+
+@pytest.mark.django_db
+def test_deploy_update_fields(account, blockchain):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    tx = Transaction.objects.create(
+        blockchain=blockchain,
+        kind='contract',
+        sender=account,
+        metadata=dict(large='x' * 1000),
+    )
+    tx.metadata = dict(changed=True)
+
+    # Success provider does not implement deploy
+    with CaptureQueriesContext(connection) as queries:
+        with pytest.raises(NotImplementedError):
+            tx.deploy()
+
+    updates = [
+        query['sql'] for query in queries.captured_queries
+        if query['sql'].startswith('UPDATE')
+    ]
+    assert len(updates) == 2
+    assert all('"metadata"' not in sql for sql in updates)
+    assert '"last_fail"' in updates[1]
+
+    tx = Transaction.objects.get(pk=tx.pk)
+    assert tx.state == 'retry'
+    assert tx.last_fail
+    assert tx.metadata == dict(large='x' * 1000)
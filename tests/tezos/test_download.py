@@ -0,0 +1,78 @@
+import json
+import urllib.parse
+
+import pytest
+
+from djwebdapp.models import Account, Blockchain
+from djwebdapp_tezos.models import TezosTransaction
+
+
+def operation(id, status='applied'):
+    return {
+        'id': id,
+        'type': 'transaction',
+        'status': status,
+        'level': id,
+        'hash': f'oo{id}',
+        'counter': id,
+        'sender': {'address': f'tz1{id % 2}'},
+        'parameter': {
+            'entrypoint': 'mint',
+            'value': {'_to': 'tz10', 'value': str(id)},
+        },
+        'gasUsed': 10,
+    }
+
+
+@pytest.mark.django_db
+def test_download(http_stub):
+    operations = [operation(id) for id in range(1, 6)]
+    operations[2]['status'] = 'failed'
+    queries = []
+    crash = [True]
+
+    def node(method, path, body):
+        return 200, {'level_info': {'level': 100}}
+
+    def tzkt(method, path, body):
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(path).query))
+        queries.append(query)
+        cursor = int(query['id.gt'])
+        if cursor >= 2 and crash[0]:
+            crash[0] = False
+            return 500, 'Crash'
+        page = [op for op in operations if op['id'] > cursor]
+        return 200, page[:int(query['limit'])]
+
+    blockchain = Blockchain.objects.create(
+        provider_class='djwebdapp_tezos.provider.TezosProvider',
+        configuration=dict(tzkt_url=http_stub(tzkt), download_limit=2),
+    )
+    blockchain.node_set.create(endpoint=http_stub(node))
+    with open('src/djwebdapp_example_tezos/contracts/FA12.json') as f:
+        contract = TezosTransaction.objects.create(
+            blockchain=blockchain,
+            address='KT1download',
+            micheline=json.load(f),
+        )
+
+    # first page is saved before the crash
+    with pytest.raises(Exception):
+        blockchain.provider.download(contract.address)
+    assert contract.call_set.count() == 2
+    assert Account.objects.filter(blockchain=blockchain).count() == 2
+
+    # resume after the last saved operation
+    assert blockchain.provider.download(contract.address) == 2
+    assert [query['id.gt'] for query in queries] == ['0', '2', '2', '4', '5']
+    assert queries[0]['level.le'] == '99'
+
+    calls = contract.call_set.order_by('level')
+    assert [call.level for call in calls] == [1, 2, 4, 5]
+    assert calls[0].function == 'mint'
+    assert calls[0].args == {'_to': 'tz10', 'value': 1}
+    assert {call.state for call in calls} == {'done'}
+
+    # nothing left to download
+    assert blockchain.provider.download(contract.address) == 0
+    assert contract.call_set.count() == 4
@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+from djwebdapp.models import Blockchain, Code
+from djwebdapp_tezos import models
+from djwebdapp_tezos.models import TezosTransaction, get_interface
+
+
+def load(path):
+    with open(f'src/djwebdapp_example_tezos/{path}') as f:
+        return json.load(f)
+
+
+def test_interface_cache(monkeypatch):
+    micheline = load('contracts/FA12.json')
+    monkeypatch.setitem(models.SETTINGS, 'TEZOS_INTERFACES', 2)
+    models.interfaces.clear()
+
+    contract = TezosTransaction(address='KT1a', micheline=micheline)
+    interface = contract.interface
+    assert contract.interface is interface
+    assert hasattr(interface, 'mint')
+
+    # shared by every contract with the same code
+    contract = TezosTransaction(address='KT1b', micheline=micheline)
+    assert contract.interface is interface
+    assert get_interface(load('caller.json')) is not interface
+    assert len(models.interfaces) == 2
+
+    # least recently used first out
+    get_interface(load('callee.json'))
+    assert get_interface(micheline) is not interface
+
+
+@pytest.mark.django_db
+def test_code_store(django_assert_num_queries):
+    micheline = load('contracts/FA12.json')
+    models.interfaces.clear()
+    blockchain = Blockchain.objects.create(
+        provider_class='djwebdapp.provider.Success',
+    )
+    contracts = [
+        TezosTransaction.objects.create(
+            blockchain=blockchain,
+            address=f'KT1{i}',
+            micheline=micheline,
+        )
+        for i in range(3)
+    ]
+    code = Code.objects.get()
+    assert code.code == micheline
+    assert {contract.code_id for contract in contracts} == {code.hash}
+
+    contract = TezosTransaction.objects.get(address='KT10')
+    assert contract.has_code
+    # code is only loaded to parse the interface once
+    with django_assert_num_queries(1):
+        interface = contract.interface
+    contract = TezosTransaction.objects.get(address='KT11')
+    with django_assert_num_queries(0):
+        assert contract.interface is interface
+    assert contract.micheline == micheline
+
+    # unchanged code is not stored again
+    with django_assert_num_queries(1):
+        contract.micheline = micheline
+        contract.save(update_fields=['name'])
+
+
+@pytest.mark.django_db
+def test_code_admin_form():
+    from django.forms import modelform_factory
+    from djwebdapp_tezos.admin import TezosTransactionForm
+
+    micheline = load('contracts/FA12.json')
+    blockchain = Blockchain.objects.create(
+        provider_class='djwebdapp.provider.Success',
+    )
+    contract = TezosTransaction.objects.create(
+        blockchain=blockchain,
+        address='KT1a',
+        micheline=micheline,
+    )
+    # declared code fields are added to the model fields of the admin
+    Form = modelform_factory(  # noqa
+        TezosTransaction,
+        form=TezosTransactionForm,
+        fields=['name'],
+    )
+    form = Form(instance=contract)
+    assert form.initial['micheline'] == micheline
+
+    caller = load('caller.json')
+    data = dict(name='a', micheline=json.dumps(caller))
+    form = Form(data, instance=contract)
+    assert form.is_valid(), form.errors
+    form.save()
+    contract = TezosTransaction.objects.get(pk=contract.pk)
+    assert contract.micheline == caller
+    assert Code.objects.count() == 2
@@ -0,0 +1,635 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from django.db import OperationalError, connection
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from djwebdapp.models import Account, Blockchain, Event, Lease
+from djwebdapp.normalizers import Normalizer
+from djwebdapp.provider import NormalizePipeline, Success
+from djwebdapp_tezos.models import TezosTransaction
+from djwebdapp_tezos.provider import TezosProvider
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('normalize_batch', (2, 100))
+def test_normalize_batch(monkeypatch, normalize_batch):
+    calls = []
+
+    class BatchNormalizer(Normalizer):
+        def deploy(self, transaction, contract):
+            calls.append('deploy')
+
+        def mint(self, transaction, contract):
+            assert contract.pk == transaction.contract_id
+            calls.append(transaction.name)
+
+        def fail(self, transaction, contract):
+            Account.objects.create(address='rolledback', blockchain=blockchain)
+            raise Exception('fail')
+
+        def Mint(self, event, contract):
+            calls.append(event.name + event.args['name'])
+
+    monkeypatch.setattr(TezosTransaction, 'normalizer_class', BatchNormalizer)
+    blockchain = Blockchain.objects.create(
+        provider_class='djwebdapp.provider.Success',
+        configuration=dict(normalize_batch=normalize_batch),
+    )
+    contract = TezosTransaction.objects.create(
+        blockchain=blockchain,
+        kind='contract',
+        state='done',
+    )
+
+    def call(name, function='mint', **kwargs):
+        return TezosTransaction.objects.create(
+            blockchain=blockchain,
+            contract=contract,
+            function=function,
+            name=name,
+            state='done',
+            **kwargs,
+        )
+
+    first = call('first')
+    call('internal', caller=first, nonce=2)
+    call('internal0', caller=first, nonce=1)
+    second = call('second')
+    Event.objects.create(
+        name='Mint',
+        args=dict(name='second'),
+        event_index=0,
+        transaction=second,
+    )
+    failed = call('failed', function='fail')
+    call('last')
+
+    provider = TezosProvider(blockchain=blockchain)
+    with CaptureQueriesContext(connection) as queries:
+        provider.normalize()
+
+    assert calls == [
+        'deploy',
+        'first',
+        'internal0',
+        'internal',
+        'second',
+        'Mintsecond',
+        'last',
+    ]
+    assert TezosTransaction.objects.filter(normalized=False).get() == failed
+    failed.refresh_from_db()
+    assert failed.error.endswith('Exception: fail\n')
+    assert failed.last_fail
+    assert not Account.objects.filter(address='rolledback').exists()
+    assert Event.objects.get().normalized
+
+    # the number of queries depends on the number of pages, not of rows
+    selects = [
+        query for query in queries.captured_queries
+        if query['sql'].startswith('SELECT')
+    ]
+    n_pages = -(-5 // normalize_batch)
+    # plus the last empty page, and the blockchain to log the failure
+    assert len(selects) == 4 * n_pages + 2
+
+    # failed transactions are retried on the next run only
+    calls.clear()
+    provider.normalize()
+    assert calls == []
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('fail', (False, True))
+def test_fa2_transfer_batch(monkeypatch, fail):
+    from djwebdapp_fa2.models import Balance, Fa2Contract, Fa2Token
+    from djwebdapp_fa2.normalizers import Fa2Normalizer
+
+    blockchain = Blockchain.objects.create(
+        provider_class='djwebdapp.provider.Success',
+    )
+    contract = Fa2Contract.objects.create(
+        blockchain=blockchain,
+        state='done',
+        normalized=True,
+    )
+    token = Fa2Token.objects.create(contract=contract, token_id=0)
+    Balance.objects.create(
+        account=Account.objects.create(address='tz1', blockchain=blockchain),
+        token=token,
+        amount=100,
+    )
+
+    def transfer(from_, *txs):
+        return TezosTransaction.objects.create(
+            blockchain=blockchain,
+            contract=contract,
+            function='transfer',
+            state='done',
+            args=[{
+                'from_': from_,
+                'txs': [
+                    dict(to_=to_, token_id=token_id, amount=amount)
+                    for to_, token_id, amount in txs
+                ],
+            }],
+        )
+
+    transfer('tz1', ('tz2', 0, 1))
+    transfer('tz1', ('tz2', 0, 2), ('tz3', 0, 3))
+    if fail:
+        # unknown token, fails the batch then its own call
+        failed = transfer('tz2', ('tz3', 1, 1))
+    else:
+        # calls are only passed to the batch callback
+        def fail_transfer(self, call, contract):
+            raise Exception('not batched')
+        monkeypatch.setattr(Fa2Normalizer, 'transfer', fail_transfer)
+    transfer('tz2', ('tz3', 0, 1))
+
+    TezosProvider(blockchain=blockchain).normalize()
+
+    assert {
+        balance.account.address: balance.amount
+        for balance in token.balance_set.all()
+    } == {'tz1': 94, 'tz2': 2, 'tz3': 4}
+    if fail:
+        assert TezosTransaction.objects.filter(
+            normalized=False,
+        ).get() == failed
+    else:
+        assert not TezosTransaction.objects.filter(normalized=False).exists()
+
+
+@pytest.mark.django_db
+def test_fa2_transfer_batch_unbatched(monkeypatch):
+    from djwebdapp_fa2.models import Balance, Fa2Contract, Fa2Token
+    from djwebdapp_fa2.normalizers import Fa2Normalizer
+
+    def normalize(name):
+        blockchain = Blockchain.objects.create(
+            name=name,
+            provider_class='djwebdapp.provider.Success',
+        )
+        contract = Fa2Contract.objects.create(
+            blockchain=blockchain,
+            state='done',
+            normalized=True,
+        )
+        token = Fa2Token.objects.create(contract=contract, token_id=0)
+        Balance.objects.create(
+            account=Account.objects.create(
+                address='tz1',
+                blockchain=blockchain,
+            ),
+            token=token,
+            amount=100,
+        )
+        for from_, *txs in (
+            ('tz1', ('tz2', 1)),
+            # self-transfer
+            ('tz1', ('tz1', 5), ('tz2', 2)),
+            # previously unknown recipient
+            ('tz2', ('tz3', 1), ('tz2', 1)),
+        ):
+            TezosTransaction.objects.create(
+                blockchain=blockchain,
+                contract=contract,
+                function='transfer',
+                state='done',
+                args=[{
+                    'from_': from_,
+                    'txs': [
+                        dict(to_=to_, token_id=0, amount=amount)
+                        for to_, amount in txs
+                    ],
+                }],
+            )
+        TezosProvider(blockchain=blockchain).normalize()
+        assert not TezosTransaction.objects.filter(
+            blockchain=blockchain,
+            normalized=False,
+        ).exists()
+        return (
+            {
+                (balance.account.address, balance.amount)
+                for balance in token.balance_set.all()
+            },
+            {
+                (account.address, account.balance)
+                for account in blockchain.account_set.all()
+            },
+        )
+
+    batched = normalize('batched')
+    with monkeypatch.context() as patch:
+        patch.delattr(Fa2Normalizer, 'transfer__batch')
+        assert normalize('unbatched') == batched
+    assert batched[0] == {('tz1', 97), ('tz2', 2), ('tz3', 1)}
+    assert batched[1] == {
+        ('tz1', 1_000_000),
+        ('tz2', 1_000_000),
+        ('tz3', 1_000_000),
+    }
+
+
+def concurrent_writers():
+    # sqlite fails a writer while another one holds the lock, right away in
+    # the shared cache of the in-memory test database, and when a read
+    # transaction is upgraded to write in a database file
+    return connection.vendor != 'sqlite'
+
+
+@pytest.mark.django_db
+def test_lease(monkeypatch):
+    monkeypatch.setattr(Lease, 'owner_id', lambda: 'first')
+    lease = Lease.acquire('test', 60)
+    assert lease.owner == 'first'
+    # the owner may acquire its lease again
+    assert Lease.acquire('test', 60)
+    assert lease.renew(60)
+
+    monkeypatch.setattr(Lease, 'owner_id', lambda: 'second')
+    assert not Lease.acquire('test', 60)
+
+    # an expired lease is taken over, and lost by its previous owner
+    Lease.objects.update(expires_at=timezone.now() - datetime.timedelta(1))
+    other = Lease.acquire('test', 60)
+    assert other.owner == 'second'
+    assert not lease.renew(60)
+    lease.release()
+    assert Lease.objects.get().owner == 'second'
+
+    other.release()
+    assert not Lease.objects.exists()
+
+    # retried while the database is locked
+    take = Lease.take
+    attempts = []
+
+    def locked(cls, name, ttl):
+        attempts.append(name)
+        if len(attempts) < 3:
+            raise OperationalError('database table is locked')
+        return take(name, ttl)
+
+    monkeypatch.setattr(Lease, 'take', classmethod(locked))
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    assert Lease.acquire('test', 60).owner == 'second'
+    assert len(attempts) == 3
+
+    attempts.clear()
+    with pytest.raises(OperationalError):
+        Lease.acquire('test', 60, retries=2)
+    assert len(attempts) == 2
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('kind', ('thread', 'process'))
+def test_normalize_parallel(monkeypatch, kind):
+    if kind == 'process' and connection.vendor == 'sqlite':
+        if connection.is_in_memory_db():
+            pytest.skip('forked processes do not share in-memory databases')
+    size = 2 if concurrent_writers() else 1
+
+    class PartitionNormalizer(Normalizer):
+        # accounts record the order of normalization across processes
+        def deploy(self, transaction, contract):
+            Account.objects.create(
+                blockchain=transaction.blockchain,
+                address=transaction.name,
+                balance=1,
+            )
+
+        mint = deploy
+
+    def normalized():
+        return [*Account.objects.order_by('pk').values_list(
+            'address',
+            flat=True,
+        )]
+
+    monkeypatch.setattr(
+        TezosTransaction,
+        'normalizer_class',
+        PartitionNormalizer,
+    )
+    blockchain = Blockchain.objects.create(
+        provider_class='djwebdapp_tezos.provider.TezosProvider',
+    )
+    contracts = dict()
+    for name in ('a', 'b', 'c', 'd'):
+        contract = contracts[name] = TezosTransaction.objects.create(
+            blockchain=blockchain,
+            kind='contract',
+            state='done',
+            name=name,
+        )
+        for number in range(2):
+            TezosTransaction.objects.create(
+                blockchain=blockchain,
+                contract=contract,
+                function='mint',
+                name=f'{name}{number}',
+                state='done',
+            )
+    # calls of a normalized contract are a partition of their own
+    contracts['c'].normalized = True
+    contracts['c'].save()
+    # a calls d, so they are normalized by the same worker
+    TezosTransaction.objects.create(
+        blockchain=blockchain,
+        contract=contracts['d'],
+        caller=TezosTransaction.objects.get(name='a0'),
+        function='mint',
+        name='a0d',
+        state='done',
+    )
+
+    provider = blockchain.provider
+    partitions = provider.normalize_partitions()
+    assert partitions == sorted([
+        sorted([contracts['a'].pk, contracts['d'].pk]),
+        [contracts['b'].pk],
+        [contracts['c'].pk],
+    ])
+
+    # a contract leased by another worker is skipped with its partition
+    Lease.objects.create(
+        name=f'normalize:{contracts["d"].pk}',
+        owner='other',
+        expires_at=timezone.now() + datetime.timedelta(1),
+    )
+    # workers compete for each partition
+    monkeypatch.setattr(
+        type(provider),
+        'normalize_partitions',
+        lambda self: partitions * 2,
+    )
+    assert 2 <= provider.normalize_parallel(size, kind) <= 4
+    assert sorted(normalized()) == ['b', 'b0', 'b1', 'c0', 'c1']
+    # order is kept within a contract
+    assert [name for name in normalized() if name.startswith('b')] == [
+        'b', 'b0', 'b1',
+    ]
+    assert Lease.objects.get().owner == 'other'
+
+    # a transaction stops before it reaches a contract leased by another
+    # worker, ie. linked after partitioning
+    assert provider.normalize_partition([contracts['a'].pk])
+    assert normalized()[5:] == ['a']
+    assert Lease.objects.get().owner == 'other'
+
+    Lease.objects.all().delete()
+    assert 1 <= provider.normalize_parallel(size, kind) <= 6
+    assert normalized()[6:] == ['a0', 'a0d', 'a1', 'd', 'd0', 'd1']
+    assert not TezosTransaction.objects.filter(normalized=False).exists()
+    assert not Lease.objects.exists()
+
+
+@pytest.mark.django_db
+def test_normalize_backoff(monkeypatch):
+    attempts = []
+
+    class FailNormalizer(Normalizer):
+        def fail(self, transaction, contract):
+            attempts.append(transaction.name)
+            raise Exception('fail')
+
+    monkeypatch.setattr(TezosTransaction, 'normalizer_class', FailNormalizer)
+    blockchain = Blockchain.objects.create(
+        provider_class='djwebdapp_tezos.provider.TezosProvider',
+        configuration=dict(normalize_max_fails=2, normalize_backoff=10),
+    )
+    contract = TezosTransaction.objects.create(
+        blockchain=blockchain,
+        kind='contract',
+        state='done',
+    )
+    failed = TezosTransaction.objects.create(
+        blockchain=blockchain,
+        contract=contract,
+        function='fail',
+        name='failed',
+        state='done',
+    )
+    # transactions of another blockchain are left to its own provider
+    other = TezosTransaction.objects.create(
+        blockchain=Blockchain.objects.create(
+            provider_class='djwebdapp_tezos.provider.TezosProvider',
+        ),
+        kind='contract',
+        state='done',
+    )
+    provider = blockchain.provider
+
+    def retry():
+        TezosTransaction.objects.filter(pk=failed.pk).update(
+            normalize_after=F('normalize_after') - datetime.timedelta(1),
+        )
+
+    provider.normalize()
+    failed.refresh_from_db()
+    assert failed.normalize_fails == 1
+    assert (
+        failed.normalize_after - failed.last_fail
+    ).total_seconds() == pytest.approx(10, abs=1)
+    assert not TezosTransaction.objects.get(pk=other.pk).normalized
+
+    # not retried before the back-off delay
+    provider.normalize()
+    assert attempts == ['failed']
+
+    retry()
+    provider.normalize()
+    assert attempts == ['failed', 'failed']
+    failed.refresh_from_db()
+    assert failed.normalize_fails == 2
+    assert failed.normalize_after is None
+
+    # dead letter until requeued
+    provider.normalize()
+    assert attempts == ['failed', 'failed']
+    assert provider.normalize_requeue() == 1
+    provider.normalize()
+    assert attempts == ['failed', 'failed', 'failed']
+    failed.refresh_from_db()
+    assert failed.normalize_fails == 1
+    assert failed.normalize_after
+
+
+@pytest.mark.django_db
+def test_normalize_transactions(monkeypatch):
+    calls = []
+
+    class QueueNormalizer(Normalizer):
+        def deploy(self, transaction, contract):
+            calls.append(transaction.name)
+
+        mint = deploy
+
+    monkeypatch.setattr(
+        TezosTransaction,
+        'normalizer_class',
+        QueueNormalizer,
+    )
+    blockchain = Blockchain.objects.create(
+        provider_class='djwebdapp.provider.Success',
+    )
+
+    def create(name, **kwargs):
+        return TezosTransaction.objects.create(
+            blockchain=blockchain,
+            name=name,
+            state='done',
+            **kwargs,
+        )
+
+    behind, direct, other = [
+        create(name, kind='contract', normalized=True)
+        for name in ('behind', 'direct', 'other')
+    ]
+    create('old', contract=behind, function='mint')
+    # not queued, left for the next normalize() run
+    create('other0', contract=other, function='mint')
+    queued = [
+        create(name, contract=contract, function='mint')
+        for name, contract in (('new', behind), ('direct0', direct))
+    ]
+    queued.append(create('direct1', contract=direct, function='mint'))
+
+    provider = PipelineProvider(blockchain=blockchain)
+    partitions = []
+    normalize_partition = provider.normalize_partition
+
+    def record(contracts, ids=None):
+        partitions.append((contracts, ids))
+        return normalize_partition(contracts, ids=ids)
+
+    monkeypatch.setattr(provider, 'normalize_partition', record)
+    ids = [transaction.pk for transaction in queued[1:]]
+    provider.normalize_transactions(ids)
+    # the older transactions of a contract are normalized first, with the
+    # history of the contract
+    provider.normalize_transactions([queued[0].pk])
+    assert calls == ['direct0', 'direct1', 'old', 'new']
+    assert partitions == [([direct.pk], ids), ([behind.pk], None)]
+    assert [*TezosTransaction.objects.filter(
+        normalized=False,
+    ).values_list('name', flat=True)] == ['other0']
+    assert not Lease.objects.exists()
+
+
+class PipelineProvider(Success):
+    transaction_class = TezosTransaction
+
+    def get_head(self):
+        return 2
+
+    def index_level(self, level, block=None):
+        contract = TezosTransaction(
+            blockchain=self.blockchain,
+            kind='contract',
+            level=level,
+            name=f'contract{level}',
+        )
+        self.index_save(contract)
+        for contract, name in (
+            (contract, f'mint{level}'),
+            (self.transaction_class.objects.get(name='contract0'),
+             f'again{level}'),
+        ):
+            self.index_save(TezosTransaction(
+                blockchain=self.blockchain,
+                contract=contract,
+                function='mint',
+                level=level,
+                name=name,
+            ))
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('index_normalize', (0, 2))
+def test_index_normalize(monkeypatch, index_normalize):
+    calls = []
+
+    class PipelineNormalizer(Normalizer):
+        def deploy(self, transaction, contract):
+            calls.append((transaction.name, threading.current_thread().name))
+
+        def mint(self, transaction, contract):
+            calls.append((transaction.name, threading.current_thread().name))
+
+    monkeypatch.setattr(
+        TezosTransaction,
+        'normalizer_class',
+        PipelineNormalizer,
+    )
+    blockchain = Blockchain.objects.create(
+        provider_class='djwebdapp.provider.Success',
+        configuration=dict(index_normalize=index_normalize),
+        index_level=1,
+        min_confirmations=0,
+    )
+    # a contract with a transaction left to normalize by a previous run
+    contract = TezosTransaction.objects.create(
+        blockchain=blockchain,
+        kind='contract',
+        name='contract0',
+        state='done',
+    )
+    TezosTransaction.objects.create(
+        blockchain=blockchain,
+        contract=contract,
+        function='mint',
+        name='old0',
+        state='done',
+    )
+    if not concurrent_writers():
+        # index the next level once the pipeline normalized the previous one
+        normalized = threading.Semaphore(0)
+        normalize_transactions = PipelineProvider.normalize_transactions
+        put = NormalizePipeline.put
+
+        def normalize_wait(self, ids):
+            try:
+                normalize_transactions(self, ids)
+            finally:
+                normalized.release()
+
+        def put_wait(self, ids):
+            put(self, ids)
+            normalized.acquire()
+
+        monkeypatch.setattr(
+            PipelineProvider,
+            'normalize_transactions',
+            normalize_wait,
+        )
+        monkeypatch.setattr(NormalizePipeline, 'put', put_wait)
+    PipelineProvider(blockchain=blockchain).index()
+
+    if index_normalize:
+        thread = f'normalize-{blockchain.pk}'
+        assert {call[1] for call in calls} == {thread}
+        names = [call[0] for call in calls]
+        # the history of each contract is normalized in order, older
+        # transactions first
+        for history in (
+            ['contract0', 'old0', 'again1', 'again2'],
+            ['contract1', 'mint1'],
+            ['contract2', 'mint2'],
+        ):
+            assert [name for name in names if name in history] == history
+        assert len(names) == 8
+        assert not TezosTransaction.objects.filter(normalized=False).exists()
+        assert not Lease.objects.exists()
+    else:
+        assert calls == []
+        assert TezosTransaction.objects.filter(normalized=False).count() == 8
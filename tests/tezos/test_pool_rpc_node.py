@@ -0,0 +1,91 @@
+import pytest
+from pytezos.rpc import RpcError
+
+from djwebdapp.nodes import NodePool
+from djwebdapp_tezos.provider import PoolRpcNode, RpcNodeError
+
+
+def test_pool_rpc_node(http_stub):
+    hits = []
+
+    def node(name, head):
+        def handler(method, path, body):
+            hits.append((name, path))
+            if path.startswith('/chains/main/blocks/head'):
+                return 200, dict(level=head)
+            level = int(path.split('/')[4])
+            if level > head:
+                return 404, 'Not found'
+            return 200, dict(level=level, node=name)
+        return http_stub(handler)
+
+    pool = NodePool([(node('behind', 5), 0), (node('primary', 10), 1)])
+    rpc = PoolRpcNode(pool)
+
+    # head queries go to the primary node
+    assert rpc.get('chains/main/blocks/head/header') == dict(level=10)
+    assert hits == [('primary', '/chains/main/blocks/head/header')]
+
+    # blocks are spread, the behind node passes over to the next one
+    blocks = [
+        rpc.get(f'chains/main/blocks/{level}/header')
+        for level in (4, 4, 8, 8)
+    ]
+    assert [block['level'] for block in blocks] == [4, 4, 8, 8]
+    assert {block['node'] for block in blocks[:2]} == {'primary', 'behind'}
+    assert {block['node'] for block in blocks[2:]} == {'primary'}
+    assert all(node.errors == 0 for node in pool.nodes)
+
+
+def test_pool_rpc_node_errors(http_stub):
+    hits = []
+
+    def failing(method, path, body):
+        hits.append('failing')
+        if path.endswith('/run_operation'):
+            # protocol errors are the same on every node
+            return 500, [{'kind': 'permanent', 'id': 'proto.script_rejected'}]
+        return 502, 'Bad gateway'
+
+    def backup(method, path, body):
+        hits.append('backup')
+        return 200, dict(level=1)
+
+    pool = NodePool(
+        [(http_stub(failing), 1), (http_stub(backup), 0)],
+        max_errors=2,
+        errors=(OSError, RpcNodeError),
+    )
+    rpc = PoolRpcNode(pool)
+
+    with pytest.raises(RpcError) as error:
+        rpc.post('chains/main/blocks/head/helpers/scripts/run_operation', {})
+    assert not isinstance(error.value, RpcNodeError)
+    assert pool.nodes[0].errors == 0
+
+    # 5xx answers fail over, then the node is skipped
+    hits.clear()
+    for _ in range(3):
+        assert rpc.get('chains/main/blocks/head/header') == dict(level=1)
+    assert hits == ['failing', 'backup', 'failing', 'backup', 'backup']
+    assert not pool.nodes[0].healthy
+
+
+def test_session_rpc_node_retries(http_stub, monkeypatch):
+    from djwebdapp_tezos import provider
+
+    hits = []
+
+    def handler(method, path, body):
+        hits.append(path)
+        return 503, [dict(kind='temporary', id='node.busy')]
+
+    sleeps = []
+    monkeypatch.setattr(provider.time, 'sleep', sleeps.append)
+    node = provider.SessionRpcNode(http_stub(handler))
+    with pytest.raises(RpcNodeError):
+        node.get('chains/main/blocks/head/header')
+
+    # no back-off after the last attempt
+    assert len(hits) == node.retries == 3
+    assert sleeps == [.25, .5]
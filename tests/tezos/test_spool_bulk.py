@@ -0,0 +1,38 @@
+import pytest
+
+from djwebdapp_tezos.models import TezosTransaction
+
+
+@pytest.mark.django_db
+def test_spool_bulk(blockchain, account1, account2):
+    blockchain.configuration['spool_bulk'] = 2
+    blockchain.save()
+    account1.balance = 1
+    account1.last_level = 0
+    account1.save()
+
+    transfers = [
+        TezosTransaction.objects.create(
+            sender=account1,
+            receiver=account2,
+            amount=amount,
+            state='deploy',
+        )
+        for amount in (1, 2, 3)
+    ]
+
+    assert blockchain.provider.spool() == transfers[0]
+    for transfer in transfers:
+        transfer.refresh_from_db()
+
+    # the first two transfers were injected in a single operation group
+    assert transfers[0].hash == transfers[1].hash
+    assert transfers[0].counter != transfers[1].counter
+    assert transfers[1].state == 'done'
+    assert not transfers[2].hash
+
+    blockchain.wait()
+    blockchain.provider.index()
+    for transfer in transfers[:2]:
+        transfer.refresh_from_db()
+        assert transfer.metadata['amount'] == str(transfer.amount)